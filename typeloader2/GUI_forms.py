@@ -13,22 +13,32 @@ components for forms and dialogs
 # import modules:
 
 import sys, os
+from threading import Event
 from PyQt5.QtSql import QSqlQueryModel, QSqlQuery
 from PyQt5.QtWidgets import (QApplication, QListView, QGroupBox, QGridLayout,
                              QFileDialog, QLabel, QPushButton, QLineEdit, QDialog,
                              QTreeWidgetItem, QVBoxLayout, QHBoxLayout, QFrame,
-                             QTableWidget, QWidget, QCheckBox, QTableWidgetItem)
+                             QTableWidget, QWidget, QCheckBox, QTableWidgetItem, QProgressDialog)
 from PyQt5.Qt import pyqtSlot, pyqtSignal, QTreeWidget
-from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QColor
+from PyQt5.QtCore import Qt, QThread, QEventLoop
+from PyQt5.QtGui import QColor, QFont
 
 from typeloader2 import general, db_internal
+from typeloader2.typeloader_functions import check_project_open
+
+try:
+    from .typeloader_core import jobs
+except ImportError:
+    from typeloader2.typeloader_core import jobs
 from typeloader2.GUI_forms_new_project import NewProjectForm
 
 
 # ===========================================================
 # parameters:
 
+font_bold = QFont()
+font_bold.setBold(True)
+
 # ===========================================================
 # classes:
 
@@ -569,7 +579,7 @@ class FileChoiceTable(QTableWidget):
                 if self.instant_accept_status:
                     if status == self.instant_accept_status:
                         self.check_dic[i].setChecked(True)
-                        status_item.setFont(general.font_bold)
+                        status_item.setFont(font_bold)
                     else:
                         all_checked = False
             self.setItem(i, self.allele_status_column + 1, status_item)
@@ -778,31 +788,84 @@ class ChoiceTable(QTableWidget):
 # ===========================================================
 # functions:
 
-def check_project_open(project_name, log, parent=None):
-    """checks whether the current project is open or closed;
-    returns True if open, False if closed
+class TaskWorker(QThread):
+    """runs func(*args, **kwargs) in a worker thread as a jobs.Job;
+    emits each stage the job reaches,
+    database calls of the job (see jobs.run_in_main_thread) are run in the GUI thread;
+    if the job is cancelled, on_cancel is called (in the worker thread)
     """
-    if not project_name:  # if no project given, treat as "Open"
-        return True
-    log.info(f"Checking status of project {project_name}...")
-    query = f"select project_status from projects where project_name = '{project_name}'"
-    success, data = db_internal.execute_query(query, 1, log,
-                                              f"retrieving project status of project {project_name} from database",
-                                              parent=parent)
-    if success and data:
-        project_open = True
-        status = data[0][0]
-        if status.lower() == "closed":
-            project_open = False
-        log.info(f"\t=> project status: {status}")
-    else:
-        if success and not data:
-            log.warning(f"\t=> Project {project_name} was not found!")
-        else:
-            log.warning(data)
-        project_open = True  # when in doubt, err on the side of giving access to the project
+    stage = pyqtSignal(str)
+    call_requested = pyqtSignal(object)
+
+    def __init__(self, func, *args, on_cancel=None, **kwargs):
+        super().__init__()
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.on_cancel = on_cancel
+        self.result = None
+        self.error = None
+        self.job = jobs.Job(on_stage=self.stage.emit, main_thread_runner=self.run_in_gui_thread)
+        self.call_requested.connect(self.handle_call)
+
+    def run(self):
+        try:
+            self.result = jobs.run_with_job(self.job, self.func, *self.args, **self.kwargs)
+        except BaseException as E:
+            self.error = E
+            if self.on_cancel and isinstance(E, jobs.JobCancelled):
+                self.on_cancel()
 
-    return project_open
+    @pyqtSlot()
+    def cancel(self):
+        self.job.cancel()
+
+    def run_in_gui_thread(self, func, *args, **kwargs):
+        """called from the worker thread: lets the GUI thread run func(*args, **kwargs) and waits for its result
+        """
+        call = {"func": func, "args": args, "kwargs": kwargs, "done": Event()}
+        self.call_requested.emit(call)
+        call["done"].wait()
+        if "error" in call:
+            raise call["error"]
+        return call["result"]
+
+    @pyqtSlot(object)
+    def handle_call(self, call):
+        try:
+            call["result"] = call["func"](*call["args"], **call["kwargs"])
+        except BaseException as E:
+            call["error"] = E
+        finally:
+            call["done"].set()
+
+
+def run_task(parent, log, title, func, *args, on_cancel=None, **kwargs):
+    """runs func(*args, **kwargs) in a TaskWorker and shows its progress in a dialog with a Cancel button;
+    the GUI stays responsive until the task is done;
+    returns its result or raises its exception (jobs.JobCancelled if the user cancelled it,
+    after calling on_cancel, e.g. to drop the task's in-memory temp files)
+    """
+    worker = TaskWorker(func, *args, on_cancel=on_cancel, **kwargs)
+    progress = QProgressDialog(title + "...", "Cancel", 0, 0, parent)
+    progress.setWindowTitle(title)
+    progress.setWindowModality(Qt.WindowModal)
+    progress.setMinimumDuration(500)
+    progress.canceled.connect(worker.cancel)
+    worker.stage.connect(lambda stage: progress.setLabelText(f"{title}:\n{stage}..."))
+    worker.stage.connect(lambda stage: log.debug(f"{title}: {stage}..."))
+
+    loop = QEventLoop()
+    worker.finished.connect(loop.quit)
+    worker.start()
+    loop.exec_()
+    worker.wait()
+    progress.canceled.disconnect(worker.cancel)
+    progress.close()
+
+    if worker.error:
+        raise worker.error
+    return worker.result
 
 
 # ===========================================================
@@ -25,13 +25,13 @@ from pickle import load
 from typeloader2 import general, typeloader_functions as typeloader
 
 try:
-    from .typeloader_core import errors
+    from .typeloader_core import errors, jobs, staging
 except ImportError:
-    from typeloader2.typeloader_core import errors
+    from typeloader2.typeloader_core import errors, jobs, staging
 
 from typeloader2.GUI_forms import (CollapsibleDialog, ChoiceSection, ChoiceButton, ChoiceTableWidget,
                        FileButton, ProceedButton, QueryButton, NewProjectButton,
-                       check_project_open)
+                       check_project_open, run_task)
 from typeloader2.GUI_misc import settings_ok
 
 
@@ -259,6 +259,8 @@ class NewAlleleForm(CollapsibleDialog):
         self.sample_id_ext = sample_ID_ext
         self.homozygous = False
         self.unsaved_changes = False
+        self.success_parsing = False
+        self.incomplete_accepted = False  # user agreed to annotate an incomplete sequence
         self.upload_btn.check_ready()
 
         self.dialog = None
@@ -341,9 +343,25 @@ class NewAlleleForm(CollapsibleDialog):
         self.header_data["collection_date"] = sample_date
 
     @pyqtSlot(int)
+    def drop_staged_files(self):
+        """drops the in-memory temp files of the current upload (see staging.py)
+        """
+        if staging.is_enabled(self.settings):
+            staging.pop_dir(self.settings["temp_dir"])
+
+    def closeEvent(self, event):
+        self.drop_staged_files()
+        super().closeEvent(event)
+
+    def reject(self):  # closed via Esc
+        self.drop_staged_files()
+        super().reject()
+
     def upload_file(self, _=None):
         """uploads & parses chosen file
         """
+        self.success_parsing = False
+        self.incomplete_accepted = False
         try:
             self.project = self.proj_widget.field.text().strip()
             self.upload_btn.setChecked(True)
@@ -363,10 +381,9 @@ class NewAlleleForm(CollapsibleDialog):
 
             # upload file to temp dir & parse it:
             self.log.debug("Uploading '{}' to temp dir...".format(os.path.basename(raw_path)))
-            success, results = typeloader.handle_new_allele_parsing(self.project, None, None,
-                                                                    raw_path, None, self.settings,
-                                                                    self.log,
-                                                                    self.restricted_db_path)
+            success, results = run_task(self, self.log, "Uploading file", typeloader.handle_new_allele_parsing,
+                                        self.project, None, None, raw_path, None, self.settings,
+                                        self.log, self.restricted_db_path, on_cancel=self.drop_staged_files)
             if not success:
                 msg = results
                 self.log.warning("Could not upload new allele")
@@ -404,49 +421,45 @@ class NewAlleleForm(CollapsibleDialog):
 
             # process file & create Allele objects:
             self.header_data["sample_id_int"] = self.sample_name
-            results = typeloader.process_sequence_file(self.project, self.filetype,
-                                                       self.blastXmlFile, self.targetFamily,
-                                                       self.fasta_filename, self.allelesFilename,
-                                                       self.header_data, self.settings, self.log,
-                                                       startover=self.startover)
+            results = run_task(self, self.log, "Annotating file", typeloader.process_sequence_file,
+                               self.project, self.filetype,
+                               self.blastXmlFile, self.targetFamily,
+                               self.fasta_filename, self.allelesFilename,
+                               self.header_data, self.settings, self.log,
+                               startover=self.startover, on_cancel=self.drop_staged_files)
             if not results[0]:  # something went wrong
                 if results[1] == "Incomplete sequence":
                     reply = QMessageBox.question(self, results[1], results[2], QMessageBox.Yes |
                                                  QMessageBox.No, QMessageBox.No)
                     if reply == QMessageBox.Yes:
-                        results = typeloader.process_sequence_file(self.project, self.filetype,
-                                                                   self.blastXmlFile,
-                                                                   self.targetFamily,
-                                                                   self.fasta_filename,
-                                                                   self.allelesFilename,
-                                                                   self.header_data,
-                                                                   self.settings,
-                                                                   self.log, incomplete_ok=True,
-                                                                   startover=self.startover)
+                        self.incomplete_accepted = True
+                        results = run_task(self, self.log, "Annotating file", typeloader.process_sequence_file,
+                                           self.project, self.filetype,
+                                           self.blastXmlFile,
+                                           self.targetFamily,
+                                           self.fasta_filename,
+                                           self.allelesFilename,
+                                           self.header_data,
+                                           self.settings,
+                                           self.log, incomplete_ok=True,
+                                           startover=self.startover, on_cancel=self.drop_staged_files)
                         if not results[0]:
                             QMessageBox.warning(self, results[1], results[2])
                             return
                     else:
                         return
                 elif results[1] in ["Allele too divergent", "Too many possible alignments"]:
-                    if self.restricted_db_path:
+                    if self.restricted_db_path:  # the alleles chosen by hand did not work either
                         msg = "The file you're trying to upload could still not be handled "
-                        msg += "with the given allele(s) as reference.\n\n"
-                        msg += "Do you want to try again?"
-                        reply = QMessageBox.question(self, "Allele still too divergent", msg,
-                                                     QMessageBox.Yes | QMessageBox.No,
-                                                     QMessageBox.No)
-                        if reply == QMessageBox.No:
-                            QMessageBox.information(self, "Allele too divergent",
-                                                    results[2])
+                        msg += "with the given allele(s) as reference.\n\n" + results[2]
+                        QMessageBox.information(self, "Allele still too divergent", msg)
+                        self.restricted_db_path = None
+                        self.chosen_alleles = None
+                        if self.dialog:
                             self.dialog.close()
-                            return
-                        else:
-                            self.restricted_db_path = None
-                            self.chosen_alleles = None
-                            if self.dialog:
-                                self.dialog.close()
+                        return
 
+                    # none of the closest allele candidates could be aligned: last resort is a manual choice
                     self.dialog = ChooseReferenceAllelesDialog(self.log, self.settings,
                                                                self.filetype, self)
                     self.dialog.restricted_db_path.connect(self.catch_restricted_db_path)
@@ -479,6 +492,7 @@ class NewAlleleForm(CollapsibleDialog):
                     self.myallele = self.myalleles[0]
                     self.ENA_widget.setText(self.ENA_text)
                     self.name_lbl.setText(self.myallele.newAlleleName)
+                    self.fill_candidates()
                     self.upload_btn.setEnabled(True)
                     self.upload_btn.setChecked(False)
                     for warning in self.myalleles[0].warnings:
@@ -486,10 +500,17 @@ class NewAlleleForm(CollapsibleDialog):
                     self.proceed_sections(0, 2)
             else:
                 QMessageBox.warning(self, results[1], results[2])
+        except jobs.JobCancelled:
+            self.log.info("Upload cancelled")
+            self.upload_btn.setChecked(False)
+            self.upload_btn.setEnabled(True)
         except Exception as E:
             self.log.error(E)
             self.log.exception(E)
             self.close()
+        finally:
+            if not self.success_parsing:  # a failed upload is started over from the raw file
+                self.drop_staged_files()
 
     @pyqtSlot(str)
     def catch_restricted_db_path(self, restricted_db_path):
@@ -693,8 +714,9 @@ class NewAlleleForm(CollapsibleDialog):
                 self.myallele.local_name = self.startover["local_name"]
             typeloader.remove_other_allele(self.blastXmlFile, self.fasta_filename, other_allele_name, self.log)
             try:
-                self.ENA_text = typeloader.make_ENA_file(self.blastXmlFile, self.targetFamily, self.myallele,
-                                                         self.settings, self.log)
+                self.ENA_text = run_task(self, self.log, "Creating EMBL file", typeloader.make_ENA_file,
+                                         self.blastXmlFile, self.targetFamily, self.myallele,
+                                         self.settings, self.log)
             except errors.IncompleteSequenceWarning as E:
                 if self.incomplete_ok and self.testing:
                     proceed = True
@@ -705,9 +727,14 @@ class NewAlleleForm(CollapsibleDialog):
                     if reply == QMessageBox.Yes:
                         proceed = True
                 if proceed:
+                    self.incomplete_accepted = True
                     try:
-                        self.ENA_text = typeloader.make_ENA_file(self.blastXmlFile, self.targetFamily, self.myallele,
-                                                                 self.settings, self.log, incomplete_ok=True)
+                        self.ENA_text = run_task(self, self.log, "Creating EMBL file", typeloader.make_ENA_file,
+                                                 self.blastXmlFile, self.targetFamily, self.myallele,
+                                                 self.settings, self.log, incomplete_ok=True)
+                    except jobs.JobCancelled:
+                        self.log.info("EMBL file creation cancelled")
+                        return
                     except errors.MissingUTRError as E:
                         QMessageBox.warning(self, "Missing UTR", E.msg)
                         return
@@ -719,6 +746,9 @@ class NewAlleleForm(CollapsibleDialog):
                 else:
                     return
 
+            except jobs.JobCancelled:
+                self.log.info("EMBL file creation cancelled")
+                return
             except errors.MissingUTRError as E:
                 QMessageBox.warning(self, "Missing UTR", E.msg)
                 return
@@ -730,6 +760,7 @@ class NewAlleleForm(CollapsibleDialog):
 
             self.ENA_widget.setText(self.ENA_text)
             self.name_lbl.setText(self.myallele.newAlleleName)
+            self.fill_candidates()
             for warning in self.myalleles[0].warnings:
                 QMessageBox.warning(self, "Potential problem with annotating this allele", warning)
             self.proceed_sections(1, 2)
@@ -751,6 +782,16 @@ class NewAlleleForm(CollapsibleDialog):
         self.name_lbl.setStyleSheet(general.label_style_2nd)
         layout.addWidget(self.name_lbl, 0, 0)
 
+        self.candidate_lbl = QLabel("Closest allele:")
+        layout.addWidget(self.candidate_lbl, 0, 1)
+        self.candidate_box = QComboBox(self)
+        self.candidate_box.setToolTip("The best BLAST hits, ranked by their number of differences to this allele. "
+                                      "Choose another one to annotate this allele against it.")
+        layout.addWidget(self.candidate_box, 0, 2, 1, 2)
+        self.candidate_box.activated.connect(self.choose_closest_allele)
+        self.candidate_lbl.hide()
+        self.candidate_box.hide()
+
         self.ENA_widget = QTextEdit(self)
         self.ENA_widget.textChanged.connect(self.on_text_changed)
         layout.addWidget(self.ENA_widget, 1, 0, 1, 6)
@@ -773,6 +814,79 @@ class NewAlleleForm(CollapsibleDialog):
 
         self.sections.append(("(3) Check ENA file and save allele:", mywidget))
 
+    def fill_candidates(self):
+        """shows the closest allele candidates of the current allele (if more than one was evaluated),
+        so another one can be chosen without a restricted reference
+        """
+        candidates = self.myallele.closest_allele_candidates
+        self.candidate_box.clear()
+        for (name, differences, error) in candidates:
+            if error:
+                self.candidate_box.addItem(f"{name} (failed: {error.splitlines()[0]})", name)
+                self.candidate_box.model().item(self.candidate_box.count() - 1).setEnabled(False)
+            else:
+                self.candidate_box.addItem(f"{name} ({differences} differences)", name)
+            if name == self.myallele.closest_allele_name:
+                self.candidate_box.setCurrentIndex(self.candidate_box.count() - 1)
+        self.candidate_lbl.setVisible(len(candidates) > 1)
+        self.candidate_box.setVisible(len(candidates) > 1)
+
+    @pyqtSlot(int)
+    def choose_closest_allele(self, index):
+        """annotates the allele against the closest allele candidate chosen in candidate_box
+        """
+        name = self.candidate_box.itemData(index)
+        if name == self.myallele.closest_allele_name:
+            return
+        if self.unsaved_changes:
+            reply = QMessageBox.question(self, "Unsaved changes",
+                                         "Annotating against another closest allele discards your changes "
+                                         "to the ENA file. Proceed?", QMessageBox.Yes | QMessageBox.No,
+                                         QMessageBox.No)
+            if reply == QMessageBox.No:
+                self.fill_candidates()
+                return
+        self.log.info(f"Choosing {name} as closest allele...")
+        try:
+            if self.filetype == "XML":
+                self.myallele.productName_FT = self.myallele.productName_DE  # make_ENA_file adds null allele tag
+                self.myallele.warnings = []
+                ENA_text = run_task(self, self.log, "Creating EMBL file", typeloader.make_ENA_file,
+                                    self.blastXmlFile, self.targetFamily, self.myallele, self.settings, self.log,
+                                    incomplete_ok=self.incomplete_accepted, closest_allele=name)
+            else:
+                results = run_task(self, self.log, "Annotating file", typeloader.process_sequence_file,
+                                   self.project, self.filetype, self.blastXmlFile, self.targetFamily,
+                                   self.fasta_filename, self.allelesFilename, self.header_data, self.settings,
+                                   self.log, incomplete_ok=self.incomplete_accepted, startover=self.startover,
+                                   closest_allele=name)
+                if not results[0]:
+                    QMessageBox.warning(self, results[1], results[2])
+                    self.fill_candidates()
+                    return
+                (_, self.myalleles, ENA_text) = results
+                self.myallele = self.myalleles[0]
+        except jobs.JobCancelled:
+            self.log.info("Choice of closest allele cancelled")
+            self.fill_candidates()
+            return
+        except Exception as E:
+            self.log.error(E)
+            self.log.exception(E)
+            QMessageBox.warning(self, "Error during ENA file creation", repr(E))
+            self.fill_candidates()
+            return
+
+        self.ENA_text = ENA_text
+        self.ENA_widget.setText(self.ENA_text)
+        self.unsaved_changes = False
+        self.discard_btn.change_to_normal()
+        self.save_changes_btn.change_to_normal()
+        self.name_lbl.setText(self.myallele.newAlleleName)
+        self.fill_candidates()
+        for warning in self.myallele.warnings:
+            QMessageBox.warning(self, "Potential problem with annotating this allele", warning)
+
     @pyqtSlot()
     def on_text_changed(self):
         """handle text edits in ENA text window
@@ -948,7 +1062,8 @@ class ChooseReferenceAllelesDialog(CollapsibleDialog):
         layout = QVBoxLayout()
         mywidget.setLayout(layout)
 
-        intro_txt1 = "TypeLoader cannot find a suitable reference gene in the reference database.\n"
+        intro_txt1 = "TypeLoader cannot find a suitable reference gene in the reference database:\n"
+        intro_txt1 += "none of the best BLAST hits (see Settings => Closest allele candidates) could be aligned.\n"
         intro_txt1 += "This may be because this allele is too dissimilar to all known "
         intro_txt1 += "reference alleles."
         intro_txt2 = "Do you know the correct reference alleles for the alleles contained in this "
@@ -1125,28 +1240,22 @@ class ChooseReferenceAllelesDialog(CollapsibleDialog):
 
         # create restricted db:
         from typeloader2.typeloader_core import update_reference
-        self.log.debug("Deleting old restricted database, if necessary...")
-        for (dirpath, subdirs, files) in os.walk(os.path.join(self.settings["temp_dir"],
-                                                              "restricted_db")):
-            for f in files:
-                myfile = os.path.join(dirpath, f)
-                os.remove(myfile)
-
-        self.log.debug("Creating restricted database...")
+        self.log.debug("Getting restricted database...")
         ref_path_official = os.path.join(self.settings["root_path"], self.settings["general_dir"],
                                          self.settings["reference_dir"])
-        restricted_db_dir = os.path.join(self.settings["temp_dir"], "restricted_db")
+        cache_dir = os.path.join(self.settings["temp_dir"], "restricted_db")
         blast_path = os.path.dirname(self.settings["blast_path"])
-        success, msg = update_reference.make_restricted_db(self.target_family,
-                                                           ref_path_official,
-                                                           self.chosen_alleles,
-                                                           restricted_db_dir,
-                                                           blast_path,
-                                                           self.log)
+        success, restricted_db_dir = update_reference.get_restricted_db(self.target_family,
+                                                                        ref_path_official,
+                                                                        self.chosen_alleles,
+                                                                        cache_dir,
+                                                                        blast_path,
+                                                                        self.log)
         if not success:
             QMessageBox.warning(self, "Error while creating restricted db",
-                                "Could not create the restricted reference database\n\n" + msg)
+                                "Could not create the restricted reference database\n\n" + restricted_db_dir)
             self.abort()
+            return
 
         self.log.debug(f"Successfully created restricted db under {restricted_db_dir}")
         self.restricted_db_path.emit(restricted_db_dir)
@@ -22,7 +22,7 @@ from PyQt5.QtGui import QIcon
 from typeloader2 import general, typeloader_functions as typeloader, db_internal
 
 from typeloader2.GUI_forms import (CollapsibleDialog, ChoiceSection,
-                       FileButton, ProceedButton, QueryButton, NewProjectButton, check_project_open)
+                       FileButton, ProceedButton, QueryButton, NewProjectButton, check_project_open, run_task)
 from typeloader2.GUI_misc import settings_ok
 
 #===========================================================
@@ -165,8 +165,8 @@ class NewAlleleBulkForm(CollapsibleDialog):
                 return False
 
         try:
-            report, self.errors_found, _ = typeloader.bulk_upload_new_alleles(self.csv_file, self.project,
-                                                                           self.settings, self.mydb, self.log)
+            report, self.errors_found, _ = run_task(self, self.log, "Bulk upload", typeloader.bulk_upload_new_alleles,
+                                                    self.csv_file, self.project, self.settings, self.mydb, self.log)
             self.report_txt.setText(report)
             self.upload_btn.setChecked(False)
         except Exception as E:
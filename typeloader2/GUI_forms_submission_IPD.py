@@ -23,7 +23,7 @@ from PyQt5.QtWidgets import (QApplication, QFileDialog, QGridLayout,
 from PyQt5.Qt import pyqtSlot, pyqtSignal
 from PyQt5.QtGui import QIcon
 
-from typeloader2 import general, db_internal
+from typeloader2 import general, db_internal, typeloader_functions as typeloader
 from typeloader2.typeloader_core import make_imgt_files as MIF, ena_accession_retrieval as EAR
 from typeloader2.GUI_forms import (CollapsibleDialog, ChoiceSection, FileChoiceTable,
                                    FileButton, ProceedButton, QueryButton, check_project_open)
@@ -829,7 +829,8 @@ class IPDSubmissionForm(CollapsibleDialog):
         return True
 
     def get_files(self):
-        """retrieves ena_file and blast_xml for each chosen sample
+        """retrieves ena_file and blast_xml for each chosen sample,
+        and the reference version the allele was annotated with
         """
         self.file_dic = {}
         for (sample_id_int, local_name, _) in self.samples:
@@ -842,6 +843,13 @@ class IPDSubmissionForm(CollapsibleDialog):
                 self.file_dic[local_name]["blast_xml"] = data[0][0]
                 self.file_dic[local_name]["ena_file"] = data[0][1]
 
+            query = """select database_version from alleles 
+            where sample_id_int = '{}' and local_name = '{}'""".format(sample_id_int, local_name)
+            success, data = db_internal.execute_query(query, 1, self.log,
+                                                      "retrieving reference version", "Database error", self)
+            if success and data:
+                self.file_dic[local_name]["db_version"] = data[0][0]
+
     @pyqtSlot(dict)
     def catch_cell_line(self, old_cell_lines):
         """catches mapping between cell_line_old and loca_name
@@ -1028,57 +1036,13 @@ class IPDSubmissionForm(CollapsibleDialog):
         if self.submission_successful:
             try:
                 self.log.info("Saving changes to db...")
-                update_queries = []
-                for (sample, local_name, _) in self.samples:
-                    # update allele_status for individual alleles:
-                    IPD_submission_nr = self.cell_lines[local_name]
-                    update_query = """update alleles set allele_status = 'IPD submitted',
-                        ENA_accession_nr = '{}', ENA_acception_date = '{}',
-                        IPD_SUBMISSION_ID = '{}', IPD_SUBMISSION_NR = '{}' 
-                        where local_name = '{}'""".format(self.ENA_id_map[local_name], self.ENA_timestamp,
-                                                          self.subm_id, IPD_submission_nr, local_name)
-                    update_queries.append(update_query)
-
-                    # update files table:
-                    subm_file = self.imgt_files[IPD_submission_nr]
-                    update_files_query = """update files set IPD_submission_file = '{}' where local_name = '{}'
-                    """.format(subm_file, local_name)
-                    update_queries.append(update_files_query)
-
-                    # update samples table with customer:
-                    update_samples_query = """update samples set customer = '{}' where sample_id_int = '{}'
-                    """.format(self.customer_dic[sample], sample)
-                    update_queries.append(update_samples_query)
-
-                    # copy file to sample folder:
-                    src_path = os.path.join(os.path.dirname(self.IPD_file), subm_file)
-                    dest_dir = os.path.join(self.settings["projects_dir"], self.project, sample)
-                    if not os.path.isdir(dest_dir):
-                        self.log.warning("Sample folder {} does not exist! Creating...".format(dest_dir))
-                        QMessageBox.warning(self, "Sample path unknown", """Sample directory '{}' does not exist (but it should)!
-                        I'm creating it, but please notify your admin!""".format(dest_dir))
-                        os.makedirs(dest_dir)
-                    dest_path = os.path.join(dest_dir, subm_file)
-                    self.log.debug("Copying IPD file to {}...".format(dest_path))
-                    try:
-                        shutil.copy(src_path, dest_path)
-                    except Exception as E:
-                        self.log.warning("Could not copy file {} to {}".format(subm_file, dest_dir))
-                        self.log.exception(E)
-                        QMessageBox.warning(self, "File copy error",
-                                            "Could not copy file '{}' to its sample-folder '{}'!".format(
-                                                os.path.basename(subm_file), dest_dir))
-
-                # update IPD_submissions table:
-                today = time.strftime("%Y-%m-%d")
-                query2 = """insert into IPD_submissions 
-                (SUBMISSION_ID, NR_ALLELES, TIMESTAMP_SENT, SUCCESS) values
-                ('{}', {}, '{}', 'yes')""".format(self.subm_id, len(self.cell_lines), today)
-                update_queries.append(query2)
-
-                success = db_internal.execute_transaction(update_queries, self.mydb, self.log,
-                                                          "trying to save this submission to the database",
-                                                          "Database error", self)
+                success, problems = typeloader.save_IPD_submission_to_db(self.project, self.subm_id, self.samples,
+                                                                         self.IPD_file, self.cell_lines,
+                                                                         self.customer_dic, self.imgt_files,
+                                                                         self.ENA_id_map, self.ENA_timestamp,
+                                                                         self.settings, self.mydb, self.log, self)
+                for (title, msg) in problems:
+                    QMessageBox.warning(self, title, msg)
                 if success:
                     self.IPD_submitted.emit()
                     self.log.info("=> Database updated successfully")
@@ -23,16 +23,15 @@ from PyQt5.QtGui import QIcon
 
 from typeloader2 import general, db_internal
 from typeloader2.authuser import user
-from typeloader2.typeloader_functions import perform_reference_update, update_curr_versions
-from typeloader2.typeloader_core import update_reference
+from typeloader2.typeloader_functions import (perform_reference_updates, update_curr_versions, get_basic_cf,
+                                             get_raw_settings, get_settings, base_config_file, user_config_file)
+from typeloader2.typeloader_core import update_reference, timing
 from typeloader2.GUI_forms import ProceedButton
 
 # ===========================================================
 # parameters:
-base_config_file = "config_base.ini"
 raw_config_file = "config_raw.ini"
 company_config_file = "config_company.ini"
-user_config_file = "config.ini"
 local_patchme_file = os.path.join("_general", "additional.ini")
 
 __version__ = general.read_package_variable("__version__")
@@ -462,79 +461,6 @@ def make_new_settings(root_path, user, user_name, short_name, email, address,
     return user_ini
 
 
-def get_basic_cf(log=None):
-    """extracts data from base_config.ini
-    """
-    if log:
-        log.info("Loading base config from {}...".format(os.path.abspath(base_config_file)))
-    cf = ConfigParser()
-    cf.read(base_config_file)
-    return cf
-
-
-def get_raw_settings(user, log, cf=None):
-    """reads settings from user's config_file
-    """
-    if not cf:
-        cf = get_basic_cf(log)
-    myos = platform.system()
-    if user == "staging":
-        if myos == "Windows":
-            root_path = cf.get("Paths", "staging_path_windows")
-            ini_file = "config_win.ini"
-        else:
-            root_path = cf.get("Paths", "staging_path_linux")
-            ini_file = "config_linux.ini"
-    else:
-        root_path = cf.get("Paths", "root_path")
-        ini_file = user_config_file
-    user_cf_file = os.path.join(root_path, user, ini_file)
-    cf.read(user_cf_file)
-    return cf, user_cf_file, myos
-
-
-def get_settings(user, log, cf=None):
-    """translates user's read config file into settings_dic 
-    """
-    log.info("Loading user settings...")
-    cf, user_cf_file, myos = get_raw_settings(user, log, cf)
-    log.debug(f"User settings file: {user_cf_file}")
-
-    if not os.path.isfile(user_cf_file):
-        log.error("\tUser settings file {} not found!".format(user_cf_file))
-        return None
-
-    settings_dic = {"user_cf": user_cf_file,  # user's config file
-                    "os": myos  # current operating system
-                    }
-    for section in cf.sections():
-        for (key, value) in cf.items(section):
-            settings_dic[key] = value.strip()
-    if settings_dic["modus"] in ["testing", "debugging"]:
-        settings_dic["embl_submission"] = settings_dic["embl_submission_test"]
-    for key in ["ipd_shortname", "cell_line_token"]:  # if these were not set during install
-        if not key in settings_dic:
-            settings_dic[key] = ""
-        elif settings_dic[key] == "a short acronym of your company; use only letters or hyphens!":
-            settings_dic[key] = ""
-    settings_dic["TL_version"] = __version__
-    settings_dic["running_modus"] = "normal"
-
-    if "timeout_ena" not in settings_dic:
-        settings_dic["timeout_ena"] = "300"
-        cf.set("Pref", "timeout_ena", "300")
-        with open(user_cf_file, "w") as g:
-            cf.write(g)
-
-    settings_dic["reference_local_path"] = os.path.join(settings_dic["root_path"],
-                                                        settings_dic["general_dir"],
-                                                        settings_dic["reference_dir"])
-    update_curr_versions(settings_dic, log)
-
-    log.info("\t=>Success")
-    return settings_dic
-
-
 def create_user_space(root_path, user, user_name, short_name, email, address, log):
     """creates folders and empty db for new user
     """
@@ -573,6 +499,10 @@ def start_logfile(log, settings_dic, curr_time):
     log.addHandler(file_handler)
     log.info("<Starting logfile>")
     log.info("Typeloader V{} started by user {}".format(__version__, settings_dic["login"]))
+    if settings_dic["stage_timing"] == "yes":
+        timing_file = timing.get_timing_filename(logfile)
+        log.info(f"Writing the duration of the pipeline stages to {timing_file}")
+        timing.enable(timing_file)
 
 
 def dump_db(curr_time, settings_dic, log):
@@ -584,7 +514,7 @@ def dump_db(curr_time, settings_dic, log):
     shutil.copy(db_file, db_file_temp)
 
 
-def handle_reference_update(update_me, reference_local_path, blast_path, parent, settings, log):
+def handle_reference_update(update_me, reference_local_path, blast_path, parent, settings, log, concurrent=True):
     """performs the reference update for all references given in upate_me, passes results to user as QMessageBox
 
     :param update_me: list of references to update (can contain "HLA", "KIR" or both)
@@ -592,13 +522,14 @@ def handle_reference_update(update_me, reference_local_path, blast_path, parent,
     :param blast_path: path for blastn
     :param log: logger instance
     :param parent: parent which should raise the resulting QMessageBox
+    :param concurrent: if True, update all references at the same time (in separate processes)
     :return: list of successfully updated references
     """
     msges = []
     updated = []
-    for db_name in update_me:
-        success, err_type, msg = perform_reference_update(db_name, reference_local_path, blast_path,
-                                                          settings["proxy"], log)
+    results = perform_reference_updates(update_me, reference_local_path, blast_path, settings["proxy"], log,
+                                        concurrent=concurrent)
+    for db_name, (success, err_type, msg) in results.items():
         if not success:
             if parent:
                 QMessageBox.warning(parent, err_type, msg)
@@ -246,6 +246,21 @@ class SettingTab(QTabWidget):
                       "timeout_ena": {"section": "Pref",
                                       "lbl_text": "ENA timeout after x seconds",
                                       "hint": "When submitting files to ENA, abort after this many seconds of no response from ENA."},
+                      "search_engine": {"section": "Pref",
+                                        "lbl_text": "Closest allele search",
+                                        "hint": "'blast' searches the closest known allele of new sequences with BLAST, 'kmer' uses TypeLoader's own k-mer index of the reference (no BLAST needed)."},
+                      "blast_output": {"section": "Pref",
+                                       "lbl_text": "BLAST output format",
+                                       "hint": "'xml' stores BLAST results as .blast.xml files, 'tabular' as much smaller .blast.tsv files. Both formats can always be read."},
+                      "closest_allele_candidates": {"section": "Pref",
+                                                    "lbl_text": "Closest allele candidates",
+                                                    "hint": "How many of the best BLAST hits are compared to find the closest allele of a new sequence. With 1, the best BLAST hit is used."},
+                      "stage_timing": {"section": "Pref",
+                                       "lbl_text": "Time upload stages",
+                                       "hint": "If 'yes', TypeLoader records how long each stage of uploading new alleles takes, in a .jsonl file next to the log file of the session (takes effect at the next login). Bulk upload reports then end with a summary."},
+                      "temp_files": {"section": "Pref",
+                                     "lbl_text": "Temporary upload files",
+                                     "hint": "'disk' writes the temporary files of new alleles (copy of the raw file, fasta, BLAST output) to the temp directory, 'memory' keeps them in memory until the allele is saved. Use 'memory' if your root path is on a slow network share."},
                       "fav_provenances": {"section": "Pref",
                                           "lbl_text": "Preferred Provenances",
                                           "hint": "These 'provenance' options will be listed above the rest. Must be separated by |, no whitespaces!"},
@@ -320,6 +335,10 @@ class SettingTab(QTabWidget):
                                                     "cDNA amplification, cloning and sequencing", "Genomic Clones",
                                                     "Cosmids", "YAC Cloning and sequencing", "Protein Biochemistry",
                                                     "No Secondary methods used"],
+                           "search_engine": ["blast", "kmer"],
+                           "blast_output": ["xml", "tabular"],
+                           "stage_timing": ["no", "yes"],
+                           "temp_files": ["disk", "memory"],
                            "type_of_primer": ["Locus specific", "Allele specific", "Generic Specific",
                                               "Both allele and locus specific", "Both allele and generic specific",
                                               "Both locus and generic specific", "None used"]}
@@ -441,6 +460,24 @@ class UserSettingsDialog(QDialog):
                                     "The ENA timeout threshold must be a number of seconds!")
                 return False
 
+        if field == "search_engine":
+            if value not in ["blast", "kmer"]:
+                QMessageBox.warning(self, "Closest allele search rejected",
+                                    "Please choose either 'blast' or 'kmer' for the closest allele search!")
+                return False
+
+        if field == "blast_output":
+            if value not in ["xml", "tabular"]:
+                QMessageBox.warning(self, "BLAST output format rejected",
+                                    "Please choose either 'xml' or 'tabular' as BLAST output format!")
+                return False
+
+        if field == "closest_allele_candidates":
+            if not value.isdigit() or not 1 <= int(value) <= 10:
+                QMessageBox.warning(self, "Closest allele candidates rejected",
+                                    "The number of closest allele candidates must be a number between 1 and 10!")
+                return False
+
         if field == "fav_provenances":
             values = value.split("|")
             ok, msg, _ = typeloader_functions.check_countries_ok(values, self.settings, self.log)
@@ -38,5 +38,6 @@ __all__ = ["__init__",
            "GUI_views_settings",
            "patches",
            "setup",
+           "typeloader_cli",
            "typeloader_functions",
            ]
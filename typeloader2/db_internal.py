@@ -17,8 +17,7 @@ import sys, os, csv
 import sqlite3
 from typeloader2 import general
 
-from PyQt5.QtWidgets import QMessageBox
-from PyQt5.QtSql import QSqlQuery
+# PyQt5 is imported where needed, so this module can be used without Qt (see typeloader_cli.py)
 
 # ===========================================================
 # parameters:
@@ -105,10 +104,94 @@ alleles_header_dic = {
 # ===========================================================
 # classes:
 
+class SqliteDatabase:
+    """connection to the internal database via plain sqlite3, for use without Qt (see typeloader_cli.py);
+    offers the part of QSqlDatabase's interface used by TypeLoader (transaction, commit, rollback, open, close)
+    """
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.conn = None
+
+    def open(self):
+        if not self.conn:
+            self.conn = sqlite3.connect(self.db_file, isolation_level=None)  # autocommit, like QSqlQuery
+        return True
+
+    def isOpen(self):
+        return self.conn is not None
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+    def transaction(self):
+        self.conn.execute("BEGIN")
+        return True
+
+    def commit(self):
+        self.conn.execute("COMMIT")
+        return True
+
+    def rollback(self):
+        self.conn.execute("ROLLBACK")
+        return True
+
+    def execute(self, query, num_columns, log, task):
+        """executes a query, returns (error message or False, data as list of lists)
+        """
+        try:
+            cursor = self.conn.execute(query)
+        except sqlite3.Error as E:
+            msg = "An error occurred while {}:".format(task)
+            log.error(msg)
+            log.error('FAILED QUERY: "{}"'.format(query))
+            return msg + "\n\n{}".format(E), []
+        data = [list(row[:num_columns]) for row in cursor.fetchall()]
+        cursor.close()
+        return False, data
+
+
+_sqlite_db = None  # SqliteDatabase used by execute_query instead of Qt's default connection, if set
+
 
 # ===========================================================
 # functions:
 
+def create_sqlite_connection(db_file, log):
+    """opens a SqliteDatabase and uses it instead of Qt's default connection from now on;
+    returns it (to be used as mydb) or False if the database cannot be opened
+    """
+    global _sqlite_db
+    log.debug("Creating sqlite3 db connection...")
+    if not os.path.isfile(db_file):
+        log.error("Cannot establish a database connection to {}: file not found!".format(db_file))
+        return False
+    mydb = SqliteDatabase(db_file)
+    try:
+        mydb.open()
+    except sqlite3.Error as E:
+        log.exception(E)
+        log.error("Cannot establish a database connection to {}!".format(db_file))
+        return False
+    _sqlite_db = mydb
+    log.debug("\t=> Connection open")
+    return mydb
+
+
+def close_sqlite_connection(log, mydb):
+    """closes a SqliteDatabase opened by create_sqlite_connection
+    """
+    global _sqlite_db
+    log.debug("Closing connection to db...")
+    if mydb:
+        mydb.close()
+    if _sqlite_db is mydb:
+        _sqlite_db = None
+    log.debug("\t=> Connection closed")
+
+
 def open_connection(db_file, log):
     """opens connection to a .db file
     """
@@ -155,12 +238,22 @@ def execute_query(query, num_columns, log, task, err_type="Database Error", pare
     log.debug("\tExecuting query {}[...]...".format(query.split("\n")[0][:100]))
     data = []
     success = False
+    if _sqlite_db:
+        err_msg, data = _sqlite_db.execute(query, num_columns, log, task)
+        if err_msg:
+            return success, err_msg
+        if data:
+            log.debug("\t=> {} records found!".format(len(data)))
+        return True, data
+
+    from PyQt5.QtSql import QSqlQuery
     q = QSqlQuery()
     q.exec_(query)
 
     err_msg = error_in_query(q, task, log)
     if err_msg:
         if parent:
+            from PyQt5.QtWidgets import QMessageBox
             QMessageBox.warning(parent, err_type, err_msg)
         data = err_msg
         return success, data
@@ -195,6 +288,19 @@ def execute_transaction(queries, mydb, log, task, err_type="Database Error", par
     log.debug("\tStarting transaction...")
     success = False
 
+    if isinstance(mydb, SqliteDatabase):
+        mydb.transaction()
+        for (i, query) in enumerate(queries):
+            log.debug("\t\tQuery #{}: '{}[...]...'".format(i + 1, query.split("\n")[0][:50]))
+            err_msg, _ = mydb.execute(query, 0, log, task)
+            if err_msg:
+                mydb.rollback()
+                return success
+        mydb.commit()
+        log.debug("\t=> transaction successful")
+        return True
+
+    from PyQt5.QtSql import QSqlQuery
     mydb.transaction()
     q = QSqlQuery()
     i = 0
@@ -205,6 +311,7 @@ def execute_transaction(queries, mydb, log, task, err_type="Database Error", par
         err_msg = error_in_query(q, task, log)
         if err_msg:
             if parent:
+                from PyQt5.QtWidgets import QMessageBox
                 QMessageBox.warning(parent, err_type, err_msg)
             mydb.rollback()
             return success
@@ -14,8 +14,8 @@ contains general functions
 # import modules:
 import sys, os, datetime, shutil, platform
 from collections import defaultdict
-from PyQt5.QtGui import QFont
 from typeloader2 import GUI_stylesheet as stylesheet
+from typeloader2.typeloader_core import staging
 import pathlib
 
 # ===========================================================
@@ -48,9 +48,6 @@ line_style_normal = "QLineEdit {default}"
 line_style_inactive = "QLineEdit {background: #F2F2F2}"  # light grey background
 line_style_changeme = "QLineEdit {background: DKMSyellow}".replace("DKMSyellow", stylesheet.color_dic["DKMSyellow"])
 
-font_bold = QFont()
-font_bold.setBold(True)
-
 # allele status:
 done = ["ipd accepted", "abandoned", "ipd released", "original result corrected"]
 pending = ["ena submitted", "ipd submitted"]
@@ -270,9 +267,14 @@ def move_rename_file(old_path, new_dir, new_name):
     """
     if old_path.endswith(".blast.xml"):
         ext = ".blast.xml"
+    elif old_path.endswith(".blast.tsv"):
+        ext = ".blast.tsv"
     else:
         ext = os.path.splitext(old_path)[-1]
     new_path = os.path.join(new_dir, new_name + ext)
+    if staging.is_staged(old_path):  # in-memory temp file, written to disk only now
+        staging.save(old_path, new_path)
+        return new_path
     try:
         shutil.move(old_path, new_path)
     except:
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+benchmark_banded_alignment.py
+
+compares the time needed to find the start of the global alignment of an incompletely aligned sequence
+(as done by closestallele.fix_incomplete_alignment):
+    - aligning the full sequences (as done before the banded alignment existed)
+    - aligning only the start of the query within a band around the HSP's diagonal
+
+The sample alleles from sample_files are used as reference;
+the queries are copies of them with changes within 3 bp of the sequence start,
+so BLAST's HSP would start only after these changes.
+
+usage: python benchmark_banded_alignment.py [repetitions]
+"""
+import os
+import sys
+import time
+import logging
+
+from typeloader2.typeloader_core import closestallele as CA, EMBLfunctions as EF
+
+SAMPLE_FILES = ["KIR2DL1_0020101.fa", "KIR2DL4_0010201.fa", "MICA_002_01.fa"]
+
+# format: (description, function turning the reference into the query, bp of query before the HSP)
+CHANGES = [("mismatch at position 2", lambda seq: seq[0] + ("A" if seq[1] != "A" else "C") + seq[2:], 2),
+           ("deletion at position 2", lambda seq: seq[0] + seq[2:], 1),
+           ("insertion at position 2", lambda seq: seq[0] + "T" + seq[1:], 2),
+           ("first 300 bp missing, mismatch at position 2",
+            lambda seq: seq[300] + ("A" if seq[301] != "A" else "C") + seq[302:], 2)]
+
+
+def make_hsp(ref_seq, query_seq, query_hsp_start):
+    """returns (hsp_start, hsp_query, hsp_subject, hsp_match) of an ungapped HSP covering the rest of the query
+    """
+    hsp_query = query_seq[query_hsp_start:]
+    ref_hsp_start = len(ref_seq) - len(hsp_query)
+    hsp_subject = ref_seq[ref_hsp_start:]
+    hsp_match = "".join("|" if q == s else " " for (q, s) in zip(hsp_query, hsp_subject))
+    return ref_hsp_start + 1, hsp_query, hsp_subject, hsp_match
+
+
+def get_alignment_start(alignments, ref_offset=0):
+    a = alignments[0]
+    return int(a.aligned[0][0][0]) + ref_offset, int(a.aligned[1][0][0])
+
+
+def benchmark(sample_dir, repetitions, log):
+    results = []
+    quiet_log = logging.getLogger("quiet")
+    quiet_log.setLevel(logging.WARNING)
+    for sample_file in SAMPLE_FILES:
+        (header, ref_seq) = list(EF.fasta_generator(os.path.join(sample_dir, sample_file)))[0]
+        allele_name = header.split()[0]
+        for (desc, change, query_hsp_start) in CHANGES:
+            query_seq = change(ref_seq)
+            (hsp_start, hsp_query, hsp_subject, hsp_match) = make_hsp(ref_seq, query_seq, query_hsp_start)
+
+            start = time.perf_counter()
+            for _ in range(repetitions):
+                full = get_alignment_start(CA.make_global_alignment(ref_seq, query_seq, quiet_log))
+            time_full = (time.perf_counter() - start) / repetitions
+
+            start = time.perf_counter()
+            for _ in range(repetitions):
+                (alignments, ref_offset) = CA.make_banded_alignment(ref_seq, query_seq, hsp_start, hsp_query,
+                                                                    hsp_subject, hsp_match, quiet_log)
+                banded = get_alignment_start(alignments, ref_offset) if alignments else None
+            time_banded = (time.perf_counter() - start) / repetitions
+
+            log.info(f"{allele_name} ({len(ref_seq)} bp), {desc}:")
+            log.info(f"\tfull alignment:   {time_full * 1e3:.1f} ms, alignment start {full}")
+            log.info(f"\tbanded alignment: {time_banded * 1e3:.1f} ms, alignment start {banded}")
+            results.append((allele_name, desc, time_full, time_banded, full == banded))
+    return results
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if len(sys.argv) > 1 and not sys.argv[1].isdigit():
+        print(__doc__)
+        sys.exit(1)
+    reps = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    mydir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sample_files")
+    benchmark(mydir, reps, logging.getLogger(__name__))
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+benchmark_bulk_blast.py
+
+compares the BLAST time of bulk uploads with 10, 100 and 500 rows:
+    - blasting each file of the upload separately (as done before BlastBatch existed)
+    - blasting all files in one run per reference database via BlastBatch
+
+The sample alleles from sample_files are used as queries; each row gets a copy with a random point mutation,
+so no query is identical to a known allele (which would skip BLAST).
+
+usage: python benchmark_bulk_blast.py <path to blastn> <path to reference_data dir> [number of rows ...]
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import logging
+import tempfile
+
+from typeloader2.typeloader_core import getAlleleSeqsAndBlast as GASB, EMBLfunctions as EF
+
+SAMPLE_FILES = ["HLA-A_01-01-01-01.fa", "KIR2DL1_0020101.fa", "KIR2DL4_0010201.fa", "MICA_002_01.fa"]
+ROWS = [10, 100, 500]
+
+
+def make_settings(blast_path, temp_dir):
+    return {"blast_path": blast_path, "temp_dir": temp_dir, "search_engine": "blast", "blast_output": "xml",
+            "gene_kir": "KIR", "gene_hla": "HLA", "parsed_kir": "parsedKIR.fa", "parsed_hla": "parsedhla.fa",
+            "kir_dat": "KIR.dat", "hla_dat": "hla.dat", "kir_version": "curr_version_KIR.txt",
+            "hla_version": "curr_version_hla.txt"}
+
+
+def make_query_files(sample_dir, n, temp_dir):
+    """writes n fasta files, each with a mutated copy of a sample allele, returns their paths
+    """
+    samples = [list(EF.fasta_generator(os.path.join(sample_dir, sample_file)))[0] for sample_file in SAMPLE_FILES]
+    random.seed(n)
+    myfiles = []
+    for i in range(n):
+        (header, seq) = samples[i % len(samples)]
+        pos = random.randrange(len(seq))
+        seq = seq[:pos] + random.choice([base for base in "ACGT" if base != seq[pos]]) + seq[pos + 1:]
+        myfile = os.path.join(temp_dir, f"row{i}.fa")
+        with open(myfile, "w") as g:
+            g.write(f">row{i} {header.split(None, 1)[-1]}\n{seq}\n")
+        myfiles.append(myfile)
+    return myfiles
+
+
+def get_database(fasta_file, settings, ref_dir, log):
+    """returns the BLAST database a file is searched in (as chosen by BlastBatch.add_files)
+    """
+    records = GASB.read_raw_records(fasta_file, log)
+    target_family = GASB.get_target_family(records[-1][0], settings)
+    (database, _, _) = GASB.get_reference_files(target_family, settings, ref_dir)
+    (_, header_data) = GASB.parse_fasta_header(records[-1][0])
+    return GASB.select_blast_db(records, header_data, database, log)
+
+
+def blast_files(myfiles, settings, ref_dir, log, batched):
+    """blasts all files like a bulk upload does, returns the needed time in seconds
+    """
+    start = time.perf_counter()
+    blast_batch = None
+    if batched:
+        blast_batch = GASB.BlastBatch(settings, log)
+        blast_batch.add_files(myfiles, ref_dir)
+    for myfile in myfiles:
+        database = get_database(myfile, settings, ref_dir, log)
+        GASB.blastSequences(myfile, database, settings, log, blast_batch=blast_batch)
+    return time.perf_counter() - start
+
+
+def benchmark(blast_path, ref_dir, rows, log):
+    sample_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sample_files")
+    results = {}
+    for n in rows:
+        for (method, batched) in [("one by one", False), ("batched", True)]:
+            temp_dir = tempfile.mkdtemp(prefix="benchmark_bulk_blast_")  # own result cache per run
+            try:
+                myfiles = make_query_files(sample_dir, n, temp_dir)
+                duration = blast_files(myfiles, make_settings(blast_path, temp_dir), ref_dir, log, batched)
+            finally:
+                shutil.rmtree(temp_dir)
+            results[(n, method)] = duration
+            log.info(f"{n} rows, {method}: {duration:.1f} s ({duration / n * 1e3:.0f} ms per row)")
+    return results
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit(1)
+    myrows = [int(n) for n in sys.argv[3:]] or ROWS
+    benchmark(sys.argv[1], sys.argv[2], myrows, logging.getLogger(__name__))
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""
+benchmark_gene_models.py
+
+compares the time per allele needed to get the gene model of the closest allele during annotation:
+    - derived from the allele's dicts (as done for every annotation before the gene model table existed)
+    - looked up in the precomputed GeneModelTable written by make_parsed_files
+
+usage: python benchmark_gene_models.py <path to hla.dat or KIR.dat> [repetitions]
+"""
+import os
+import sys
+import time
+import logging
+
+from typeloader2.typeloader_core import hla_embl_parser as HEP, coordinates as COO
+
+
+def benchmark(dat_file, repetitions, log):
+    target = os.path.splitext(os.path.basename(dat_file))[0]
+    log.info(f"Reading {dat_file}...")
+    alleles, _ = HEP.read_dat_file(dat_file, target.upper(), log)
+    gene_models = HEP.GeneModelTable()
+    for allele in alleles.values():
+        gene_models.add(allele)
+    names = list(alleles.keys())
+    n = len(names) * repetitions
+    log.info(f"Getting gene models of {len(names)} alleles {repetitions} times...")
+
+    start = time.perf_counter()
+    for _ in range(repetitions):
+        for name in names:
+            allele = alleles[name]
+            COO.getClosestAlleleCoordinates(allele, allele.length)
+    time_old = (time.perf_counter() - start) / n
+
+    start = time.perf_counter()
+    for _ in range(repetitions):
+        for name in names:
+            allele = alleles[name]
+            COO.getClosestAlleleCoordinates(allele, allele.length, gene_models.get(name))
+    time_new = (time.perf_counter() - start) / n
+
+    log.info(f"\tderived from allele: {time_old * 1e6:.1f} µs per allele")
+    log.info(f"\tlooked up in table:  {time_new * 1e6:.1f} µs per allele")
+    return time_old, time_new
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    reps = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    benchmark(sys.argv[1], reps, logging.getLogger(__name__))
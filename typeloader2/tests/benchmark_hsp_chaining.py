@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+benchmark_hsp_chaining.py
+
+counts how often parse_blast has to fall back to fix_incomplete_alignment (global re-alignment)
+for sequences with large InDels, which BLAST splits into several HSPs:
+    - using only the best HSP (as done before HSPs were chained)
+    - chaining the HSPs via closestallele.chain_HSPs
+
+The sample alleles from sample_files are used as reference; the queries are copies of them with large InDels.
+BLAST's HSPs are simulated as the maximal ungapped alignments of the unchanged parts of the query.
+
+usage: python benchmark_hsp_chaining.py
+"""
+import os
+import sys
+import time
+import logging
+
+from typeloader2.typeloader_core import closestallele as CA, EMBLfunctions as EF, blast_results as BR
+
+SAMPLE_FILES = ["HLA-A_01-01-01-01.fa", "KIR2DL1_0020101.fa", "KIR2DL4_0010201.fa", "MICA_002_01.fa"]
+
+# format: (description, [(start, end) of the reference parts the query consists of, inserted sequence after it])
+CHANGES = [("500 bp deletion", [(0, 1500, ""), (2000, None, "")]),
+           ("300 bp insertion", [(0, 1500, "ACGTTGCA" * 37 + "ACGT"), (1500, None, "")]),
+           ("2 deletions", [(0, 800, ""), (1000, 2500, ""), (2900, None, "")]),
+           ("deletion + mismatch", [(0, 1500, "A"), (2001, None, "")])]
+
+
+def make_query(ref_seq, parts):
+    """returns (query, [(query start, ref start, length) of each unchanged part])
+    """
+    (query, segments) = ("", [])
+    for (start, end, insertion) in parts:
+        end = len(ref_seq) if end is None else end
+        segments.append((len(query), start, end - start))
+        query += ref_seq[start:end] + insertion
+    return query, segments
+
+
+def make_hsps(ref_seq, query_seq, segments):
+    """returns the simulated HSPs (longest first): each unchanged part of the query, extended while bases match
+    """
+    hsps = []
+    for (q, r, length) in segments:
+        while q > 0 and r > 0 and query_seq[q - 1] == ref_seq[r - 1]:
+            (q, r, length) = (q - 1, r - 1, length + 1)
+        while q + length < len(query_seq) and r + length < len(ref_seq) \
+                and query_seq[q + length] == ref_seq[r + length]:
+            length += 1
+        hsps.append(BR.BlastHsp(query_seq[q:q + length], ref_seq[r:r + length], q + 1, q + length, r + 1, r + length,
+                                length, length, 0, length, 0))
+    hsps.sort(key=lambda hsp: hsp.align_length, reverse=True)
+    return hsps
+
+
+def needs_fallback(results, query_length):
+    (hsp_query, _, _, concatHSPS, _, hsp_align_len) = results
+    return hsp_align_len < query_length or (concatHSPS and len(hsp_query.replace("-", "")) < query_length)
+
+
+def benchmark(sample_dir, log):
+    counts = {"single HSP": 0, "chained HSPs": 0}
+    n = 0
+    for sample_file in SAMPLE_FILES:
+        (header, ref_seq) = list(EF.fasta_generator(os.path.join(sample_dir, sample_file)))[0]
+        for (desc, parts) in CHANGES:
+            (query_seq, segments) = make_query(ref_seq, parts)
+            hsps = make_hsps(ref_seq, query_seq, segments)
+            n += 1
+            for (method, chain) in [("single HSP", False), ("chained HSPs", True)]:
+                start = time.perf_counter()
+                results = CA.puzzle_HSPs_from_first_hit(hsps, ref_seq, query_seq, sample_file, chain=chain)
+                duration = time.perf_counter() - start
+                fallback = needs_fallback(results, len(query_seq))
+                counts[method] += fallback
+                if chain:  # the chained alignment must contain the complete query and the aligned part of the reference
+                    (hsp_query, hsp_subject, _, _, hsp_start, _) = results
+                    assert hsp_query.replace("-", "") == query_seq
+                    assert ref_seq[hsp_start - 1:].startswith(hsp_subject.replace("-", ""))
+                log.info(f"{header.split()[0]}, {desc}, {method}: {len(hsps)} HSPs, "
+                         f"fallback needed: {fallback} ({duration * 1e3:.2f} ms)")
+    for (method, count) in counts.items():
+        log.info(f"{method}: fallback needed for {count} of {n} sequences")
+    return counts
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if len(sys.argv) > 1:
+        print(__doc__)
+        sys.exit(1)
+    mydir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sample_files")
+    benchmark(mydir, logging.getLogger(__name__))
@@ -16,8 +16,11 @@ import os, sys, re, time, platform, datetime, csv
 import difflib  # compare strings
 import shutil
 import copy
+import threading
+import subprocess
+import json
 from pathlib import Path
-from random import randint
+from random import randint, Random
 from configparser import ConfigParser
 
 mypath_inner = Path(__file__).parent.parent
@@ -33,7 +36,9 @@ shutil.copyfile(mypath_inner / "typeloader_GUI.pyw", mypath_inner / "typeloader_
 
 from typeloader2 import typeloader_GUI
 from typeloader2.typeloader_core import errors, EMBLfunctions as EF, make_imgt_files as MIF, backend_make_ena as BME, \
-    imgt_text_generator as ITG, closestallele as CA, getAlleleSeqsAndBlast as GASB
+    imgt_text_generator as ITG, closestallele as CA, getAlleleSeqsAndBlast as GASB, reference_cache as RC, \
+    hla_embl_parser as HEP, update_reference, reference_store as RS, coordinates as COO, locus_partitions as LP, \
+    result_cache as RSC, blast_results as BR, alignment_service as AS, jobs, timing, staging, kmer_index as KI
 from typeloader2 import GUI_forms_new_project as PROJECT
 from typeloader2 import GUI_forms_new_allele as ALLELE
 from typeloader2 import GUI_forms_new_allele_bulk as BULK
@@ -285,6 +290,279 @@ class TestUpdateReference(unittest.TestCase):
         self.assertTrue("KIR" not in update_me)
 
 
+class TestReferenceCache(unittest.TestCase):
+    """test that the parsed reference is only loaded once per process
+    """
+
+    @classmethod
+    def setUpClass(self):
+        if skip_other_tests:
+            self.skipTest(self, "Skipping reference cache test because skip_other_tests is set to True")
+
+        self.target = "KIR"
+        self.reference_local_path = os.path.join(curr_settings["root_path"],
+                                                 curr_settings["general_dir"],
+                                                 curr_settings["reference_dir"])
+        RC.clear_reference_cache()
+
+    @classmethod
+    def tearDownClass(self):
+        RC.clear_reference_cache()
+
+    def test_loaded_once(self):
+        """test that repeated calls return the cached alleles
+        """
+        alleles1 = RC.get_reference_alleles(self.target, self.reference_local_path, log)
+        alleles2 = RC.get_reference_alleles(self.target, self.reference_local_path, log)
+        self.assertTrue(len(alleles1) > 0)
+        self.assertIs(alleles1, alleles2)
+
+    def test_reload_after_clearing(self):
+        """test that the alleles are re-read after the cache was cleared (as after a reference update)
+        """
+        alleles1 = RC.get_reference_alleles(self.target, self.reference_local_path, log)
+        RC.clear_reference_cache(self.target)
+        alleles2 = RC.get_reference_alleles(self.target, self.reference_local_path, log)
+        self.assertIsNot(alleles1, alleles2)
+        self.assertEqual(sorted(alleles1.keys()), sorted(alleles2.keys()))
+
+
+class TestReferenceIndices(unittest.TestCase):
+    """test the index files make_parsed_files writes besides the parsed reference
+    (byte-offset index and record hashes of the .dat file, gene models, sequence index)
+    """
+
+    @classmethod
+    def setUpClass(self):
+        if skip_other_tests:
+            self.skipTest(self, "Skipping reference index test because skip_other_tests is set to True")
+
+        self.target = "KIR"
+        self.reference_local_path = os.path.join(curr_settings["root_path"],
+                                                 curr_settings["general_dir"],
+                                                 curr_settings["reference_dir"])
+        RC.clear_reference_cache()
+
+        # build all index files of the reference from its .dat file:
+        self.index_dir = os.path.join(curr_settings["temp_dir"], "test_reference_indices")
+        os.makedirs(self.index_dir, exist_ok=True)
+        with open(os.path.join(self.reference_local_path, f"{self.target}.dat"), "rb") as dat_stream:
+            HEP.make_parsed_files(self.target, self.index_dir, log, dat_stream=dat_stream)
+
+    @classmethod
+    def tearDownClass(self):
+        RC.clear_reference_cache()
+        shutil.rmtree(self.index_dir, ignore_errors=True)
+
+    def test_indexed_alleles_equal_full_parse(self):
+        """test that alleles read via the byte-offset index equal those from parsing the whole .dat file
+        """
+        dat_file = os.path.join(self.index_dir, f"{self.target}.dat")
+        index_file = os.path.join(self.index_dir, f"{self.target}_dat_index.dump")
+
+        alleles, _ = HEP.read_dat_file(dat_file, self.target, log)
+        indexed_alleles = HEP.IndexedDatFile(dat_file, index_file, self.target, log)
+        self.assertTrue(len(alleles) > 0)
+        self.assertEqual(sorted(alleles.keys()), sorted(indexed_alleles.keys()))
+        for allele_name in list(alleles.keys())[:50]:
+            allele = alleles[allele_name]
+            indexed_allele = indexed_alleles[allele_name]
+            self.assertEqual(allele.seq, indexed_allele.seq)
+            self.assertEqual(allele.exonpos_dic, indexed_allele.exonpos_dic)
+            self.assertEqual(allele.intronpos_dic, indexed_allele.intronpos_dic)
+            self.assertEqual(allele.utrpos_dic, indexed_allele.utrpos_dic)
+            self.assertEqual(allele.pseudo_exon_dic, indexed_allele.pseudo_exon_dic)
+
+    def test_incremental_parse_without_changes(self):
+        """test that re-parsing the current reference incrementally reuses all alleles and reports no changes
+        """
+        index_file = os.path.join(self.index_dir, f"{self.target}_dat_index.dump")
+        index_data = HEP.read_dat_index(index_file)
+        self.assertEqual(sorted(index_data["hashes"].keys()), sorted(index_data["alleles"].keys()))
+        self.assertEqual(sorted(index_data["dumped"].keys()), sorted(index_data["alleles"].keys()))
+
+        new_dir = os.path.join(self.index_dir, "temp_incremental")
+        os.makedirs(new_dir, exist_ok=True)
+        try:
+            with open(os.path.join(self.index_dir, f"{self.target}.dat"), "rb") as dat_stream:
+                HEP.make_parsed_files(self.target, new_dir, log, dat_stream=dat_stream,
+                                      previous_dir=self.index_dir)
+            changes = HEP.read_change_report(os.path.join(new_dir, f"{self.target}_changes.txt"))
+            self.assertEqual(changes, {"added": [], "changed": [], "removed": []})
+            self.assertEqual(index_data["hashes"],
+                             HEP.read_dat_index(os.path.join(new_dir, f"{self.target}_dat_index.dump"))["hashes"])
+        finally:
+            shutil.rmtree(new_dir)
+
+    def test_gene_models_equal_derived(self):
+        """test that the precomputed gene models give the same annotation basis as deriving them from the alleles
+        """
+        gene_models = RC.get_gene_models(self.target, self.index_dir, log)
+        alleles = RC.get_reference_alleles(self.target, self.index_dir, log)
+        self.assertEqual(len(gene_models), len(alleles))
+        for allele_name in list(alleles.keys())[:50]:
+            allele = alleles[allele_name]
+            self.assertEqual(COO.getClosestAlleleCoordinates(allele, allele.length),
+                             COO.getClosestAlleleCoordinates(allele, allele.length, gene_models.get(allele_name)))
+
+    def test_sequence_index_finds_reference_alleles(self):
+        """test that the sequences of reference alleles are recognized by the sequence index without BLAST
+        """
+        seq_index = RC.get_sequence_index(self.target, self.index_dir, log)
+        self.assertIsNotNone(seq_index)
+        alleles = RC.get_reference_alleles(self.target, self.index_dir, log)
+        for allele_name in list(alleles.keys())[:50]:
+            allele = alleles[allele_name]
+            if not HEP.use_in_reference_fasta(allele, self.target):
+                continue
+            (found_name, length, start) = seq_index.find(allele.seq)
+            self.assertEqual(alleles[found_name].seq, allele.seq)
+            self.assertEqual(start, 0)
+
+            stripped_seq = allele.seq[len(allele.UTR5):allele.length - len(allele.UTR3)]
+            (found_name, length, start) = seq_index.find(stripped_seq)
+            self.assertEqual(start, len(alleles[found_name].UTR5))
+        self.assertIsNone(seq_index.find("ACGT"))
+
+
+class TestLocusPartitions(unittest.TestCase):
+    """test the per-locus partitions of the reference fasta written by make_parsed_files
+    """
+
+    @classmethod
+    def setUpClass(self):
+        if skip_other_tests:
+            self.skipTest(self, "Skipping locus partition test because skip_other_tests is set to True")
+
+        self.target = "KIR"
+        self.reference_local_path = os.path.join(curr_settings["root_path"],
+                                                 curr_settings["general_dir"],
+                                                 curr_settings["reference_dir"])
+        self.index_dir = os.path.join(curr_settings["temp_dir"], "test_locus_partitions")
+        os.makedirs(self.index_dir, exist_ok=True)
+        with open(os.path.join(self.reference_local_path, f"{self.target}.dat"), "rb") as dat_stream:
+            HEP.make_parsed_files(self.target, self.index_dir, log, dat_stream=dat_stream)
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.index_dir, ignore_errors=True)
+
+    def test_locus_partitions_cover_reference(self):
+        """test that the per-locus partitions together contain exactly the alleles of the full reference
+        """
+        partitions = LP.list_partition_fastas(self.index_dir, self.target)
+        self.assertTrue(len(partitions) > 1)
+
+        partition_alleles = []
+        for (locus, fasta_file) in partitions.items():
+            names = [header.split()[0] for (header, _) in EF.fasta_generator(fasta_file)]
+            self.assertTrue(all(LP.get_locus(name) == locus for name in names))
+            partition_alleles.extend(names)
+        full_fasta = os.path.join(self.index_dir, f"parsed{self.target}.fa")
+        full_alleles = [header.split()[0] for (header, _) in EF.fasta_generator(full_fasta)]
+        self.assertEqual(sorted(partition_alleles), sorted(full_alleles))
+
+
+class TestReferenceVersions(unittest.TestCase):
+    """test the multi-version reference store and annotating against the reference version
+    an allele was originally submitted with (getCoordinates(db_version=...))
+    """
+
+    @classmethod
+    def setUpClass(self):
+        if skip_other_tests:
+            self.skipTest(self, "Skipping reference version test because skip_other_tests is set to True")
+
+        self.target = "KIR"
+        self.reference_local_path = os.path.join(curr_settings["root_path"],
+                                                 curr_settings["general_dir"],
+                                                 curr_settings["reference_dir"])
+        self.settings = dict(curr_settings, temp_dir="")  # without result cache
+        RC.clear_reference_cache()
+
+        # copy of the local KIR reference (incl. BLAST database), so its version can be changed:
+        self.ref_dir = os.path.join(curr_settings["temp_dir"], "test_reference_versions")
+        os.makedirs(self.ref_dir, exist_ok=True)
+        for myfile in os.listdir(self.reference_local_path):
+            if self.target in myfile and os.path.isfile(os.path.join(self.reference_local_path, myfile)):
+                shutil.copy(os.path.join(self.reference_local_path, myfile), self.ref_dir)
+        self.version = RS.add_version(self.target, self.ref_dir, log)
+
+        # BLAST a reference allele with one mismatch against the copied reference:
+        alleles = RC.get_reference_alleles(self.target, self.ref_dir, log)
+        allele = next(allele for allele in alleles.values() if HEP.use_in_reference_fasta(allele, self.target))
+        pos = len(allele.seq) // 2
+        seq = allele.seq[:pos] + ("A" if allele.seq[pos] != "A" else "C") + allele.seq[pos + 1:]
+        fasta_file = os.path.join(self.ref_dir, "query.fa")
+        with open(fasta_file, "w") as g:
+            g.write(f">query\n{seq}\n")
+        self.blast_file = GASB.blastSequences(fasta_file, os.path.join(self.ref_dir, f"parsed{self.target}.fa"),
+                                              self.settings, log)
+        self.dat_file = os.path.join(self.ref_dir, f"{self.target}.dat")
+        self.current = COO.getCoordinates(self.blast_file, self.dat_file, self.target, self.settings, log)
+
+        # make the stored version an older one:
+        with open(os.path.join(self.ref_dir, f"curr_version_{self.target}.txt"), "w") as g:
+            g.write("0.0.0")
+
+    @classmethod
+    def tearDownClass(self):
+        RC.clear_reference_cache()
+        shutil.rmtree(self.ref_dir, ignore_errors=True)
+
+    def test_stored_version_equals_current(self):
+        """test that a reference version stored in the multi-version reference store
+        contains the same alleles as the current reference
+        """
+        self.assertTrue(self.version)
+        self.assertIn(self.version, RS.list_versions(self.ref_dir, self.target))
+
+        current_alleles = RC.get_reference_alleles(self.target, self.ref_dir, log)
+        stored_alleles = RS.get_version_alleles(self.target, self.ref_dir, self.version, log)
+        self.assertEqual(sorted(current_alleles.keys()), sorted(stored_alleles.keys()))
+        for allele_name in list(current_alleles.keys())[:50]:
+            self.assertEqual(current_alleles[allele_name].seq, stored_alleles[allele_name].seq)
+            self.assertEqual(current_alleles[allele_name].exonpos_dic, stored_alleles[allele_name].exonpos_dic)
+
+    def test_stored_from_dat_index(self):
+        """test that storing a version via the record hashes of the dat index written by make_parsed_files
+        gives the same manifest as hashing the .dat file again
+        """
+        index_data = RS.get_current_index(self.target, self.ref_dir, self.version)
+        self.assertIsNotNone(index_data)
+        self.assertIsNone(RS.get_current_index(self.target, self.ref_dir, "0.0.1"))
+        store_dirs = [os.path.join(self.ref_dir, mydir) for mydir in ["test_store_index", "test_store_dat"]]
+        for mydir in store_dirs:
+            os.makedirs(mydir, exist_ok=True)
+        (manifest, added) = RS.add_records_from_index(RS.RecordStore(store_dirs[0]), index_data, self.ref_dir,
+                                                      self.target)
+        (manifest_dat, added_dat) = RS.add_records_from_dat(RS.RecordStore(store_dirs[1]), self.dat_file,
+                                                            self.target, log)
+        self.assertEqual(manifest, manifest_dat)
+        self.assertEqual(added, len(manifest))
+        self.assertEqual(added_dat, len(manifest_dat))
+
+    def test_coordinates_of_stored_version(self):
+        """test that getCoordinates annotates against a stored reference version if it is given as db_version
+        """
+        with self.assertLogs(log, "INFO") as cm:
+            annotations = COO.getCoordinates(self.blast_file, self.dat_file, self.target, self.settings, log,
+                                             db_version=self.version)
+        self.assertIn(f"Using stored {self.target} reference version {self.version}", "\n".join(cm.output))
+        self.assertEqual(annotations["query"]["closestAllele"], self.current["query"]["closestAllele"])
+        self.assertEqual(annotations["query"]["coordinates"], self.current["query"]["coordinates"])
+        self.assertEqual(annotations["query"]["differences"], self.current["query"]["differences"])
+
+    def test_coordinates_of_version_not_stored(self):
+        """test that getCoordinates raises the 'database changed' error instead of using the current reference
+        if the given db_version is not stored
+        """
+        with self.assertRaises(KeyError) as cm:
+            COO.getCoordinates(self.blast_file, self.dat_file, self.target, self.settings, log, db_version="0.0.1")
+        self.assertIn("no longer stored locally", cm.exception.args[0])
+        self.assertIn("database changed between submissions", cm.exception.args[0])
+
+
 class Test_1_Create_Project(unittest.TestCase):
     """ create project
     """
@@ -474,6 +752,44 @@ class Test_2_ProjectStatus(unittest.TestCase):
         self.assertEqual(new_index, 0)
 
 
+class TestHeadless(unittest.TestCase):
+    """test the database access & imports used by typeloader_cli.py, which runs without Qt
+    """
+
+    @classmethod
+    def setUpClass(self):
+        if skip_other_tests:
+            self.skipTest(self, "Skipping TestHeadless because skip_other_tests is set to True")
+        else:
+            self.project = project_name
+
+    def test1_sqlite_connection(self):
+        """test if queries and transactions work via sqlite3
+        """
+        sqlite_db = db_internal.create_sqlite_connection(curr_settings["db_file"], log)
+        self.assertTrue(sqlite_db)
+        try:
+            self.assertTrue(typeloader_functions.check_project_open(self.project, log))
+            query = f"select project_status from projects where project_name = '{self.project}'"
+            self.assertEqual(db_internal.execute_query(query, 1, log, "testing"), (True, [["Open"]]))
+
+            # failing transactions are rolled back:
+            queries = [f"update projects set project_status = 'Closed' where project_name = '{self.project}'",
+                       "select * from no_such_table"]
+            self.assertFalse(db_internal.execute_transaction(queries, sqlite_db, log, "testing"))
+            self.assertTrue(typeloader_functions.check_project_open(self.project, log))
+        finally:
+            db_internal.close_sqlite_connection(log, sqlite_db)
+
+    def test2_no_qt_imports(self):
+        """test if the headless entry point and the functions it uses can be imported without Qt
+        """
+        cmd = [sys.executable, "-c", "import sys; from typeloader2 import typeloader_cli, typeloader_functions; "
+                                     "print([m for m in sys.modules if m.startswith('PyQt5')])"]
+        result = subprocess.run(cmd, cwd=mypath, stdout=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(result.stdout.strip(), "[]")
+
+
 class Test_Create_New_Allele(unittest.TestCase):
     """
     create new allele
@@ -2116,6 +2432,27 @@ class Test_BulkUpload(unittest.TestCase):
         done = self.form.perform_bulk_upload(auto_confirm=True)
         self.assertTrue(done)
 
+    def test_stored_in_csv_order(self):
+        """alleles prepared in parallel are stored in the order of the .csv file,
+        with consecutive project numbers and their final local name as cell_line in the ENA file
+        """
+        local_names = ["DKMS-LSL_ID2_bulk_KIR_2DL5B_1", "DKMS-LSL_ID3_bulk_HLAshort_2DL1_1"]
+        query = f"""select alleles.local_name, alleles.project_nr, alleles.sample_id_int, files.ena_file
+                from alleles join files on alleles.sample_id_int = files.sample_id_int
+                and alleles.allele_nr = files.allele_nr
+                where alleles.project_name = '{self.project_name}'
+                and alleles.local_name in ('{"', '".join(local_names)}')
+                order by alleles.project_nr"""
+        success, data = db_internal.execute_query(query, 4, log, "retrieving the bulk uploaded alleles")
+        self.assertTrue(success)
+        self.assertEqual([local_name for [local_name, _, _, _] in data], local_names)
+        self.assertEqual(data[1][1], data[0][1] + 1)
+        for [local_name, _, sample_id_int, ena_file] in data:
+            with open(os.path.join(curr_settings["projects_dir"], self.project_name, sample_id_int, ena_file)) as f:
+                ena_text = f.read()
+            self.assertIn(f'/cell_line="{local_name}"', ena_text)
+            self.assertNotIn(typeloader_functions.LOCAL_NAME_PLACEHOLDER, ena_text)
+
     def test_success(self):
         """make sure expected results occur
         """
@@ -2970,9 +3307,16 @@ class TestEdgecases(unittest.TestCase):
 
             log.info(f"Established {len(self.testcases)} testcases from file.")
 
+            # copies of the current reference fasta files, without k-mer index (built by the first search):
+            self.kmer_dir = os.path.join(curr_settings["temp_dir"], "test_kmer_index")
+            os.makedirs(self.kmer_dir, exist_ok=True)
+            for target_family in set(case.target_family for case in self.testcases):
+                (parsed_fasta, _, _) = GASB.get_reference_files(target_family, curr_settings)
+                shutil.copy(parsed_fasta, self.kmer_dir)
+
     @classmethod
     def tearDownClass(self):
-        pass
+        shutil.rmtree(self.kmer_dir, ignore_errors=True)
 
     def test_edgecases(self):
         """
@@ -2997,6 +3341,432 @@ class TestEdgecases(unittest.TestCase):
             self.assertEqual(d["differences"]['insertionPositions'], case.ins_pos)
             self.assertEqual(d["differences"]['mismatchPositions'], case.mm_pos)
 
+    def test_kmer_index_finds_same_closest_allele(self):
+        """testing whether the k-mer index search chooses the same closest allele as BLAST for these cases
+        """
+        for case in self.testcases:
+            log.info(f"Testing case {case.nr}:{case.desc} with the k-mer index...")
+            records = list(EF.fasta_generator(case.filename.replace("blast.xml", "fa")))
+            (parsed_fasta, _, _) = GASB.get_reference_files(case.target_family, curr_settings)
+            (_, target) = GASB.get_reference_target(parsed_fasta)
+            hits = GASB.search_kmer_index(records, os.path.join(self.kmer_dir, os.path.basename(parsed_fasta)), log)
+            self.assertTrue(os.path.isfile(os.path.join(self.kmer_dir, f"{target}_kmer_index.npz")))
+            self.assertIsNotNone(hits)
+            self.assertEqual(hits[0].allele_name, case.closest_allele)
+
+    def test_tabular_blast_output_gives_same_results(self):
+        """testing whether these cases are parsed identically after conversion to the tabular BLAST output format
+        """
+        for case in self.testcases:
+            log.info(f"Testing case {case.nr}:{case.desc} in tabular format...")
+            tabular_file = BR.xml_to_tabular(case.filename)
+            try:
+                self.assertTrue(BR.is_tabular(tabular_file))
+                self.assertEqual(CA.get_closest_known_alleles(tabular_file, case.target_family, curr_settings, log),
+                                 CA.get_closest_known_alleles(case.filename, case.target_family, curr_settings, log))
+            finally:
+                os.remove(tabular_file)
+
+    def test_banded_alignment_matches_full_alignment(self):
+        """testing whether the banded alignment of fix_incomplete_alignment finds the same alignment start
+        as the global alignment of the full sequences for these cases (or falls back to it)
+        """
+        banded_cases = 0
+        for case in self.testcases:
+            log.info(f"Testing case {case.nr}:{case.desc}: banded vs. full alignment...")
+            (parsed_fasta, _, _) = GASB.get_reference_files(case.target_family, curr_settings)
+            with open(case.filename) as f:
+                record = next(BR.parse(f))
+            alignment = record.alignments[0]
+            ref_seq = CA.Seq(CA.get_indexed_fasta(parsed_fasta, log).fetch(CA.get_hit_name(alignment,
+                                                                                        case.target_family)))
+            (_, query_seq) = next(EF.fasta_generator(BR.get_query_fasta(case.filename)))
+            query_seq = CA.Seq(query_seq)
+            (hsp_query, hsp_subject, hsp_match, _, hsp_start, _) = \
+                CA.puzzle_HSPs_from_first_hit(alignment.hsps, ref_seq, query_seq, None)
+
+            (banded, ref_offset) = CA.make_banded_alignment(ref_seq, query_seq, hsp_start, hsp_query, hsp_subject,
+                                                            hsp_match, log)
+            if banded is None:
+                continue
+            banded_cases += 1
+            full = CA.make_global_alignment(ref_seq, query_seq, log)[0]
+            self.assertEqual(banded[0].aligned[0][0][0] + ref_offset, full.aligned[0][0][0])
+            self.assertEqual(banded[0].aligned[1][0][0], full.aligned[1][0][0])
+        self.assertGreater(banded_cases, 0)
+
+    def test_banded_alignment_fallback(self):
+        """testing whether the banded alignment gives up (so the full sequences are aligned instead)
+        if the HSP has no anchor or the best alignment might lie outside the band
+        """
+        rnd = Random(17)
+        ref = "".join(rnd.choice("ACGT") for _ in range(1500))
+
+        def banded(query, query_start, ref_start):
+            length = min(len(query) - query_start, len(ref) - ref_start)
+            (hsp_query, hsp_subject) = (query[query_start:query_start + length], ref[ref_start:ref_start + length])
+            hsp_match = "".join("|" if q == r else " " for (q, r) in zip(hsp_query, hsp_subject))
+            return CA.make_banded_alignment(ref, query, ref_start + 1, hsp_query, hsp_subject, hsp_match, log)
+
+        # no exact match of ANCHOR_LENGTH bp within the HSP:
+        query = "".join(base if i % 10 else ("A" if base != "A" else "C") for (i, base) in enumerate(ref[100:]))
+        self.assertEqual(banded(query, 3, 103), (None, 0))
+
+        # within the band: same start as the full alignment
+        query = ref[:60] + ref[260:]
+        (alignments, ref_offset) = banded(query, 60, 260)
+        self.assertIsNotNone(alignments)
+        full = CA.make_global_alignment(ref, query, log)[0]
+        self.assertEqual(alignments[0].aligned[0][0][0] + ref_offset, full.aligned[0][0][0])
+
+        # deletion longer than the band: the full alignment starts outside the band
+        for (head, deletion) in [(150, 150), (300, 300)]:
+            query = ref[:head] + ref[head + deletion:]
+            self.assertEqual(CA.make_global_alignment(ref, query, log)[0].aligned[0][0][0], 0)
+            self.assertEqual(banded(query, head, head + deletion), (None, 0))
+
+    def test_closest_allele_candidates(self):
+        """testing whether evaluating the top 3 BLAST hits finds a closest allele at least as close as the best hit
+        """
+        settings = dict(curr_settings, closest_allele_candidates="3")
+        settings_best_hit = dict(curr_settings, closest_allele_candidates="1")
+        for case in self.testcases:
+            log.info(f"Testing case {case.nr}:{case.desc} with 3 closest allele candidates...")
+            best_hit = CA.get_closest_known_alleles(case.filename, case.target_family, settings_best_hit, log)
+            results = CA.get_closest_known_alleles(case.filename, case.target_family, settings, log)
+            for (query, closest_allele) in results.items():
+                self.assertLessEqual(CA.count_differences(closest_allele), CA.count_differences(best_hit[query]))
+                candidates = closest_allele.get("candidates")
+                if candidates:  # BLAST found more than one hit
+                    self.assertEqual(candidates[0]["name"], closest_allele["name"])
+                    differences = [candidate["differences"] for candidate in candidates
+                                   if candidate["differences"] is not None]
+                    self.assertEqual(differences, sorted(differences))
+
+    def test_closest_allele_candidates_are_annotated(self):
+        """testing whether each closest allele candidate is annotated and can be chosen instead of the best one
+        """
+        settings = dict(curr_settings, closest_allele_candidates="3")
+        for case in self.testcases:
+            log.info(f"Testing case {case.nr}:{case.desc}: annotation of the closest allele candidates...")
+            (_, dat_file, _) = GASB.get_reference_files(case.target_family, settings)
+            annotations = COO.getCoordinates(case.filename, dat_file, case.target_family, settings, log,
+                                             incomplete_ok=True)
+            for (query, annotation) in annotations.items():
+                candidates = annotation["closestAlleleCandidates"]
+                if not candidates:  # BLAST found only one hit
+                    continue
+                self.assertEqual(candidates[0]["name"], annotation["closestAllele"])
+                self.assertEqual(candidates[0]["annotation"]["coordinates"], annotation["coordinates"])
+                for candidate in candidates[1:]:
+                    if not candidate["annotation"]:
+                        self.assertTrue(candidate["error"])
+                        continue
+                    chosen = COO.getCoordinates(case.filename, dat_file, case.target_family, settings, log,
+                                                incomplete_ok=True, closest_allele=candidate["name"])[query]
+                    self.assertEqual(chosen["closestAllele"], candidate["name"])
+                    self.assertEqual(chosen["coordinates"], candidate["annotation"]["coordinates"])
+                    self.assertEqual(chosen["differences"], candidate["annotation"]["differences"])
+                    self.assertEqual(chosen["closestAlleleCandidates"], candidates)
+
+
+class TestChainHSPs(unittest.TestCase):
+    """test whether HSPs split by large InDels are chained and joined correctly (closestallele.chain_HSPs, join_HSPs)
+    on real BLAST output of a random reference and queries with a 300 bp InDel
+    """
+
+    @classmethod
+    def setUpClass(self):
+        if skip_other_tests:
+            self.skipTest(self, "Skipping TestChainHSPs because skip_other_tests is set to True")
+        else:
+            self.mydir = os.path.join(curr_settings["temp_dir"], "test_chain_hsps")
+            os.makedirs(self.mydir, exist_ok=True)
+            rnd = Random(18)
+            ref = [rnd.choice("ACGT") for _ in range(3000)]
+            # the bases flanking bp 1001-1300 differ, so each InDel has exactly one best position:
+            (ref[999], ref[1000], ref[1299], ref[1300]) = ("A", "C", "G", "T")
+            self.ref = "".join(ref)
+            self.insertion = "G" + "".join(rnd.choice("ACGT") for _ in range(298)) + "T"
+            self.ref_file = os.path.join(self.mydir, "ref.fa")
+            with open(self.ref_file, "w") as g:
+                g.write(f">REF\n{self.ref}\n")
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.mydir, ignore_errors=True)
+
+    def align(self, name, query):
+        """BLASTs the query against the reference, returns (HSPs of the hit, closest allele items)
+        """
+        query_file = os.path.join(self.mydir, f"{name}.fa")
+        blast_file = os.path.join(self.mydir, f"{name}.blast.xml")
+        with open(query_file, "w") as g:
+            g.write(f">{name}\n{query}\n")
+        subprocess.run([curr_settings["blast_path"], "-query", query_file, "-subject", self.ref_file,
+                        "-outfmt", "5", "-dust", "no", "-soft_masking", "false", "-out", blast_file], check=True)
+        with open(blast_file) as f:
+            record = next(BR.parse(f))
+        hsps = record.alignments[0].hsps
+        items = CA.evaluate_hit(hsps, "REF", self.ref, query, len(query), query_file, log)
+        return hsps, items
+
+    def check(self, name, query, deletions=(), insertions=(), mismatches=()):
+        (hsps, items) = self.align(name, query)
+        self.assertGreater(len(hsps), 1)
+        self.assertEqual(len(CA.chain_HSPs(hsps)), 2)
+        self.assertTrue(items["concatHSPS"])
+        self.assertEqual(items["hitStart"], 1)
+        self.assertEqual(items["differences"]["deletionPositions"], list(deletions))
+        self.assertEqual(items["differences"]["insertionPositions"], list(insertions))
+        self.assertEqual(items["differences"]["mismatchPositions"], list(mismatches))
+        return items
+
+    @staticmethod
+    def mutate(base):
+        return "A" if base != "A" else "C"
+
+    def test_deletion(self):
+        """a deletion of bp 1001-1300 is placed at alignment positions 1001-1300
+        """
+        self.check("deletion", self.ref[:1000] + self.ref[1300:], deletions=range(1001, 1301))
+
+    def test_insertion(self):
+        """an insertion behind bp 1000 is placed at alignment positions 1001-1300
+        """
+        self.check("insertion", self.ref[:1000] + self.insertion + self.ref[1000:], insertions=range(1001, 1301))
+
+    def test_mismatch_before_junction(self):
+        """a mismatch 5 bp before a deletion is kept as a mismatch next to the deletion
+        """
+        query = self.ref[:995] + self.mutate(self.ref[995]) + self.ref[996:1000] + self.ref[1300:]
+        items = self.check("mismatch_before", query, deletions=range(1001, 1301), mismatches=[996])
+        self.assertEqual(items["differences"]["mismatches"], [(query[995], self.ref[995])])
+
+    def test_mismatch_behind_junction(self):
+        """a mismatch 5 bp behind an insertion is kept as a mismatch next to the insertion
+        """
+        query = self.ref[:1000] + self.insertion + self.ref[1000:1004] + self.mutate(self.ref[1004]) + \
+            self.ref[1005:]
+        self.check("mismatch_behind", query, insertions=range(1001, 1301), mismatches=[1305])
+
+    def test_overlapping_hsps(self):
+        """a tandem duplication makes the HSPs overlap in the reference: the overlap is removed from the second HSP,
+        leaving one contiguous 300 bp insertion
+        """
+        (hsps, items) = self.align("duplication", self.ref[:1300] + self.ref[1000:])
+        chain = CA.chain_HSPs(hsps)
+        self.assertEqual(len(chain), 2)
+        self.assertLessEqual(chain[1].sbjct_start, chain[0].sbjct_end)  # overlap
+        differences = items["differences"]
+        self.assertEqual(differences["deletionPositions"], [])
+        self.assertEqual(differences["mismatchPositions"], [])
+        insertions = differences["insertionPositions"]
+        self.assertEqual(len(insertions), 300)
+        self.assertEqual(insertions, list(range(insertions[0], insertions[0] + 300)))
+
+
+class TestResultCache(unittest.TestCase):
+    """test the on-disk cache of BLAST and annotation results (result_cache.ResultCache)
+    """
+
+    @classmethod
+    def setUpClass(self):
+        if skip_other_tests:
+            self.skipTest(self, "Skipping result cache test because skip_other_tests is set to True")
+
+        self.cache_dir = os.path.join(curr_settings["temp_dir"], "test_result_cache")
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def test_reuses_entries_under_new_names(self):
+        """test that a cached result is found again and mapped to the query IDs of the current file
+        """
+        cache = RSC.ResultCache(self.cache_dir)
+        key = RSC.hash_sequences(["ACGT", "GGCC"]) + ("test", "KIR")
+        result = {"allele1": {"closestAllele": "x"}, "allele2": None}
+        cache.put("test", key, RSC.to_positions(result, ["allele1", "allele2"]), log)
+        cached = cache.get("test", key, log)
+        self.assertEqual(RSC.from_positions(cached, ["renamed1", "renamed2"]),
+                         {"renamed1": {"closestAllele": "x"}, "renamed2": None})
+        self.assertIsNone(cache.get("test", RSC.hash_sequences(["ACGA", "GGCC"]) + ("test", "KIR"), log))
+
+        small_cache = RSC.ResultCache(cache.cache_dir, max_size=os.path.getsize(cache.get_path("test", key)) * 10)
+        for i in range(30):  # evicts the least recently used entries once the cache grows too large
+            small_cache.put("test", ("entry", i), RSC.to_positions(result, ["allele1", "allele2"]), log)
+        sizes = [size for (_, size, _) in small_cache.list_entries()]
+        self.assertLessEqual(sum(sizes), small_cache.max_size)
+        self.assertEqual(RSC._cache_sizes[small_cache.cache_dir], sum(sizes))
+
+
+class TestAlignmentService(unittest.TestCase):
+    """test the long-lived alignment worker of a GUI session (alignment_service.py)
+    """
+
+    @classmethod
+    def setUpClass(self):
+        if skip_other_tests:
+            self.skipTest(self, "Skipping alignment service test because skip_other_tests is set to True")
+
+        self.target = "KIR"
+        self.reference_local_path = os.path.join(curr_settings["root_path"],
+                                                 curr_settings["general_dir"],
+                                                 curr_settings["reference_dir"])
+
+    @classmethod
+    def tearDownClass(self):
+        RC.clear_reference_cache()
+
+    def test_keeps_reference_warm(self):
+        """test that the alignment service warms up a target with its first job, runs jobs with the cached reference
+        and restarts after reference changes
+        """
+        service = AS.start_service(curr_settings, log)
+        try:
+            self.assertEqual(service.warm_targets, set())  # nothing is loaded before the first job of a target
+            AS.warm_up(self.target)
+            self.assertEqual(service.warm_targets, {self.target})
+
+            get_alleles = lambda: RC.get_reference_alleles(self.target, self.reference_local_path, log)
+            alleles = AS.run_job(get_alleles)
+            self.assertIs(AS.run_job(get_alleles), alleles)
+            with self.assertRaises(ValueError):
+                AS.run_job(int, "not a number")
+
+            service.reference_keys = {}  # as if the reference had been updated
+            self.assertIsNot(AS.run_job(get_alleles), alleles)
+            self.assertEqual(service.restarts, 1)
+            self.assertEqual(service.warm_targets, set())
+        finally:
+            AS.stop_service()
+        self.assertIsNone(AS.get_service())
+
+
+class TestTaskWorker(unittest.TestCase):
+    """test running tasks in a cancellable worker thread (GUI_forms.run_task)
+    """
+
+    def test_run_task(self):
+        """results and exceptions of a task reach the GUI thread, database calls of a task run in the GUI thread
+        """
+        def task(x):
+            jobs.report_stage("parse")
+            return x, jobs.run_in_main_thread(threading.current_thread)
+
+        (x, thread) = GUI_forms.run_task(None, log, "Testing", task, 1)
+        self.assertEqual(x, 1)
+        self.assertIs(thread, threading.current_thread())
+        with self.assertRaises(ValueError):
+            GUI_forms.run_task(None, log, "Testing", int, "not a number")
+
+    def test_cancel_task(self):
+        """cancelling a task kills its running subprocess and raises JobCancelled
+        """
+        def task():
+            threading.Timer(0.2, jobs.current_job().cancel).start()
+            return jobs.run_process([sys.executable, "-c", "import time; time.sleep(10)"])
+
+        start = time.time()
+        with self.assertRaises(jobs.JobCancelled):
+            GUI_forms.run_task(None, log, "Testing", task)
+        self.assertLess(time.time() - start, 5)
+
+
+class TestStageTiming(unittest.TestCase):
+    """test timing the stages of the allele pipeline (timing.py)
+    """
+
+    @classmethod
+    def setUpClass(self):
+        self.timing_file = os.path.join(curr_settings["temp_dir"], "unittest_timings.jsonl")
+
+    def tearDown(self):
+        timing.disable()
+        if os.path.isfile(self.timing_file):
+            os.remove(self.timing_file)
+
+    def test_disabled(self):
+        """without a timing file, nothing is recorded
+        """
+        with timing.collect() as records:
+            with timing.stage("copy"):
+                pass
+            timing.timed(len)("abc")
+        self.assertEqual(records, [])
+        self.assertFalse(os.path.isfile(self.timing_file))
+
+    def test_timing_file(self):
+        """timed stages are written to the timing file and collected for the summary
+        """
+        timing.enable(self.timing_file)
+        with timing.collect() as records:
+            for _ in range(2):
+                timing.timed(time.sleep)(0.01)
+            with timing.stage("copy", file="test.fa"):
+                pass
+        self.assertEqual([r["stage"] for r in records], ["sleep", "sleep", "copy"])
+        self.assertGreaterEqual(records[0]["seconds"], 0.01)
+        self.assertEqual(records[2]["file"], "test.fa")
+        with open(self.timing_file) as f:
+            self.assertEqual([json.loads(line) for line in f], records)
+
+        summary = timing.summarize(records).split("\n")
+        self.assertEqual(len(summary), 3)
+        self.assertTrue(summary[1].startswith("sleep"))
+        self.assertEqual(summary[1].split()[1], "2")
+
+
+class TestStaging(unittest.TestCase):
+    """test keeping the temp files of an upload in memory (staging.py)
+    """
+
+    @classmethod
+    def setUpClass(self):
+        if skip_other_tests:
+            self.skipTest(self, "Skipping TestStaging because skip_other_tests is set to True")
+        else:
+            mydir = os.path.join(curr_settings["login_dir"], curr_settings["data_unittest"], "delete_partner")
+            self.blast_xml_file = os.path.join(mydir, "DKMS-LSL_ID1_E_1.blast.xml")
+            self.fasta_file = os.path.join(mydir, "DKMS-LSL_ID1_E_1.fa")
+            self.partner_allele = "E*01:03:02:01-Novel-2"
+            self.fasta_ref_file = os.path.join(mydir, "DKMS-LSL_ID1_E_1_test.fa")
+            self.blast_ref_file = os.path.join(mydir, "DKMS-LSL_ID1_E_1_test.blast.xml")
+            self.temp_dir = os.path.join(curr_settings["temp_dir"], "unittest_staging")
+            self.sample_dir = os.path.join(curr_settings["temp_dir"], "unittest_staging_sample")
+            for mydir in [self.temp_dir, self.sample_dir]:
+                os.makedirs(mydir, exist_ok=True)
+
+    @classmethod
+    def tearDownClass(self):
+        staging.pop_dir(self.temp_dir)
+        for mydir in [self.temp_dir, self.sample_dir]:
+            shutil.rmtree(mydir, ignore_errors=True)
+
+    def test_remove_other_allele_in_memory(self):
+        """in-memory temp files are cleaned in memory and only written to disk when they are moved to the sample dir
+        """
+        staged = {}
+        for myfile in [self.blast_xml_file, self.fasta_file]:
+            staged[myfile] = os.path.join(self.temp_dir, os.path.basename(myfile))
+            with open(myfile) as f:
+                staging.stage(staged[myfile], f.read())
+        self.assertEqual(BR.get_query_fasta(staged[self.blast_xml_file]), staged[self.fasta_file])
+
+        typeloader_functions.remove_other_allele(staged[self.blast_xml_file], staged[self.fasta_file],
+                                                 self.partner_allele, log)
+        self.assertEqual(os.listdir(self.temp_dir), [])
+        self.assertEqual(list(EF.fasta_generator(staged[self.fasta_file])),
+                         list(EF.fasta_generator(self.fasta_ref_file)))
+        with open(self.blast_ref_file) as f:
+            self.assertEqual(staging.read_text(staged[self.blast_xml_file]), f.read())
+
+        new_path = general.move_rename_file(staged[self.fasta_file], self.sample_dir, "unittest")
+        self.assertFalse(staging.is_staged(staged[self.fasta_file]))
+        self.assertEqual(list(EF.fasta_generator(new_path)), list(EF.fasta_generator(self.fasta_ref_file)))
+        self.assertEqual(list(staging.pop_dir(self.temp_dir)), [os.path.abspath(staged[self.blast_xml_file])])
+
 
 class TestDeleteOtherAllele(unittest.TestCase):
     """
@@ -3183,6 +3953,8 @@ class TestRestrictedReference(unittest.TestCase):
                                                            "restricted_db_wrong_target_family")
             self.restricted_db_wrong_alleles = os.path.join(self.mydir,
                                                             "restricted_db_bad")
+            # only the best BLAST hit, which is too divergent (other candidates might be usable):
+            self.settings = dict(curr_settings, closest_allele_candidates="1")
 
     @classmethod
     def tearDownClass(self):
@@ -3205,7 +3977,7 @@ class TestRestrictedReference(unittest.TestCase):
         results2 = typeloader_functions.process_sequence_file(project_name, filetype, blastXmlFile,
                                                               targetFamily, fasta_filename,
                                                               allelesFilename, header_data,
-                                                              curr_settings, log)
+                                                              self.settings, log)
 
         success = results2[0]
         msg = results2[1]
@@ -3247,7 +4019,7 @@ class TestRestrictedReference(unittest.TestCase):
         results2 = typeloader_functions.process_sequence_file(project_name, filetype, blastXmlFile,
                                                               targetFamily, fasta_filename,
                                                               allelesFilename, header_data,
-                                                              curr_settings, log)
+                                                              self.settings, log)
 
         success = results2[0]
         msg = results2[1]
@@ -3274,7 +4046,7 @@ class TestRestrictedReference(unittest.TestCase):
         results2 = typeloader_functions.process_sequence_file(project_name, filetype, blastXmlFile,
                                                               targetFamily, fasta_filename,
                                                               allelesFilename, header_data,
-                                                              curr_settings, log)
+                                                              self.settings, log)
         self.assertTrue(results2[0])  # success
         [allele1, allele2] = results2[1]
         self.assertEqual(allele1.gendx_result, "B*07:386N-Novel-1")
@@ -3287,7 +4059,7 @@ class TestRestrictedReference(unittest.TestCase):
         as expected)
         """
         with mock.patch('PyQt5.QtWidgets.QMessageBox.warning', return_value=QMessageBox.Ok):
-            self.form = ALLELE.NewAlleleForm(log, mydb, self.project_name, curr_settings, None,
+            self.form = ALLELE.NewAlleleForm(log, mydb, self.project_name, self.settings, None,
                                              self.sample_id_int, self.sample_id_ext, testing=True)
             self.dialog = self.form.dialog
             self.assertFalse(self.dialog)  # dialog does not exist, yet
@@ -3349,8 +4121,27 @@ class TestRestrictedReference(unittest.TestCase):
                        "parsedhla.fa.nhr", "parsedhla.fa.nin", "parsedhla.fa.nsq"]:
             self.assertTrue(os.path.exists(os.path.join(restricted_db_path_new, myfile)))
 
+        # the restricted db stays cached for reuse:
         temp_restricted_db_dir = os.path.join(curr_settings["temp_dir"], "restricted_db")
-        self.assertFalse(os.listdir(temp_restricted_db_dir))  # should be empty
+        cached_dbs = [mydir for mydir in os.listdir(temp_restricted_db_dir) if mydir.startswith("hla_")]
+        self.assertTrue(cached_dbs)
+
+    def test7_restricted_db_reused(self):
+        """test that a restricted db for the same alleles and reference version is reused
+        """
+        ref_path = os.path.join(curr_settings["root_path"], curr_settings["general_dir"],
+                                curr_settings["reference_dir"])
+        cache_dir = os.path.join(curr_settings["temp_dir"], "restricted_db")
+        blast_path = os.path.dirname(curr_settings["blast_path"])
+        success1, db_dir1 = update_reference.get_restricted_db("hla", ref_path, self.ref_alleles, cache_dir,
+                                                               blast_path, log)
+        self.assertTrue(success1)
+        with patch.object(update_reference, "make_restricted_db") as make_db:
+            success2, db_dir2 = update_reference.get_restricted_db("hla", ref_path, self.ref_alleles[::-1],
+                                                                   cache_dir, blast_path, log)
+            make_db.assert_not_called()
+        self.assertTrue(success2)
+        self.assertEqual(db_dir1, db_dir2)
 
 
 class TestHomozygousXML(unittest.TestCase):
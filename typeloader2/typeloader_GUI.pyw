@@ -22,6 +22,7 @@ import os
 import ctypes
 import time
 import platform
+import multiprocessing
 from functools import partial
 from datetime import datetime
 from PyQt5.QtWidgets import (QMainWindow, QApplication, QDialog,
@@ -43,6 +44,7 @@ from typeloader2 import GUI_mini_dialogs
 from typeloader2 import GUI_download_files, GUI_user_manual
 from typeloader2.GUI_misc import UnderConstruction
 from typeloader2 import patches
+from typeloader2.typeloader_core import alignment_service
 
 # ===========================================================
 # parameters:
@@ -618,6 +620,7 @@ def remove_lock(settings_dic, log):
 # main:
 
 if __name__ == '__main__':  # pragma: nocover
+    multiprocessing.freeze_support()  # reference updates use worker processes, also in the frozen executable
     if GUI_login.config_files_missing():
         sys.exit(1)
 
@@ -688,7 +691,9 @@ if __name__ == '__main__':  # pragma: nocover
                 except Exception as E2:
                     log.info("Could not open QMessagebox")
                     log.exception(E2)
+            alignment_service.start_service(settings_dic, log)
             result = app.exec_()
+            alignment_service.stop_service(wait=False)
             cleanup_recovery(settings_dic, log)
             ok = True
 
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# -*- coding: cp1252 -*-
+'''
+Created on 16.10.2026
+
+typeloader_cli.py
+
+headless entry point of TypeLoader for batch jobs (e.g., nightly runs on a compute node):
+    - upload: bulk upload of new alleles from a .csv file (like the Bulk Upload dialog)
+    - ena: concatenated flatfile & manifest of all ENA-ready alleles of a project, ready for Webin-CLI
+    - ipd: IPD submission files of all alleles of a project that were accepted by ENA
+
+No Qt is needed: the internal database is accessed via sqlite3 (see db_internal.create_sqlite_connection).
+To keep the start-up fast, the TypeLoader modules are only imported once the command line was parsed
+(check with 'python -X importtime -m typeloader2.typeloader_cli --help').
+
+usage examples:
+    python -m typeloader2.typeloader_cli -u admin upload 20260101_ADMIN_KIR_1 alleles.csv
+    python -m typeloader2.typeloader_cli -u admin ena 20260101_ADMIN_KIR_1
+    python -m typeloader2.typeloader_cli -u admin ipd 20260101_ADMIN_KIR_1 pretypings.csv
+
+The exit code is 0 if everything went fine, else 1.
+'''
+
+# import modules:
+
+import sys, os
+import argparse
+
+# ===========================================================
+# parameters:
+
+package_dir = os.path.dirname(os.path.abspath(__file__))
+
+# ===========================================================
+# functions:
+
+def get_settings(user, log):
+    """reads the settings of a user (like GUI_login.get_settings, but independent of the working directory)
+    """
+    from configparser import ConfigParser
+    from typeloader2 import typeloader_functions as typeloader
+
+    cf = ConfigParser()
+    cf.read(os.path.join(package_dir, typeloader.base_config_file))
+    return typeloader.get_settings(user, log, cf)
+
+
+def get_ENA_project_ID(project, log):
+    """returns the ENA accession (PRJEB...) of a project from the internal database, or None
+    """
+    from typeloader2 import db_internal
+
+    query = f"select ENA_ID_project from projects where project_name = '{project}'"
+    success, data = db_internal.execute_query(query, 1, log, "retrieving the ENA project ID for this project")
+    if success and data:
+        return data[0][0]
+    return None
+
+
+def upload_alleles(project, csv_file, settings, mydb, log, concurrent=True):
+    """uploads all alleles specified in csv_file to project, prints the report;
+    returns True if no problems occurred
+    """
+    from typeloader2 import typeloader_functions as typeloader
+
+    report, errors_found, _ = typeloader.bulk_upload_new_alleles(csv_file, project, settings, mydb, log,
+                                                                 concurrent=concurrent)
+    print(report)
+    return not errors_found
+
+
+def make_ENA_flatfile(project, settings, log):
+    """updates the ENA files of all ENA-ready alleles of a project with provenance and collection date
+    from the internal database, concatenates them to one gzipped flatfile and creates its manifest;
+    returns (success, msg)
+    """
+    from typeloader2 import typeloader_functions as typeloader, db_internal
+    from typeloader2.typeloader_core import EMBLfunctions as EF
+
+    ENA_ID = get_ENA_project_ID(project, log)
+    if not ENA_ID:
+        return False, f"Could not find the ENA project ID of project {project}!"
+
+    query = f"""select project_nr, alleles.sample_id_int, ena_file from alleles
+     join files on alleles.sample_id_int = files.sample_id_int and alleles.allele_nr = files.allele_nr
+     where alleles.project_name = '{project}' and allele_status = 'ENA-ready'
+     order by project_nr"""
+    success, data = db_internal.execute_query(query, 3, log, "retrieving the ENA-ready alleles of this project")
+    if not success:
+        return False, data
+    if not data:
+        return False, f"Project {project} contains no ENA-ready alleles!"
+
+    samples = [[project, str(nr)] for (nr, _, _) in data]
+    donors = [sample_id_int for (_, sample_id_int, _) in data]
+    files = [os.path.join(settings["projects_dir"], project, sample_id_int, ena_file)
+             for (_, sample_id_int, ena_file) in data]
+
+    update_dic = typeloader.get_existing_spatiotemporal_data(donors, log)
+    if update_dic is False:
+        return False, "Could not retrieve provenance and collection dates from the database!"
+    success, msg = typeloader.update_ena_files(samples, files, update_dic, settings, log)
+    if not success:
+        return False, msg
+
+    file_dic, _, analysis_alias = typeloader.create_ENA_filenames(project, ENA_ID, settings, log)
+    concat_successful, _ = EF.concatenate_flatfile(files, file_dic["concat_FF_zip"], log)
+    if not concat_successful:
+        return False, "Concatenated file is empty :-("
+    EF.make_manifest(file_dic["manifest"], ENA_ID, analysis_alias + "_filesub", file_dic["concat_FF_zip"],
+                     settings["TL_version"], log)
+
+    msg = f"Concatenated the ENA files of {len(files)} alleles:\n"
+    msg += f"\t- flatfile: {file_dic['concat_FF_zip']}\n\t- manifest: {file_dic['manifest']}"
+    return True, msg
+
+
+def get_IPD_alleles(project, ENA_id_map, ENA_gene_map, log):
+    """collects all alleles of a project that were submitted to ENA and have an ENA accession
+    (by local_name or cell_line_old, like IPDFileChoiceTable);
+    returns (samples, file_dic, allele_dic) as needed by make_imgt_files.write_imgt_files, or False
+    """
+    from collections import namedtuple
+    from typeloader2 import db_internal
+
+    TargetAllele = namedtuple("TargetAllele", "gene target_allele partner_allele")
+
+    query = f"""select alleles.sample_id_int, alleles.local_name,
+        case
+            when instr(IPD_SUBMISSION_NR, '_') > 0
+                then substr(IPD_SUBMISSION_NR, 1, instr(IPD_SUBMISSION_NR, '_')-1)
+            else
+                IPD_SUBMISSION_NR
+        end as IPD_SUBMISSION_NR,
+        cell_line_old, gene, target_allele, partner_allele, blast_xml, ena_file, database_version
+        from alleles
+         join files on alleles.sample_id_int = files.sample_id_int and alleles.allele_nr = files.allele_nr
+        where alleles.project_name = '{project}' and allele_status = 'ENA submitted'
+        order by project_nr"""
+    success, data = db_internal.execute_query(query, 10, log, "retrieving the alleles of this project")
+    if not success:
+        return False
+
+    samples = []
+    file_dic = {}
+    allele_dic = {}
+    for (sample_id_int, local_name, IPD_nr, cell_line_old, gene, target_allele, partner_allele,
+         blast_xml, ena_file, db_version) in data:
+        if local_name not in ENA_id_map:
+            if cell_line_old in ENA_id_map:  # submitted to ENA under its old cell_line identifier
+                ENA_id_map[local_name] = ENA_id_map[cell_line_old]
+                ENA_gene_map[local_name] = ENA_gene_map[cell_line_old]
+            else:
+                log.info(f"\tNo ENA accession found for {local_name}, skipping it")
+                continue
+        samples.append((sample_id_int, local_name, IPD_nr or ""))
+        file_dic[local_name] = {"blast_xml": blast_xml, "ena_file": ena_file, "db_version": db_version}
+        allele_dic[local_name] = TargetAllele(gene=gene, target_allele=target_allele, partner_allele=partner_allele)
+    return samples, file_dic, allele_dic
+
+
+def make_IPD_files(project, pretypings, settings, mydb, log):
+    """creates the IPD submission files of all alleles of a project that were submitted to ENA
+    and have received an accession (retrieved from ENA's server), saves the submission to the database;
+    returns (success, msg)
+    """
+    import shutil, time
+    from typeloader2 import general, typeloader_functions as typeloader
+    from typeloader2.typeloader_core import make_imgt_files as MIF, ena_accession_retrieval as EAR
+
+    study_nr = get_ENA_project_ID(project, log)
+    if not study_nr:
+        return False, f"Could not find the ENA project ID of project {project}!"
+
+    log.info("Retrieving ENA accession numbers from ENA server...")
+    ENA_timestamp = general.timestamp("%Y-%m-%d")
+    ENA_id_map, ENA_gene_map = EAR.get_ENA_results(study=study_nr, proxy=settings["proxy"],
+                                                   timeout=int(settings["timeout_ena"]), log=log)
+    if ENA_id_map is False:
+        return False, ENA_gene_map  # error message
+
+    results = get_IPD_alleles(project, ENA_id_map, ENA_gene_map, log)
+    if not results:
+        return False, "Could not retrieve the alleles of this project from the database!"
+    (samples, file_dic, allele_dic) = results
+    if not samples:
+        return False, f"Project {project} contains no alleles with ENA accessions that are ready for IPD!"
+
+    subm_id = "IPD_{}".format(time.strftime("%Y%m%d%H%M%S"))
+    project_dir = os.path.join(settings["projects_dir"], project)
+    mydir = os.path.join(project_dir, "IPD-submissions", subm_id)
+    os.makedirs(mydir, exist_ok=True)
+    shutil.copy(pretypings, os.path.join(mydir, os.path.basename(pretypings)))
+
+    results = MIF.write_imgt_files(project_dir, samples, file_dic, allele_dic, ENA_id_map, ENA_gene_map,
+                                   pretypings, subm_id, mydir, settings, log)
+    if not results[0]:
+        msg = results[1]
+        if len(results) > 2:
+            msg += "\n{}".format(results[2])
+        return False, msg
+    (IPD_file, cell_lines, customer_dic, resultText, imgt_files, success, error) = results
+    if error:
+        return False, "An error occurred during the creation of IPD files:\n\n{}".format(repr(error))
+    if not success or not os.path.isfile(IPD_file) or not os.path.getsize(IPD_file):
+        return False, "Could not create IPD files!"
+
+    success, _ = typeloader.save_IPD_submission_to_db(project, subm_id, samples, IPD_file, cell_lines, customer_dic,
+                                                      imgt_files, ENA_id_map, ENA_timestamp, settings, mydb, log)
+    if not success:
+        return False, f"Created {IPD_file}, but could not save this submission to the database!"
+
+    msg = f"Created IPD files for {len(samples)} alleles: {IPD_file}"
+    if resultText:
+        msg += "\n" + resultText
+    return True, msg
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(prog="typeloader_cli",
+                                     description="Runs TypeLoader workflows without GUI.")
+    parser.add_argument("-u", "--user", default="admin", help="TypeLoader user (default: admin)")
+    parser.add_argument("-l", "--log_file", help="also write the debug log to this file")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log debug messages to the console")
+    parser.add_argument("-t", "--timing_file",
+                        help="time the pipeline stages and append the results to this JSON-lines file "
+                             "(default with the setting stage_timing = yes: next to the log file)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    upload = commands.add_parser("upload", help="bulk upload of new alleles specified in a .csv file")
+    upload.add_argument("project")
+    upload.add_argument("csv_file")
+    upload.add_argument("--sequential", action="store_true",
+                        help="process the alleles one after the other instead of in parallel")
+
+    ena = commands.add_parser("ena", help="create the ENA flatfile & manifest of a project's ENA-ready alleles")
+    ena.add_argument("project")
+
+    ipd = commands.add_parser("ipd", help="create the IPD submission files of a project's alleles accepted by ENA")
+    ipd.add_argument("project")
+    ipd.add_argument("pretypings", help=".csv file with the pretypings of all samples")
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    # relative paths refer to the working directory of the caller:
+    for key in ["csv_file", "pretypings", "log_file", "timing_file"]:
+        if getattr(args, key, None):
+            setattr(args, key, os.path.abspath(getattr(args, key)))
+
+    from typeloader2 import general, db_internal, typeloader_functions as typeloader
+    from typeloader2.typeloader_core import timing
+
+    log = general.start_log(level="DEBUG" if args.verbose else "INFO", debug_to_file=args.log_file)
+    log.info("<Start {} {}>".format(os.path.basename(__file__), args.command))
+    settings = get_settings(args.user, log)
+    if not settings:
+        return 1
+    if not args.timing_file and args.log_file and settings["stage_timing"] == "yes":
+        args.timing_file = timing.get_timing_filename(args.log_file)
+    if args.timing_file:
+        log.info(f"Writing the duration of the pipeline stages to {args.timing_file}")
+        timing.enable(args.timing_file)
+    mydb = db_internal.create_sqlite_connection(settings["db_file"], log)
+    if not mydb:
+        return 1
+
+    try:
+        if not typeloader.check_project_open(args.project, log):
+            log.error(f"Project {args.project} is closed!")
+            return 1
+
+        if args.command == "upload":
+            success = upload_alleles(args.project, args.csv_file, settings, mydb, log,
+                                     concurrent=not args.sequential)
+        else:
+            if args.command == "ena":
+                success, msg = make_ENA_flatfile(args.project, settings, log)
+            else:
+                success, msg = make_IPD_files(args.project, args.pretypings, settings, mydb, log)
+            if success:
+                print(msg)
+            else:
+                log.error(msg)
+    finally:
+        db_internal.close_sqlite_connection(log, mydb)
+    log.info("<End>")
+    return 0 if success else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -16,6 +16,11 @@ import gzip
 import requests
 import re
 
+try:
+    from . import staging
+except ImportError:
+    import staging
+
 FUSION_INTRON_PATTERN = re.compile('/number=\d+/\d+')
 
 
@@ -45,7 +50,7 @@ def fasta_generator(fasta_file):
     """reads a fasta file,
     returns the header and sequence of the first entry
     """
-    with open(fasta_file) as fasta:
+    with staging.open_text(fasta_file) as fasta:  # may be an in-memory temp file
         check_fasta_valid(fasta)
         # groupby(data to group, function for grouping)
         tupple_out = (x[1] for x in groupby(fasta, lambda line: line[0] == ">"))
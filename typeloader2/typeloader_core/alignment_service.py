@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+alignment_service.py
+
+long-lived alignment worker of a TypeLoader GUI session:
+started at login, it runs alignment jobs (e.g., GASB.blast_raw_seqs) from a local queue.
+When the first job for a target arrives (see warm_up), the local reference of this target is loaded
+into memory (parsed alleles, gene models, sequence index, k-mer index if it was built already, FASTA index)
+and kept there,
+so later uploads do not pay for loading the reference cold.
+
+The worker is a thread of the TypeLoader process, so it shares the caches of reference_cache and fasta_index.
+Before each job, it checks the local reference versions (see reference_cache.get_reference_key);
+if a reference was updated in the meantime, the worker restarts:
+the cached references are dropped and loaded again by the next job of their target.
+"""
+import os
+from queue import Queue
+from threading import Thread, Lock, current_thread, local
+from contextlib import contextmanager
+from concurrent.futures import Future
+
+try:
+    from . import reference_cache, jobs
+    from .fasta_index import get_indexed_fasta
+except ImportError:
+    import reference_cache
+    import jobs
+    from fasta_index import get_indexed_fasta
+
+# ===========================================================
+# parameters:
+
+TARGETS = ["hla", "KIR"]
+
+_service = None
+_service_lock = Lock()
+_local = local()
+
+
+# ===========================================================
+# classes:
+
+class AlignmentService:
+    """runs jobs (func, args, kwargs) one after the other in a worker thread with warm references
+    """
+    def __init__(self, settings, log):
+        self.log = log
+        self.ref_dir = settings.get("reference_local_path") or os.path.join(settings["root_path"],
+                                                                             settings["general_dir"],
+                                                                             settings["reference_dir"])
+        self.jobs = Queue()
+        self.thread = None
+        self.reference_keys = {}
+        self.warm_targets = set()
+        self.warm_lock = Lock()
+        self.restarts = 0
+
+    def start(self):
+        if self.is_alive():
+            return
+        self.thread = Thread(target=self._run, name="AlignmentService", daemon=True)
+        self.thread.start()
+
+    def is_alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def stop(self, wait=True):
+        """stops the worker after all jobs submitted so far are done
+        """
+        if self.is_alive():
+            self.jobs.put(None)
+            if wait:
+                self.thread.join()
+
+    def submit(self, func, *args, **kwargs):
+        """queues a job, returns a concurrent.futures.Future of its result
+        """
+        future = Future()
+        self.jobs.put((future, func, args, kwargs))
+        return future
+
+    def _run(self):
+        self.reference_keys = self.get_reference_keys()
+        self.log.info("Alignment service ready")
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            (future, func, args, kwargs) = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                if self.reference_changed():
+                    self.restart()
+                future.set_result(func(*args, **kwargs))
+            except BaseException as E:
+                future.set_exception(E)
+        self.log.debug("Alignment service stopped")
+
+    def get_reference_keys(self):
+        return {target: reference_cache.get_reference_key(target, self.ref_dir) for target in TARGETS}
+
+    def reference_changed(self):
+        return self.get_reference_keys() != self.reference_keys
+
+    def restart(self):
+        self.log.info("Local reference changed, restarting the alignment service...")
+        with self.warm_lock:
+            reference_cache.clear_reference_cache()
+            self.warm_targets = set()
+        self.reference_keys = self.get_reference_keys()
+        self.restarts += 1
+
+    def warm_up(self, target):
+        """loads the reference of a target into memory, unless this was already done
+        """
+        target = "KIR" if target.upper() == "KIR" else "hla"
+        with self.warm_lock:
+            if target in self.warm_targets:
+                return
+            self.warm_targets.add(target)
+            (version, _) = reference_cache.get_reference_key(target, self.ref_dir)
+            if not version:  # no local reference (yet)
+                return
+            self.log.debug(f"Alignment service: loading {target} reference version {version}...")
+            try:
+                reference_cache.get_reference_alleles(target, self.ref_dir, self.log)
+                reference_cache.get_gene_models(target, self.ref_dir, self.log)
+                reference_cache.get_sequence_index(target, self.ref_dir, self.log)
+                if os.path.isfile(os.path.join(self.ref_dir, f"{target}_kmer_index.npz")):  # else built on use
+                    reference_cache.get_kmer_index(target, self.ref_dir, self.log)
+                get_indexed_fasta(os.path.join(self.ref_dir, f"parsed{target}.fa"), self.log)
+            except Exception as E:  # jobs will load what they need themselves
+                self.log.warning(f"Alignment service could not load the {target} reference: {repr(E)}")
+
+
+# ===========================================================
+# functions:
+
+def start_service(settings, log):
+    """starts the alignment service of this process (if it is not running yet) and returns it
+    """
+    global _service
+    with _service_lock:
+        if not (_service and _service.is_alive()):
+            log.info("Starting alignment service...")
+            _service = AlignmentService(settings, log)
+            _service.start()
+    return _service
+
+
+def get_service():
+    """returns the running alignment service of this process, or None
+    """
+    service = _service
+    if service and service.is_alive():
+        return service
+    return None
+
+
+def stop_service(wait=True):
+    global _service
+    with _service_lock:
+        if _service:
+            _service.stop(wait=wait)
+        _service = None
+
+
+def warm_up(target):
+    """called by a job once it knows its target (HLA or KIR):
+    if the alignment service is running, it keeps the reference of this target in memory from now on
+    """
+    service = get_service()
+    if service:
+        service.warm_up(target)
+
+
+@contextmanager
+def run_directly():
+    """within, run_job runs the jobs of the current thread directly instead of queueing them in the service
+    (e.g., in the worker threads of a bulk upload, whose alignments should run in parallel);
+    they still use the references cached in memory by the service
+    """
+    _local.direct = True
+    try:
+        yield
+    finally:
+        _local.direct = False
+
+
+def run_job(func, *args, **kwargs):
+    """runs func(*args, **kwargs) in the alignment service if it is running, else directly;
+    returns its result or raises its exception (the service runs it as part of the caller's jobs.Job, if any)
+    """
+    service = get_service()
+    if not service or current_thread() is service.thread or getattr(_local, "direct", False):
+        return func(*args, **kwargs)
+    return service.submit(jobs.run_with_job, jobs.current_job(), func, *args, **kwargs).result()
+
+
+if __name__ == '__main__':
+    pass
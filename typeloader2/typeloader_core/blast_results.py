@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+"""
+blast_results.py
+
+reads and writes BLAST results in TypeLoader's compact tabular format:
+BLAST's commented tabular output (-outfmt 7) including the aligned sequences,
+stored as {name}.blast.tsv next to the query fasta file.
+Compared to BLAST's XML output (-outfmt 5, {name}.blast.xml), this is a fraction of the size
+and can be parsed line by line.
+
+parse() reads both formats and returns records with the attributes of Bio.Blast.Record that TypeLoader uses,
+so legacy .blast.xml files can still be processed; xml_to_tabular converts them.
+"""
+import os
+import re
+
+from Bio.Blast import NCBIXML
+
+try:
+    from . import staging
+except ImportError:
+    import staging
+
+# ===========================================================
+# parameters:
+
+TABULAR_FIELDS = ["qseqid", "qlen", "sseqid", "stitle", "slen", "qstart", "qend", "sstart", "send",
+                  "length", "score", "bitscore", "evalue", "nident", "gaps", "qseq", "sseq"]
+OUTFMT_TABULAR = "7 " + " ".join(TABULAR_FIELDS)
+TABULAR_EXTENSION = ".blast.tsv"
+XML_EXTENSION = ".blast.xml"
+
+
+# ===========================================================
+# classes:
+
+class BlastRecord:
+    """results of one query (corresponds to Bio.Blast.Record.Blast)
+    """
+    def __init__(self, query_id, query, database, query_length=None):
+        self.query_id = query_id
+        self.query = query  # definition line
+        self.database = database
+        self.query_length = query_length
+        self.alignments = []
+
+
+class BlastAlignment:
+    """hit of a query against one subject (corresponds to Bio.Blast.Record.Alignment)
+    """
+    def __init__(self, hit_id, hit_def, length):
+        self.hit_id = hit_id
+        self.hit_def = hit_def
+        self.length = length
+        self.hsps = []
+
+
+class BlastHsp:
+    """one local alignment of a hit (corresponds to Bio.Blast.Record.HSP)
+    """
+    def __init__(self, query, sbjct, query_start, query_end, sbjct_start, sbjct_end,
+                 score, bits, expect, identities, gaps):
+        self.query = query
+        self.sbjct = sbjct
+        self.match = make_midline(query, sbjct)
+        self.query_start = query_start
+        self.query_end = query_end
+        self.sbjct_start = sbjct_start
+        self.sbjct_end = sbjct_end
+        self.align_length = len(query)
+        self.score = score
+        self.bits = bits
+        self.expect = expect
+        self.identities = identities
+        self.gaps = gaps
+
+
+# ===========================================================
+# functions:
+
+def make_midline(query, sbjct):
+    """returns the match line of a nucleotide alignment as BLAST writes it ('|' for identical bases, else ' ')
+    """
+    return "".join("|" if q == s and q != "-" else " " for (q, s) in zip(query.upper(), sbjct.upper()))
+
+
+def is_tabular(blast_file):
+    """returns True if blast_file contains tabular output, False for XML output
+    """
+    with staging.open_text(blast_file) as f:  # may be an in-memory temp file (see staging.py)
+        return not f.read(100).lstrip().startswith("<")
+
+
+def get_query_fasta(blast_file):
+    """returns the path of the query fasta file belonging to a BLAST output file
+    """
+    for ext in [TABULAR_EXTENSION, XML_EXTENSION]:
+        if blast_file.endswith(ext):
+            base = blast_file[:-len(ext)]
+            if not staging.exists(base + ".fa") and staging.exists(base + ".fasta"):
+                return base + ".fasta"
+            return base + ".fa"
+    return blast_file
+
+
+def get_output_filename(input_fasta_file, tabular):
+    """returns the path of the BLAST output file for an input fasta file
+    """
+    base = re.sub(r"\.(fasta|fa)$", "", input_fasta_file)
+    return base + (TABULAR_EXTENSION if tabular else XML_EXTENSION)
+
+
+def split_header(header):
+    """returns (query ID, query definition) of a fasta header or '# Query:' line, as BLAST reports them
+    """
+    s = header.split(None, 1)
+    query_def = s[1] if len(s) > 1 else "No definition line"
+    return s[0] if s else "", query_def
+
+
+def parse_tabular(handle):
+    """streams the records of a tabular BLAST output file (see OUTFMT_TABULAR) from an open file handle
+    """
+    record = None
+    for line in handle:
+        line = line.rstrip("\r\n")
+        if line.startswith("# Query: "):
+            if record:
+                yield record
+            (query_id, query_def) = split_header(line[len("# Query: "):])
+            record = BlastRecord(query_id, query_def, "")
+        elif line.startswith("# Database: "):
+            record.database = line[len("# Database: "):]
+        elif line.startswith("#") or not line.strip():
+            continue
+        else:
+            values = dict(zip(TABULAR_FIELDS, line.split("\t")))
+            record.query_length = int(values["qlen"])
+            if not record.alignments or record.alignments[-1].hit_id != values["sseqid"]:
+                record.alignments.append(BlastAlignment(values["sseqid"], values["stitle"], int(values["slen"])))
+            hsp = BlastHsp(values["qseq"], values["sseq"],
+                           int(values["qstart"]), int(values["qend"]), int(values["sstart"]), int(values["send"]),
+                           float(values["score"]), float(values["bitscore"]), float(values["evalue"]),
+                           int(values["nident"]), int(values["gaps"]))
+            record.alignments[-1].hsps.append(hsp)
+    if record:
+        yield record
+
+
+def parse(handle):
+    """streams the records of BLAST output in tabular or XML format from an open file handle
+    """
+    start = handle.read(100)
+    handle.seek(0)
+    if start.lstrip().startswith("<"):
+        return NCBIXML.parse(handle)
+    return parse_tabular(handle)
+
+
+def read_database(blast_file):
+    """returns the BLAST database a BLAST output file (tabular or XML) was created with
+    """
+    with staging.open_text(blast_file) as f:
+        head = f.read(4096)
+    match = re.search(r"<BlastOutput_db>(.*?)</BlastOutput_db>", head) or \
+        re.search(r"^# Database: (.*?)$", head, re.MULTILINE)
+    return match.group(1) if match else None
+
+
+def write_tabular(records, handle):
+    """writes BLAST records (e.g., parsed from XML output) to handle in tabular format
+    """
+    n = 0
+    for record in records:
+        handle.write("# BLASTN\n")
+        query_header = record.query_id
+        if record.query and record.query != "No definition line":
+            query_header += " " + record.query
+        handle.write(f"# Query: {query_header}\n")
+        handle.write(f"# Database: {record.database}\n")
+        rows = []
+        for alignment in record.alignments:
+            for hsp in alignment.hsps:
+                rows.append([record.query_id, record.query_length, alignment.hit_id, alignment.hit_def,
+                             alignment.length, hsp.query_start, hsp.query_end, hsp.sbjct_start, hsp.sbjct_end,
+                             hsp.align_length, int(hsp.score), hsp.bits, hsp.expect, hsp.identities or 0, hsp.gaps or 0,
+                             hsp.query, hsp.sbjct])
+        if rows:
+            handle.write(f"# Fields: {', '.join(TABULAR_FIELDS)}\n")
+        handle.write(f"# {len(rows)} hits found\n")
+        for row in rows:
+            handle.write("\t".join(str(value) for value in row) + "\n")
+        n += 1
+    handle.write(f"# BLAST processed {n} queries\n")
+
+
+def xml_to_tabular(xml_file, tabular_file=None):
+    """converts a legacy BLAST XML output file into tabular format, returns the path of the tabular file
+    """
+    if not tabular_file:
+        tabular_file = get_output_filename(get_query_fasta(xml_file), tabular=True)
+    with open(xml_file) as f, open(tabular_file, "w") as g:
+        write_tabular(NCBIXML.parse(f), g)
+    return tabular_file
+
+
+def split_tabular(blast_output):
+    """splits tabular BLAST output of several queries into dict {query ID: text block of this query}
+    """
+    blocks = {}
+    for match in re.finditer(r"^# Query: .*?(?=^# BLASTN|^# BLAST processed|\Z)", blast_output,
+                             re.MULTILINE | re.DOTALL):
+        block = match.group()
+        blocks[split_header(block.split("\n", 1)[0][len("# Query: "):])[0]] = block
+    return blocks
+
+
+def join_tabular(blocks, headers):
+    """creates tabular BLAST output from the text blocks of some queries (see split_tabular),
+    with query IDs and definitions reset to those of the given fasta headers
+    """
+    text = ""
+    for (block, header) in zip(blocks, headers):
+        (old_header, rest) = block.split("\n", 1)
+        old_id = split_header(old_header[len("# Query: "):])[0]
+        rest = re.sub(f"^{re.escape(old_id)}\t", lambda _: split_header(header)[0] + "\t", rest, flags=re.MULTILINE)
+        text += f"# BLASTN\n# Query: {header}\n{rest}"
+    return text + f"# BLAST processed {len(blocks)} queries\n"
+
+
+def remove_queries(blast_file, query_name, output_file):
+    """writes tabular BLAST output without the records of queries whose header contains query_name
+    """
+    blocks = split_tabular(staging.read_text(blast_file))
+    kept = [block for block in blocks.values() if query_name not in block.split("\n", 1)[0]]
+    with staging.open_for_writing(output_file, staging.is_staged(blast_file)) as g:
+        g.write(join_tabular(kept, [block.split("\n", 1)[0][len("# Query: "):] for block in kept]))
+
+
+if __name__ == '__main__':
+    pass
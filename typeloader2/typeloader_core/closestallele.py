@@ -9,28 +9,57 @@ This routine makes the following assumptions :
     3. The GenDX generated file will have 2 sequences, only 1 of them is assumed to be not present in the database
 """
 
-from Bio.Blast import NCBIXML
 from Bio import SeqIO
 from Bio import Align
+from Bio.Seq import Seq
 import os
 import re
 
 try:
     from . import errors
+    from .fasta_index import get_indexed_fasta
+    from . import result_cache, blast_results, timing, staging
 except ImportError:
     import errors
+    from fasta_index import get_indexed_fasta
+    import result_cache
+    import blast_results
+    import timing
+    import staging
 
 
 ###################################################
 
+ANCHOR_LENGTH = 20  # bp of exact match within the HSP the banded alignment is anchored to
+BAND_WIDTH = 100  # bp the banded alignment may deviate from the HSP's diagonal
+MAX_JUNCTION_BP = 10  # max. bp besides an InDel between two chained HSPs
+CANDIDATES = 3  # default number of BLAST hits evaluated as closest allele (setting 'closest_allele_candidates')
+
+###################################################
 
-def get_closest_known_alleles(blast_xml_filename, target_family, settings, log):
-    with open(blast_xml_filename) as xmlHandle:
-        xmlParser = NCBIXML.parse(xmlHandle)
 
-        # get the associated fasta file
-        query_fasta_file = blast_xml_filename.replace("blast.xml", "fa")
-        closestAllelesData = parse_blast(xmlParser, target_family, query_fasta_file, settings, log)
+@timing.timed
+def get_closest_known_alleles(blast_xml_filename, target_family, settings, log, reference_dir=None):
+    # get the associated fasta file
+    query_fasta_file = blast_results.get_query_fasta(blast_xml_filename)
+    cache = result_cache.get_result_cache(settings)
+    if cache:
+        (query_ids, query_key) = result_cache.get_query_key(blast_xml_filename, query_fasta_file)
+        cache_key = query_key + (target_family, os.path.abspath(reference_dir) if reference_dir else None,
+                                 get_candidate_number(settings))
+        cached = cache.get("closest_alleles", cache_key, log)
+        if cached is not None:
+            return result_cache.from_positions(cached, query_ids)
+
+    with staging.open_text(blast_xml_filename) as blastHandle:  # may be an in-memory temp file
+        blastParser = blast_results.parse(blastHandle)  # tabular or XML
+        closestAllelesData = parse_blast(blastParser, target_family, query_fasta_file, settings, log,
+                                         reference_dir=reference_dir)
+
+    if cache:
+        positions = result_cache.to_positions(closestAllelesData, query_ids)
+        if positions is not None:
+            cache.put("closest_alleles", cache_key, positions, log)
     return closestAllelesData
 
 
@@ -46,8 +75,12 @@ def print_hsp(hsp_query, hsp_subject, hsp_match, concat_HSPs, hsp_start, hsp_ali
     print("query_length: ", query_length)
 
 
-def parse_blast(xml_records, target_family, query_fasta_file, settings, log):
+def parse_blast(blast_records, target_family, query_fasta_file, settings, log, reference_dir=None):
     """
+    blast_records: records of BLAST's XML output or TypeLoader's tabular format (see blast_results.parse)
+    reference_dir: directory containing the parsed reference fasta files;
+    if not given, the current local reference is used
+
     Basic description of the XML below
     For more details on parsing the BLAST XML output:
      see http://biopython.org/DIST/docs/tutorial/Tutorial.html#sec:parsing-blast
@@ -59,62 +92,54 @@ def parse_blast(xml_records, target_family, query_fasta_file, settings, log):
 
     closestAlleles = {}
     hsp_start = 1
-    for xmlRecord in xml_records:
-        queryId = xmlRecord.query_id
-        output_db = xmlRecord.database
-        if output_db.endswith("parsedKIR.fa"):
-            output_db = os.path.join(settings["dat_path"], settings["general_dir"], settings["reference_dir"],
-                                     "parsedKIR.fa")
-        elif output_db.endswith("parsedhla.fa"):
-            output_db = os.path.join(settings["dat_path"], settings["general_dir"], settings["reference_dir"],
-                                     "parsedhla.fa")
+    n_candidates = get_candidate_number(settings)
+    with staging.open_text(query_fasta_file) as f:
+        query_sequences = SeqIO.to_dict(SeqIO.parse(f, "fasta"))
+    if not reference_dir:
+        reference_dir = os.path.join(settings["dat_path"], settings["general_dir"], settings["reference_dir"])
+    for blastRecord in blast_records:
+        queryId = blastRecord.query_id
+        output_db = blastRecord.database
+        db_match = re.search(r"parsed(KIR|hla)(_[^/\\]+)?\.fa$", output_db)  # full reference or locus partition
+        if db_match:
+            output_db = os.path.join(reference_dir, f"parsed{db_match.group(1)}.fa")
         else:
             log.error("Unknown reference file (in closestallele.py):", output_db)
-        alignments = xmlRecord.alignments
-        queryLength = xmlRecord.query_length
+        alignments = blastRecord.alignments
+        queryLength = blastRecord.query_length
         if not alignments:
             log.error("No alignments found: probably not a supported locus!")
             raise ValueError(
                 "No fitting result found in reference. Maybe this allele belongs to a gene not supported by TypeLoader?")
 
-        potentialClosestAlleleAlignment = alignments[0]
-        hsps = potentialClosestAlleleAlignment.hsps
-
-        closestAlleleName = potentialClosestAlleleAlignment.hit_def
-        if closestAlleleName.find(target_family) == -1:
-            if closestAlleleName.startswith("MIC") and target_family == "HLA":
-                pass
-            else:
-                closestAlleleName = potentialClosestAlleleAlignment.hit_id
-
-        try:
-            ref_sequence = SeqIO.to_dict(SeqIO.parse(output_db, "fasta"))[closestAlleleName].seq
-        except KeyError:
-            local_name = os.path.splitext(os.path.basename(query_fasta_file))[0]
-            msg = f"Could not find {closestAlleleName} in current reference db!\n" \
-                  f"This was originally assigned as closest allele to {local_name}. \n\n" \
-                  f"Maybe the reference db version changed since ENA submission?\n\n" \
-                  f"Please consult the user manual under 'Error: database changed between submissions' " \
-                  f"for instructions how to proceed from here."
-            raise KeyError(msg)
-        query_sequence = SeqIO.to_dict(SeqIO.parse(query_fasta_file, "fasta"))[queryId].seq
-        results = puzzle_HSPs_from_first_hit(hsps, ref_sequence, query_sequence, query_fasta_file)
-        hsp_query, hsp_subject, hsp_match, concatHSPS, hsp_start, hsp_align_len = results
-        query_start_overhang = 0
-
-        #print_hsp(hsp_query, hsp_subject, hsp_match, concatHSPS, hsp_start, hsp_align_len, queryLength)
-        if hsp_query == "" and hsp_subject == "" and hsp_match == "":
-            closestAlleles[queryId] = None
+        query_sequence = query_sequences[queryId].seq
+        candidates = []
+        for (i, alignment) in enumerate(alignments[:n_candidates]):
+            closestAlleleName = get_hit_name(alignment, target_family)
+            try:
+                ref_sequence = Seq(get_indexed_fasta(output_db, log).fetch(closestAlleleName))
+            except KeyError:
+                if i > 0:  # only the best hit is required
+                    log.warning(f"Could not find {closestAlleleName} in current reference db, skipping candidate")
+                    continue
+                local_name = os.path.splitext(os.path.basename(query_fasta_file))[0]
+                msg = f"Could not find {closestAlleleName} in current reference db!\n" \
+                      f"This was originally assigned as closest allele to {local_name}. \n\n" \
+                      f"Maybe the reference db version changed since ENA submission?\n\n" \
+                      f"Please consult the user manual under 'Error: database changed between submissions' " \
+                      f"for instructions how to proceed from here."
+                raise KeyError(msg)
+            candidates.append((alignment.hsps, closestAlleleName, ref_sequence))
+
+        if len(candidates) == 1:
+            (hsps, closestAlleleName, ref_sequence) = candidates[0]
+            closestAlleles[queryId] = evaluate_hit(hsps, closestAlleleName, ref_sequence, query_sequence,
+                                                   queryLength, query_fasta_file, log)
         else:
-            if hsp_align_len < queryLength:  # incomplete alignment:
-                log.warning("Sequence did not align fully! Probably a mismatch within 3 bp of either sequence end!")
-                results = fix_incomplete_alignment(ref_sequence, query_sequence, hsp_start, hsp_align_len, queryLength,
-                                                   hsp_query, hsp_subject, hsp_match, closestAlleleName, log)
-                (hsp_query, hsp_subject, hsp_match, hsp_align_len, hsp_start, query_start_overhang) = results
-                log.debug("fix_incomplete_alignment finished")
-            closestAlleles[queryId] = closest_allele_items(hsp_query, hsp_subject, hsp_match, closestAlleleName,
-                                                           concatHSPS,
-                                                           hsp_start, hsp_align_len, queryLength, query_start_overhang)
+            closestAlleles[queryId] = evaluate_candidates(candidates, query_sequence, queryLength, query_fasta_file,
+                                                          log)
+        if closestAlleles[queryId]:
+            hsp_start = closestAlleles[queryId]["hitStart"]
 
     if hsp_start != 1:
         log.warning("Incomplete sequence found: first {} bp missing!".format(hsp_start - 1))
@@ -122,6 +147,113 @@ def parse_blast(xml_records, target_family, query_fasta_file, settings, log):
     return closestAlleles
 
 
+def get_candidate_number(settings):
+    """returns how many of the best BLAST hits are evaluated as closest allele (setting 'closest_allele_candidates')
+    """
+    try:
+        return max(1, int((settings or {}).get("closest_allele_candidates", CANDIDATES)))
+    except (TypeError, ValueError):
+        return CANDIDATES
+
+
+def get_hit_name(alignment, target_family):
+    """returns the allele name of a BLAST hit
+    """
+    name = alignment.hit_def
+    if name.find(target_family) == -1:
+        if name.startswith("MIC") and target_family == "HLA":
+            pass
+        else:
+            name = alignment.hit_id
+    return name
+
+
+def evaluate_hit(hsps, closest_allele_name, ref_sequence, query_sequence, query_length, query_fasta_file, log):
+    """aligns the query to the reference sequence of one BLAST hit,
+    returns the closest allele items (see closest_allele_items) or None if the hit has no usable HSPs
+    """
+    results = puzzle_HSPs_from_first_hit(hsps, ref_sequence, query_sequence, query_fasta_file)
+    hsp_query, hsp_subject, hsp_match, concatHSPS, hsp_start, hsp_align_len = results
+    query_start_overhang = 0
+
+    #print_hsp(hsp_query, hsp_subject, hsp_match, concatHSPS, hsp_start, hsp_align_len, query_length)
+    if hsp_query == "" and hsp_subject == "" and hsp_match == "":
+        return None
+
+    query_aligned_len = len(hsp_query.replace("-", ""))
+    # incomplete alignment (for chained HSPs, long deletions can hide missing query ends):
+    if hsp_align_len < query_length or (concatHSPS and query_aligned_len < query_length):
+        log.warning("Sequence did not align fully! Probably a mismatch within 3 bp of either sequence end!")
+        results = fix_incomplete_alignment(ref_sequence, query_sequence, hsp_start, hsp_align_len, query_length,
+                                           hsp_query, hsp_subject, hsp_match, closest_allele_name, log)
+        (hsp_query, hsp_subject, hsp_match, hsp_align_len, hsp_start, query_start_overhang) = results
+        log.debug("fix_incomplete_alignment finished")
+    return closest_allele_items(hsp_query, hsp_subject, hsp_match, closest_allele_name, concatHSPS,
+                                hsp_start, hsp_align_len, query_length, query_start_overhang)
+
+
+def try_hit(hsps, closest_allele_name, ref_sequence, query_sequence, query_length, query_fasta_file, log):
+    """runs evaluate_hit for one candidate;
+    returns (closest allele items or None, error message or None, exception raised or None)
+    """
+    try:
+        items = evaluate_hit(hsps, closest_allele_name, ref_sequence, query_sequence, query_length,
+                             query_fasta_file, log)
+        return items, None if items else "no usable alignment", None
+    except errors.DevianceError as E:
+        return None, E.msg, E
+    except Exception as E:
+        return None, repr(E), E
+
+
+def count_differences(closest_allele):
+    """returns the number of mismatched, inserted and deleted bp between a query and its closest allele
+    """
+    differences = closest_allele["differences"]
+    return sum(len(differences[key]) for key in ["mismatchPositions", "insertionPositions", "deletionPositions"])
+
+
+def evaluate_candidates(candidates, query_sequence, query_length, query_fasta_file, log):
+    """evaluates several BLAST hits [(hsps, allele name, reference sequence)] as closest allele,
+    so ties between hits do not need to be resolved by hand with a restricted reference;
+
+    each candidate costs as much as the best hit alone: milliseconds if its HSPs cover the query,
+    else fix_incomplete_alignment, which takes 3-5 s per KIR candidate if it has to fall back to
+    the global alignment of the full sequences. The candidates are evaluated one after the other
+    (a process pool per query costs more than it saves for most queries and would be nested within
+    the worker processes of bulk uploads), so N candidates can take up to N times as long as the best hit.
+
+    returns the closest allele items of the candidate with the fewest differences to the query
+    (ties are broken by BLAST's ranking), with the ranked list of all candidates stored under "candidates"
+    as [{"name": allele name, "differences": number of differences or None, "error": error message or None,
+    "closestAllele": closest allele items of the candidate or None}] (annotated by coordinates.processAlleles);
+    if no candidate can be aligned, the error of the best BLAST hit is raised
+    """
+    log.info(f"Evaluating {len(candidates)} candidates for the closest allele...")
+    results = [try_hit(hsps, name, ref_sequence, query_sequence, query_length, query_fasta_file, log)
+               for (hsps, name, ref_sequence) in candidates]
+
+    ranking = sorted(range(len(candidates)),
+                     key=lambda i: (results[i][0] is None, count_differences(results[i][0]) if results[i][0] else 0, i))
+    ranked = []
+    for i in ranking:
+        (items, error, _) = results[i]
+        ranked.append({"name": candidates[i][1], "differences": count_differences(items) if items else None,
+                       "error": error, "closestAllele": items})
+        log.debug(f"\t{candidates[i][1]}: " + (f"{ranked[-1]['differences']} differences" if items
+                                               else f"failed ({error})"))
+
+    (best_items, _, _) = results[ranking[0]]
+    if not best_items:  # no candidate worked: raise the problem of the best hit
+        (_, _, exception) = results[0]
+        if exception:
+            raise exception
+        return None
+    best_items = dict(best_items, candidates=ranked)
+    log.info(f"=> {best_items['name']} chosen as closest allele ({ranked[0]['differences']} differences)")
+    return best_items
+
+
 def make_global_alignment(ref_seq, query_seq, log):
     """
     performs global alignment of the two sequences via Biopython and returns list of alignment objects
@@ -143,6 +275,36 @@ def make_global_alignment(ref_seq, query_seq, log):
     return alignments
 
 
+def make_banded_alignment(ref_seq, query_seq, hsp_start, hsp_query, hsp_subject, hsp_match, log):
+    """
+    performs the global alignment of make_global_alignment only for the start of the query,
+    up to the first exact match of ANCHOR_LENGTH bp within the HSP, against a window of the reference
+    reaching at most BAND_WIDTH bp beyond the HSP's diagonal (fix_incomplete_alignment only needs the alignment start);
+    returns (alignments, offset of the reference window),
+    or (None, 0) if no anchor is found or the alignment reaches the border of the band;
+
+    an alignment leaving the band needs more than BAND_WIDTH deleted bp, so it scores at most
+    (match score * aligned query length + score of a BAND_WIDTH + 1 bp deletion);
+    if the banded alignment scores lower, a better alignment might exist outside the band (None, 0 is returned)
+    """
+    anchor_col = hsp_match.find("|" * ANCHOR_LENGTH)
+    hsp_query_start = str(query_seq).find(hsp_query.replace("-", ""))
+    if anchor_col == -1 or hsp_query_start == -1:
+        return None, 0
+    ref_end = hsp_start - 1 + len(hsp_subject[:anchor_col].replace("-", "")) + ANCHOR_LENGTH
+    query_end = hsp_query_start + len(hsp_query[:anchor_col].replace("-", "")) + ANCHOR_LENGTH
+    ref_offset = max(0, ref_end - query_end - BAND_WIDTH)
+
+    alignments = make_global_alignment(ref_seq[ref_offset:ref_end], query_seq[:query_end], log)
+    a = alignments[0]
+    out_of_band_score = 2 * query_end - 5 - 2 * BAND_WIDTH  # scores of make_global_alignment
+    if (ref_offset and (a.aligned[0][0][0] == 0 or a.score < out_of_band_score)) \
+            or a.aligned[0][-1][1] != ref_end - ref_offset or a.aligned[1][-1][1] != query_end:
+        log.debug("\t=> banded alignment reached the border of its band")
+        return None, 0
+    return alignments, ref_offset
+
+
 def remove_end_gaps(ref, matched, query):
     """
     removes end gaps ('-'-characters on the right side) from an alignment incl. its sequences
@@ -157,7 +319,11 @@ def remove_end_gaps(ref, matched, query):
 
 def fix_incomplete_alignment(ref_seq, query_seq, hsp_start, hsp_align_len, query_length,
                              hsp_query, hsp_subject, hsp_match, closest_allele_name, log):
-    alignments = make_global_alignment(ref_seq, query_seq, log)
+    alignments, ref_offset = make_banded_alignment(ref_seq, query_seq, hsp_start, hsp_query, hsp_subject, hsp_match,
+                                                   log)
+    if alignments is None:
+        log.debug("\t=> falling back to alignment of the full sequences")
+        alignments = make_global_alignment(ref_seq, query_seq, log)
     log.debug(f"=> found {len(alignments)} alignments")
     if not alignments:
         log.error("No alignment found, sorry! Aborting...")
@@ -170,7 +336,7 @@ def fix_incomplete_alignment(ref_seq, query_seq, hsp_start, hsp_align_len, query
     log.info("Adding info from global alignment to local alignment...")
     # find alignment positions:
     aligned_query = a.aligned[0]
-    q_start = aligned_query[0][0]
+    q_start = aligned_query[0][0] + ref_offset
     query_start_overhang = a.aligned[1][0][0]  # relevant if query has longer 5' UTR than reference
 
     # fix alignments:
@@ -327,224 +493,135 @@ def closest_allele_items(hsp_query, hsp_subject, hsp_match, closest_allele_name,
     return closestAllele
 
 
-def puzzle_HSPs_from_first_hit(hsps, ref_sequence, query_sequence, query_fasta_file):
-    # TODO: (future) Validation of HSP puzzle, until that, take first HSP
-    potentialClosestHSP = hsps[0]
-    hsp_query = potentialClosestHSP.query
-    hsp_subject = potentialClosestHSP.sbjct
-    hsp_match = potentialClosestHSP.match
-    hsp_start = potentialClosestHSP.sbjct_start
-    hsp_align_len = potentialClosestHSP.align_length
-
-    concatHSPS = False
-
+def is_collinear(hsp1, hsp2):
+    """returns True if hsp2 lies behind hsp1 (on the plus strand) in both query and subject;
+    the HSPs may overlap, but hsp2 must extend beyond hsp1 at both ends
     """
+    for hsp in [hsp1, hsp2]:
+        if hsp.query_start > hsp.query_end or hsp.sbjct_start > hsp.sbjct_end:
+            return False
+    return hsp1.query_start < hsp2.query_start and hsp1.query_end < hsp2.query_end \
+        and hsp1.sbjct_start < hsp2.sbjct_start and hsp1.sbjct_end < hsp2.sbjct_end
 
-    1. Iterate through each hsp in the first hit
-    2. possible cuts (X):
-
-        a:              |========|
-                             XXXX
-                            |============|
-            result:              |=======|
-
-        b:                      |========|
-                                 XXXX
-                        |============|
-            result:     |=======|
-
-        c:              |============|          |============|
-                                 XXXX            XXXX
-                                |====================|
-            result:                  |==========|
-
-    3. every other possibility will be ignored
 
+def can_follow(hsp1, hsp2):
+    """returns True if hsp2 can be chained behind hsp1:
+    collinear, and the sequence between them is a (possibly large) InDel with at most MAX_JUNCTION_BP other bases
     """
-
-    """
-
-    hspMap = {}
-    bool_sequence = [0] * len(ref_sequence)
-
-    for hsp in hsps:
-
-        overlap_beginning_start = 0
-        overlap_beginning_end = 0
-        overlap_beginning_end_marker = -1
-        overlap_zeros_before = False
-        overlap_break = 0
-        hsp_break = False
-
-        for run in range(hsp.sbjct_start - 1, hsp.sbjct_end):
-            overlap_break += 1
-            if bool_sequence[run] == 1:
-                # it's an overlap
-
-                # case a:
-                if hsp.sbjct_start - 1 + overlap_beginning_start == run: overlap_beginning_start += 1
-
-                # case b:
-                if hsp.sbjct_start - 1 + overlap_break - 1 == run and overlap_zeros_before:
-                    if overlap_beginning_end_marker == -1: overlap_beginning_end_marker = overlap_break - 1
-                    if overlap_beginning_end_marker + overlap_beginning_end != run: break
-                    overlap_beginning_end += 1
-            else:
-                # no overlap
-                if overlap_beginning_start > 0 and overlap_beginning_end > 0:
-                    # case c:
-                    hsp_break = True
-                    break
-                bool_sequence[run] = 1
-                overlap_zeros_before = True
-
-        # break if:
-        #   1: if query is a completely overlap
-        #   2: query is not one of the cutting cases
-        if overlap_beginning_start == hsp.sbjct_end - hsp.sbjct_start + 1 or hsp_break: break
-
-        # next: add query to hspMap:
-        save_sbjct_start = hsp.sbjct_start + overlap_beginning_start
-        save_sbjct_end = hsp.sbjct_start + overlap_break - overlap_beginning_end - 1
-        save_sbjct = hsp.sbjct[overlap_beginning_start:overlap_break - overlap_beginning_end]
-
-        save_query_start = hsp.query_start + overlap_beginning_start
-        save_query_end = hsp.query_start + overlap_break - overlap_beginning_end - 1
-        save_query = hsp.query[overlap_beginning_start:overlap_break - overlap_beginning_end]
-
-        save_mismatch = hsp.match[overlap_beginning_start:overlap_break - overlap_beginning_end]
-
-        print "save_sbjct_start ", save_sbjct_start, "real_start ", hsp.sbjct_start
-        print "save_sbjct_end ", save_sbjct_end, "real_end ", hsp.sbjct_end
-        print "save_query_start", save_query_start, "real_start ", hsp.query_start
-        print "save_query_end ", save_query_end, "real_end ", hsp.query_end
-        print "overlap_beginning_start " , overlap_beginning_start
-        print "overlap_beginning_end " , overlap_beginning_end
-        print "overlap_break " , overlap_break
-        print "hsp_break ", hsp_break
-        #print "\n\n"
-
-        hspMap[save_sbjct_start] = [save_sbjct_start, save_sbjct_end, save_sbjct, save_query_start, save_query_end, save_query, save_mismatch]
-
-    hsp_query = ""
-    hsp_subject = ""
-    hsp_match = ""
-    iter_step = 1
-
-    concatHSPS = True if len(hspMap) > 1 else False
-    if concatHSPS: EF.write_log(err_file, "WARNING", "Used more than 1 HSP in BLAST algorithm by using " + query_fasta_file)
-
-    # return empty string, if subject not start at position 1
-    # otherwise: wrong positions!
-    if bool_sequence[0] == 0:
-        return (hsp_query, hsp_subject, hsp_match, concatHSPS)
+    if not is_collinear(hsp1, hsp2):
+        return False
+    query_gap = hsp2.query_start - hsp1.query_end - 1
+    sbjct_gap = hsp2.sbjct_start - hsp1.sbjct_end - 1
+    return min(query_gap, sbjct_gap) <= MAX_JUNCTION_BP
+
+
+def chain_HSPs(hsps):
+    """chains the HSPs of a hit that can be joined with the first (= best) HSP into one alignment
+    (large InDels split an alignment into several HSPs);
+    HSPs are added by score, each one only between two chained HSPs it can follow and precede;
+    returns the chained HSPs sorted by position
     """
-
-    """
-    hspMap_Keys:
-        0 = subject start
-        1 = subject end
-        2 = subject nucleotides
-        3 = query start
-        4 = query end
-        5 = query nucleotides
-        6 = mismatch signs
+    chain = [hsps[0]]
+    for hsp in hsps[1:]:
+        i = 0  # position of hsp in the chain (sorted by query position)
+        while i < len(chain) and chain[i].query_start < hsp.query_start:
+            i += 1
+        if i > 0 and not can_follow(chain[i - 1], hsp):
+            continue
+        if i < len(chain) and not can_follow(hsp, chain[i]):
+            continue
+        chain.insert(i, hsp)
+    return chain
+
+
+def get_junction_aligner():
+    """returns a global aligner with the scores of make_global_alignment for the bases between two chained HSPs
+    (both ends of a junction are anchored by HSPs, so end gaps are scored like internal gaps)
     """
+    aligner = Align.PairwiseAligner()
+    aligner.mode = "global"
+    aligner.match_score = 2
+    aligner.mismatch_score = -3
+    aligner.open_gap_score = -5
+    aligner.extend_gap_score = -2
+    return aligner
 
-    """
-    for key in sorted(hspMap.iterkeys()):
-
-        if iter_step == 1:
-
-            # first iteration
-            hsp_subject = hspMap[key][2]
-            hsp_query = hspMap[key][5]
-            hsp_match = hspMap[key][6]
-
-        else:
 
-            #print "last: " , "subS: ", hspMap[last_key][0], "subE: " ,hspMap[last_key][1], "querS: ", hspMap[last_key][3], "querE: ", hspMap[last_key][4]
-            #print "now: " , "subS: ", hspMap[key][0], "subE: ", hspMap[key][1], "querS: ", hspMap[key][3], "querE: ", hspMap[key][4]
-
-            if hspMap[last_key][4] >= hspMap[key][3]:
-
-                #print "overlap deletion"
-                hsp_starting_point = 1
-                diff = hspMap[last_key][4]-hspMap[key][3]
-                deleted_nucleotides = ref_sequence[hspMap[last_key][1]-diff:hspMap[key][0]]
-                inserted_nucleotides = ""
-
-            elif hspMap[last_key][1] >= hspMap[key][0]:
-
-                #print "overlap insertion"
-                hsp_starting_point = 1
-                diff = hspMap[last_key][1] - hspMap[key][0]
-                inserted_nucleotides = query_sequence[hspMap[last_key][4]:hspMap[key][3]]
-                deleted_nucleotides = ""
-
-            else:
-
-                #print "no overlapping"
-                hsp_starting_point = 0
-                diff = 0
-                deleted_nucleotides = ref_sequence[hspMap[last_key][1]:hspMap[key][0] - 1]
-                inserted_nucleotides = query_sequence[hspMap[last_key][4]:hspMap[key][3] - 1]
-
-            #print diff
-            #print hsp_query
-            hsp_subject = hsp_subject[0:len(hsp_subject)-diff]
-            hsp_query = hsp_query[0:len(hsp_query)-diff]
-            hsp_match = hsp_match[0:len(hsp_match)-diff]
-            #print hsp_query
-
-            new_subject = hspMap[key][2][hsp_starting_point:len(hspMap[key][2])]
-            new_query = hspMap[key][5][hsp_starting_point:len(hspMap[key][5])]
-            new_match = hspMap[key][6][hsp_starting_point:len(hspMap[key][6])]
-
-            number_deletions = len(deleted_nucleotides)
-            number_insertions = len(inserted_nucleotides)
-
-            #print "number_deletions: ", number_deletions
-            #print "deleted: ", deleted_nucleotides
-            #print "number_insertions: ", number_insertions
-            #print "insertions: ", inserted_nucleotides
-
-            # deletion --> see query
-            #hsp_query = hsp_query + "\n" + inserted_nucleotides + "\n" + "".join(["-"]*number_deletions) + "\n" + new_query
-            # insertions --> see subject
-            #hsp_subject = hsp_subject + "\n" + "".join(["-"]*number_insertions) + "\n" + deleted_nucleotides + "\n" + new_subject
-            # mismatches --> see match
-            #hsp_match = hsp_match + "\n" + "".join(["X"]*number_insertions) + "\n" + "".join(["X"]*number_deletions) + "\n" + new_match
-
-            # deletion --> see query
-            hsp_query = hsp_query + inserted_nucleotides + "".join(["-"]*number_deletions) + new_query
-            # insertions --> see subject
-            hsp_subject = hsp_subject + "".join(["-"]*number_insertions) + deleted_nucleotides + new_subject
-            # mismatches --> see match
-            hsp_match = hsp_match + "".join(["X"]*number_insertions) + "".join(["X"]*number_deletions) + new_match
-
-        iter_step += 1
-        last_key = key
+def align_junction(query_gap, sbjct_gap):
+    """aligns the bases between two chained HSPs (at most MAX_JUNCTION_BP bp plus an InDel),
+    returns (query, subject, match) strings
     """
-
+    if not query_gap or not sbjct_gap:  # pure InDel
+        return query_gap + "-" * len(sbjct_gap), sbjct_gap + "-" * len(query_gap), \
+            " " * max(len(query_gap), len(sbjct_gap))
+    a = get_junction_aligner().align(sbjct_gap, query_gap)[0]
+    (sbjct_aligned, query_aligned) = (a[0], a[1])
+    match = "".join("|" if q == s else " " for (q, s) in zip(query_aligned, sbjct_aligned))
+    return query_aligned, sbjct_aligned, match
+
+
+def join_HSPs(chain, ref_sequence, query_sequence):
+    """joins chained HSPs into one alignment, returns (query, subject, match) strings;
+    overlaps are removed from the later HSP; the bases between the last MAX_JUNCTION_BP exact matches
+    before a junction and the first MAX_JUNCTION_BP exact matches behind it are aligned by align_junction
+    (so the InDel's placement does not depend on how far BLAST extended either HSP)
     """
-    curr_file = str.split(ntpath.basename(query_fasta_file), ".")[0]
-    filename = "/home/markus/playground/report/Validation_ClosestAllele/output/" + curr_file + ".query.txt"
-    filebuff = open(filename,'w')
-    filebuff.write(str(hsp_query))
-    filebuff.close()
-
-    filename = "/home/markus/playground/report/Validation_ClosestAllele/output/" + curr_file + ".sbjct.txt"
-    filebuff = open(filename,'w')
-    filebuff.write(str(hsp_subject))
-    filebuff.close()
-
-    filename = "/home/markus/playground/report/Validation_ClosestAllele/output/" + curr_file + ".mismatch.txt"
-    filebuff = open(filename,'w')
-    filebuff.write(str(hsp_match))
-    filebuff.close()
+    anchor = "|" * MAX_JUNCTION_BP
+    first = chain[0]
+    (hsp_query, hsp_subject, hsp_match) = (first.query, first.sbjct, first.match)
+    (query_end, sbjct_end) = (first.query_end, first.sbjct_end)  # last positions aligned so far (1-based)
+    last_start = 0  # column where the last joined HSP starts
+    for hsp in chain[1:]:
+        # go back to the end of the last anchor of the previous HSP:
+        anchor_end = hsp_match.rfind(anchor, last_start)
+        if anchor_end != -1 and anchor_end + MAX_JUNCTION_BP < len(hsp_match):
+            anchor_end += MAX_JUNCTION_BP
+            query_end -= len(hsp_query[anchor_end:].replace("-", ""))
+            sbjct_end -= len(hsp_subject[anchor_end:].replace("-", ""))
+            (hsp_query, hsp_subject, hsp_match) = (hsp_query[:anchor_end], hsp_subject[:anchor_end],
+                                                   hsp_match[:anchor_end])
+
+        # skip overlap (and leading gaps after it):
+        (col, query_pos, sbjct_pos) = (0, hsp.query_start, hsp.sbjct_start)
+        while query_pos <= query_end or sbjct_pos <= sbjct_end or hsp.query[col] == "-" or hsp.sbjct[col] == "-":
+            if hsp.query[col] != "-":
+                query_pos += 1
+            if hsp.sbjct[col] != "-":
+                sbjct_pos += 1
+            col += 1
+
+        # skip to the first anchor of this HSP:
+        anchor_start = hsp.match.find(anchor, col)
+        if anchor_start != -1:
+            query_pos += len(hsp.query[col:anchor_start].replace("-", ""))
+            sbjct_pos += len(hsp.sbjct[col:anchor_start].replace("-", ""))
+            col = anchor_start
+
+        # align bases between the HSPs:
+        (query_aligned, sbjct_aligned, match) = align_junction(str(query_sequence[query_end:query_pos - 1]),
+                                                               str(ref_sequence[sbjct_end:sbjct_pos - 1]))
+        hsp_query += query_aligned
+        hsp_subject += sbjct_aligned
+        hsp_match += match
+
+        last_start = len(hsp_match)
+        hsp_query += hsp.query[col:]
+        hsp_subject += hsp.sbjct[col:]
+        hsp_match += hsp.match[col:]
+        (query_end, sbjct_end) = (hsp.query_end, hsp.sbjct_end)
+    return hsp_query, hsp_subject, hsp_match
+
+
+def puzzle_HSPs_from_first_hit(hsps, ref_sequence, query_sequence, query_fasta_file, chain=True):
+    """returns the alignment of the query with the first hit as
+    (query, subject, match, concatenated from several HSPs?, subject start, alignment length);
+    if chain is True, HSPs that continue the best HSP across InDels are joined to it (see chain_HSPs)
     """
-
+    chained = chain_HSPs(hsps) if chain else [hsps[0]]
+    (hsp_query, hsp_subject, hsp_match) = join_HSPs(chained, ref_sequence, query_sequence)
+    hsp_start = chained[0].sbjct_start
+    hsp_align_len = len(hsp_match)
+    concatHSPS = len(chained) > 1
     return hsp_query, hsp_subject, hsp_match, concatHSPS, hsp_start, hsp_align_len
 
 
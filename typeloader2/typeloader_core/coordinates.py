@@ -8,8 +8,11 @@ import re
 import os
 from Bio import SeqIO
 from collections import defaultdict
-from .closestallele import get_closest_known_alleles
-from .hla_embl_parser import read_dat_file
+from .closestallele import get_closest_known_alleles, get_candidate_number
+from .reference_cache import get_reference_alleles, get_target_from_dat_file, get_reference_key, get_gene_models
+from .hla_embl_parser import build_gene_model
+from .reference_store import get_version_alleles, get_version_fasta_dir
+from . import result_cache, blast_results, timing, staging
 from .imgtTransform import changeToImgtCoords
 from .errors import MissingUTRError, IncompleteSequenceWarning
 
@@ -156,24 +159,56 @@ def pprint_annotations(annotations):
         pprint(myannotations)
 
 
+def get_reference_for_version(target, ref_dir, db_version, log):
+    """returns (alleles, directory of the parsed reference fasta files) of the reference version db_version;
+    uses the current local reference if db_version is not given or is the current version;
+    raises a KeyError if db_version is neither the current version nor stored locally
+    (annotating against another version than the allele was uploaded with might give a different annotation)
+    """
+    if db_version and db_version != get_reference_key(target, ref_dir)[0]:
+        alleles = get_version_alleles(target, ref_dir, db_version, log)
+        if alleles is None:
+            msg = f"This allele was uploaded with {target} reference version {db_version}, " \
+                  f"which is no longer stored locally!\n\n" \
+                  f"Please consult the user manual under 'Error: database changed between submissions' " \
+                  f"for instructions how to proceed from here."
+            log.warning(msg)
+            raise KeyError(msg)
+        log.info(f"Using stored {target} reference version {db_version}")
+        return alleles, get_version_fasta_dir(target, ref_dir, db_version, log)
+    return get_reference_alleles(target, ref_dir, log), None
+
+
+@timing.timed
 def getCoordinates(blastXmlFilename, allelesFilename, targetFamily, settings, log, isENA=True,
-                   incomplete_ok=False):
+                   incomplete_ok=False, db_version=None, closest_allele=None):
+    """returns the annotations of all sequences of a BLAST output file;
+    closest_allele: annotate against this closest allele candidate instead of the best one (see chooseCandidate)
+    """
     if "restricted_db" in allelesFilename:
         allelesFilename = os.path.join(settings["root_path"], settings["general_dir"],
                                        settings["reference_dir"],
                                        os.path.basename(allelesFilename))
-    allAlleles, _ = read_dat_file(allelesFilename, targetFamily, isENA)
-    closestAlleles = get_closest_known_alleles(blastXmlFilename, targetFamily, settings, log)
-    seqsFile = blastXmlFilename.replace(".blast.xml", ".fa")
-
-    try: 
-        seqsHandle = open(seqsFile)
-    except IOError:
-        seqsFile = blastXmlFilename.replace(".blast.xml",".fasta")
-        seqsHandle = open(seqsFile)
-
+    ref_dir, target = get_target_from_dat_file(allelesFilename)
+    seqsFile = blast_results.get_query_fasta(blastXmlFilename)
+
+    cache = result_cache.get_result_cache(settings)
+    if cache:
+        (query_ids, query_key) = result_cache.get_query_key(blastXmlFilename, seqsFile)
+        cache_key = query_key + (targetFamily, target) + get_reference_key(target, ref_dir) + \
+            (db_version, incomplete_ok, get_candidate_number(settings))
+        cached = cache.get("annotations", cache_key, log)
+        if cached is not None:
+            annotations = result_cache.from_positions(cached, query_ids)
+            return chooseCandidate(annotations, closest_allele) if closest_allele else annotations
+
+    allAlleles, version_dir = get_reference_for_version(target, ref_dir, db_version, log)
+    gene_models = None if version_dir else get_gene_models(target, ref_dir, log)
+    closestAlleles = get_closest_known_alleles(blastXmlFilename, targetFamily, settings, log,
+                                               reference_dir=version_dir)
+    seqsHandle = staging.open_text(seqsFile)  # may be an in-memory temp file
     seqsHash = SeqIO.to_dict(SeqIO.parse(seqsHandle, "fasta"))
-    annotations = processAlleles(closestAlleles, allAlleles, seqsHash, incomplete_ok)
+    annotations = processAlleles(closestAlleles, allAlleles, seqsHash, incomplete_ok, gene_models)
     # for cell_line in annotations:
     #     for key in annotations[cell_line]:
     #         item = annotations[cell_line][key]
@@ -188,15 +223,14 @@ def getCoordinates(blastXmlFilename, allelesFilename, targetFamily, settings, lo
     #             else:
     #                 print("'{}' : {}".format(key, annotations[cell_line][key]))
 
-    for gendxAllele in list(annotations.keys()):
-        if not annotations[gendxAllele]:
-            continue
-        alleleSeq = str(seqsHash[gendxAllele].seq)
-        annotations[gendxAllele]["sequence"] = alleleSeq
-        annotations[gendxAllele]["imgtDifferences"]["mmCodons"] = getMismatchData(annotations[gendxAllele])
-        
     seqsHandle.close()
 
+    if cache:
+        positions = result_cache.to_positions(annotations, query_ids)
+        if positions is not None:
+            cache.put("annotations", cache_key, positions, log)
+    if closest_allele:
+        annotations = chooseCandidate(annotations, closest_allele)
     return annotations
 
 
@@ -293,112 +327,136 @@ def shift_differences_for_missing_bp(missing_bp, differences, imgtDifferences, c
     return new_differences, new_imgtDifferences
 
 
-def processAlleles(closestAlleles, allAlleles, hashOfQuerySequences, incomplete_ok = False):
+def processAlleles(closestAlleles, allAlleles, hashOfQuerySequences, incomplete_ok = False, gene_models=None):
 
     annotations = {}
     for alleleQuery in list(closestAlleles.keys()):
         if not closestAlleles[alleleQuery]:
             annotations[alleleQuery] = None
             continue
-        closestAlleleName = closestAlleles[alleleQuery]["name"]
-        differences = closestAlleles[alleleQuery]["differences"]
-        isExactMatch = closestAlleles[alleleQuery]["exactMatch"]
-        concatHSPS = closestAlleles[alleleQuery]["concatHSPS"]
-        hitStart = closestAlleles[alleleQuery]["hitStart"]
-        missing_bp = hitStart - 1
-        alignLength = closestAlleles[alleleQuery]["alignLength"]
-        queryLength = closestAlleles[alleleQuery]["queryLength"]
-        query_start_overhang = closestAlleles[alleleQuery]["queryStartOverhang"]
-
-        features, coordinates, extraInformation, closestAlleleCdsSequence, \
-            closestAlleleSequence = calculateCoordinates(closestAlleleName, allAlleles, differences,
-                                                        len(hashOfQuerySequences[alleleQuery]), missing_bp)
-        
-        coordinates = shift_coordinates_for_missing_bp(missing_bp, coordinates)
-        
-        (UTR3start, UTR3end) = coordinates[-1]
-        UTR3length = UTR3end - UTR3start + 1
+        querySequence = hashOfQuerySequences[alleleQuery]
+        annotation = annotateAllele(closestAlleles[alleleQuery], allAlleles, querySequence, incomplete_ok,
+                                    gene_models)
+        annotation["closestAlleleCandidates"] = annotateCandidates(closestAlleles[alleleQuery].get("candidates"),
+                                                                   annotation, allAlleles, querySequence,
+                                                                   incomplete_ok, gene_models)
+        annotations[alleleQuery] = annotation
 
-        if UTR3length <= 0:
-            raise MissingUTRError(3)
+    return annotations
 
-        UTR3length_orig = len(allAlleles[closestAlleleName].UTR3)
-        missing_bp_end = check_incomplete_utrs(missing_bp, UTR3length_orig, UTR3length, incomplete_ok)
 
-        coordinates, imgtDifferences_orig, cdsMap = changeToImgtCoords(features, coordinates, differences)
-        
-        differences, imgtDifferences = shift_differences_for_missing_bp(missing_bp, differences, imgtDifferences_orig,
-                                                                        closestAlleleSequence)
-        
-        annotations[alleleQuery] = {"features": features, "coordinates": coordinates,
-                                    "imgtDifferences": imgtDifferences, "differences": differences,
-                                    "closestAllele": closestAlleleName, "cdsMap": cdsMap,
-                                    "closestAlleleCdsSequence": closestAlleleCdsSequence,
-                                    "closestAlleleSequence": closestAlleleSequence, "isExactMatch": isExactMatch,
-                                    "extraInformation": extraInformation, "concatHSPS": concatHSPS,
-                                    "missing_bp": missing_bp, "missing_bp_end": missing_bp_end,
-                                    "imgtDifferences_orig": imgtDifferences_orig,
-                                    "queryLength": queryLength, "alignLength": alignLength,
-                                    "queryStartOverhang": query_start_overhang}
-        
-        
-    return annotations
+def annotateAllele(closestAllele, allAlleles, querySequence, incomplete_ok=False, gene_models=None):
+    """returns the annotation of a query sequence (SeqRecord) based on one closest allele (see closestallele.py)
+    """
+    closestAlleleName = closestAllele["name"]
+    differences = closestAllele["differences"]
+    isExactMatch = closestAllele["exactMatch"]
+    concatHSPS = closestAllele["concatHSPS"]
+    hitStart = closestAllele["hitStart"]
+    missing_bp = hitStart - 1
+    alignLength = closestAllele["alignLength"]
+    queryLength = closestAllele["queryLength"]
+    query_start_overhang = closestAllele["queryStartOverhang"]
 
-def getClosestAlleleCoordinates(alleleData, queryLength):
-
-    features = []
-    coordinates = []
-    exonIds = []
-    extraInformation = {"pseudoexon":{}, "exon_number":{}, "intron_number":{}}
-    closestAlleleCdsSequence = ""
-    closestAlleleSequence = ""
-
-    if "utr5" in alleleData.utrpos_dic:
-        features.append("utr5")
-        coordinates.append((alleleData.utrpos_dic["utr5"][0] + 1, alleleData.utrpos_dic["utr5"][1]))
-
-    for exon, pseudoexon in alleleData.pseudo_exon_dic.items():
-        extraInformation["pseudoexon"][exon] = pseudoexon
-    for exon, exon_number in alleleData.exon_num_dic.items():
-        extraInformation["exon_number"][exon] = exon_number
-    for intron, intron_number in alleleData.intron_num_dic.items():
-        extraInformation["intron_number"][intron] = intron_number
-
-    #exonIds = [(exonNumber,"e") for exonNumber in alleleData.exonpos_dic.keys()]
-    for exonNumber in list(alleleData.exonpos_dic.keys()):
-        if extraInformation["pseudoexon"][exonNumber]:
-            exonIds.append((exonNumber, "epseudo"))
-        else:
-            exonIds.append((exonNumber, "e"))
+    features, coordinates, extraInformation, closestAlleleCdsSequence, \
+        closestAlleleSequence = calculateCoordinates(closestAlleleName, allAlleles, differences,
+                                                    len(querySequence), missing_bp, gene_models)
 
-    intronIds = [(intronNumber, "i") for intronNumber in list(alleleData.intronpos_dic.keys())]
+    coordinates = shift_coordinates_for_missing_bp(missing_bp, coordinates)
 
-    cdsIds = copy(exonIds)
-    cdsIds.extend(intronIds)
-    cdsIds.sort()
-    features.extend(cdsIds)
+    (UTR3start, UTR3end) = coordinates[-1]
+    UTR3length = UTR3end - UTR3start + 1
 
-    for cdsId in cdsIds:
-        if cdsId[1] == "e":
-            coordinates.append((alleleData.exonpos_dic[cdsId[0]][0] + 1, alleleData.exonpos_dic[cdsId[0]][1]))
-            closestAlleleCdsSequence += alleleData.seq[alleleData.exonpos_dic[cdsId[0]][0]:alleleData.exonpos_dic[cdsId[0]][1]]
-        elif cdsId[1] == "epseudo":
-            coordinates.append((alleleData.exonpos_dic[cdsId[0]][0] + 1, alleleData.exonpos_dic[cdsId[0]][1]))
-        else: coordinates.append((alleleData.intronpos_dic[cdsId[0]][0] + 1, alleleData.intronpos_dic[cdsId[0]][1]))
+    if UTR3length <= 0:
+        raise MissingUTRError(3)
+
+    UTR3length_orig = len(allAlleles[closestAlleleName].UTR3)
+    missing_bp_end = check_incomplete_utrs(missing_bp, UTR3length_orig, UTR3length, incomplete_ok)
+
+    coordinates, imgtDifferences_orig, cdsMap = changeToImgtCoords(features, coordinates, differences)
+
+    differences, imgtDifferences = shift_differences_for_missing_bp(missing_bp, differences, imgtDifferences_orig,
+                                                                    closestAlleleSequence)
+
+    annotation = {"features": features, "coordinates": coordinates,
+                  "imgtDifferences": imgtDifferences, "differences": differences,
+                  "closestAllele": closestAlleleName, "cdsMap": cdsMap,
+                  "closestAlleleCdsSequence": closestAlleleCdsSequence,
+                  "closestAlleleSequence": closestAlleleSequence, "isExactMatch": isExactMatch,
+                  "extraInformation": extraInformation, "concatHSPS": concatHSPS,
+                  "missing_bp": missing_bp, "missing_bp_end": missing_bp_end,
+                  "imgtDifferences_orig": imgtDifferences_orig,
+                  "queryLength": queryLength, "alignLength": alignLength,
+                  "queryStartOverhang": query_start_overhang,
+                  "sequence": str(querySequence.seq)}
+    annotation["imgtDifferences"]["mmCodons"] = getMismatchData(annotation)
+    return annotation
+
+
+def annotateCandidates(candidates, annotation, allAlleles, querySequence, incomplete_ok=False, gene_models=None):
+    """annotates the query against each closest allele candidate (see closestallele.evaluate_candidates);
+    annotation is the annotation of the chosen (= best) candidate;
+
+    returns the ranked candidates as [{"name": allele name, "differences": number of differences or None,
+    "error": error message or None, "annotation": annotation or None}], or None if only one hit was evaluated
+    """
+    if not candidates:
+        return None
+    annotated = []
+    for candidate in candidates:
+        entry = {"name": candidate["name"], "differences": candidate["differences"], "error": candidate["error"],
+                 "annotation": None}
+        if candidate["name"] == annotation["closestAllele"]:
+            entry["annotation"] = dict(annotation)
+        elif candidate["closestAllele"]:
+            try:
+                entry["annotation"] = annotateAllele(candidate["closestAllele"], allAlleles, querySequence,
+                                                     incomplete_ok, gene_models)
+            except Exception as E:
+                entry["error"] = getattr(E, "msg", repr(E))
+        annotated.append(entry)
+    return annotated
+
+
+def chooseCandidate(annotations, closest_allele):
+    """replaces the annotation of each query by its annotation against the candidate closest_allele
+    (see annotateCandidates); raises a ValueError if closest_allele was not evaluated or could not be annotated
+    """
+    for alleleQuery in annotations:
+        annotation = annotations[alleleQuery]
+        if not annotation or annotation["closestAllele"] == closest_allele:
+            continue
+        chosen = [candidate for candidate in annotation.get("closestAlleleCandidates") or []
+                  if candidate["name"] == closest_allele]
+        if not chosen or not chosen[0]["annotation"]:
+            raise ValueError(f"{closest_allele} is no usable closest allele candidate of {alleleQuery}!")
+        annotations[alleleQuery] = dict(chosen[0]["annotation"],
+                                        closestAlleleCandidates=annotation["closestAlleleCandidates"])
+    return annotations
+
+
+def getClosestAlleleCoordinates(alleleData, queryLength, gene_model=None):
+    """returns the gene model of the closest allele, adjusted to the query length;
+    gene_model can be given from a precomputed GeneModelTable, otherwise it is derived from alleleData
+    """
+    if gene_model is None:
+        gene_model = build_gene_model(alleleData)
+    (features, coordinates, extraInformation, cds_offsets) = gene_model
 
-    if "utr3" in alleleData.utrpos_dic:
-        features.append("utr3")
-        coordinates.append((alleleData.utrpos_dic["utr3"][0] + 1, queryLength))
+    if features and features[-1] == "utr3":
+        coordinates[-1] = (coordinates[-1][0], queryLength)
 
     closestAlleleSequence = alleleData.seq
+    closestAlleleCdsSequence = "".join(closestAlleleSequence[start:end] for (start, end) in cds_offsets)
 
     return (features, coordinates, extraInformation, closestAlleleCdsSequence, closestAlleleSequence)
 
-def calculateCoordinates(alleleName, alleles, differences, queryLength, missing_bp):
+def calculateCoordinates(alleleName, alleles, differences, queryLength, missing_bp, gene_models=None):
 
     allele = alleles[alleleName]
+    gene_model = gene_models.get(alleleName) if gene_models is not None else None
     features, coordinates, extraInformation, closestAlleleCdsSequence, \
-        closestAlleleSequence = getClosestAlleleCoordinates(allele, queryLength)
+        closestAlleleSequence = getClosestAlleleCoordinates(allele, queryLength, gene_model)
 
     #features = ['utr5', (1, 'e'), (1, 'i'), (2, 'e'), (2, 'i'), ... , 'utr3']
     #coordinates = [(1, 267), ... , (10737, 10561)]
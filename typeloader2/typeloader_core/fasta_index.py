@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""
+fasta_index.py
+
+creates and reads FAI-style indices of fasta files (like samtools faidx),
+so single sequences of the parsed reference fasta files can be fetched without reading the whole file
+"""
+import os
+from threading import Lock
+
+# ===========================================================
+# parameters:
+
+_index_cache = {}  # format: {fasta_file: ((mtime, size), IndexedFasta)}
+_index_cache_lock = Lock()
+
+
+# ===========================================================
+# functions:
+
+def build_fasta_index(fasta_file):
+    """scans a fasta file once,
+    returns dict of format {name: (seq_length, offset of first base, bases per line, bytes per line)}
+    """
+    index = {}
+    name = None
+    with open(fasta_file, "rb") as f:
+        offset = 0
+        for line in f:
+            line_len = len(line)
+            if line.startswith(b">"):
+                name = line[1:].split()[0].decode("latin-1")
+                index[name] = [0, offset + line_len, 0, 0]
+                last_line_short = False
+            elif name is not None:
+                bases = len(line.rstrip(b"\r\n"))
+                entry = index[name]
+                if bases:
+                    if last_line_short:
+                        raise ValueError(f"Sequence {name} in {fasta_file} has lines of differing length!")
+                    if not entry[2]:
+                        entry[2] = bases
+                        entry[3] = line_len
+                    elif bases != entry[2]:
+                        last_line_short = True
+                    entry[0] += bases
+            offset += line_len
+    return {name: tuple(entry) for (name, entry) in index.items()}
+
+
+def write_fasta_index(index, fai_file):
+    """writes an index created by build_fasta_index to a .fai file
+    """
+    with open(fai_file, "w") as g:
+        for name, (length, offset, line_bases, line_width) in index.items():
+            g.write(f"{name}\t{length}\t{offset}\t{line_bases}\t{line_width}\n")
+
+
+def read_fasta_index(fai_file):
+    """reads a .fai file,
+    returns dict of format {name: (seq_length, offset of first base, bases per line, bytes per line)}
+    """
+    index = {}
+    with open(fai_file, "r") as f:
+        for line in f:
+            s = line.rstrip("\n").split("\t")
+            if len(s) < 5:
+                continue
+            index[s[0]] = (int(s[1]), int(s[2]), int(s[3]), int(s[4]))
+    return index
+
+
+def make_fasta_index(fasta_file, log=None):
+    """creates the index {fasta_file}.fai for a fasta file,
+    returns the path of the index file
+    """
+    fai_file = fasta_file + ".fai"
+    if log:
+        log.debug(f"\tCreating fasta index {fai_file}...")
+    write_fasta_index(build_fasta_index(fasta_file), fai_file)
+    return fai_file
+
+
+class IndexedFasta:
+    """random access to the sequences of a fasta file via its .fai index:
+    each sequence is read directly from its position in the file
+    """
+    def __init__(self, fasta_file, log=None):
+        self.fasta_file = fasta_file
+        fai_file = fasta_file + ".fai"
+        if os.path.isfile(fai_file) and os.path.getmtime(fai_file) >= os.path.getmtime(fasta_file):
+            self.index = read_fasta_index(fai_file)
+        else:  # index missing or outdated (e.g., reference created by an older TypeLoader version)
+            if log:
+                log.debug(f"\tNo current index found for {fasta_file}, creating it...")
+            self.index = build_fasta_index(fasta_file)
+            try:
+                write_fasta_index(self.index, fai_file)
+            except OSError as E:
+                if log:
+                    log.warning(f"Could not write fasta index {fai_file}: {repr(E)}")
+
+    def fetch(self, name):
+        """returns the sequence with the given name (as str); raises KeyError if it does not exist
+        """
+        (length, offset, line_bases, line_width) = self.index[name]
+        if not length:
+            return ""
+        num_lines = -(-length // line_bases)  # ceiling division
+        with open(self.fasta_file, "rb") as f:
+            f.seek(offset)
+            raw = f.read(num_lines * line_width)
+        seq = raw.replace(b"\n", b"").replace(b"\r", b"")[:length]
+        return seq.decode("latin-1")
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+
+def get_indexed_fasta(fasta_file, log=None):
+    """returns an IndexedFasta object for fasta_file;
+    these are kept in memory until the fasta file changes
+    """
+    stat = os.stat(fasta_file)
+    file_key = (stat.st_mtime, stat.st_size)
+    with _index_cache_lock:
+        cached = _index_cache.get(fasta_file)
+        if cached and cached[0] == file_key:
+            return cached[1]
+        indexed_fasta = IndexedFasta(fasta_file, log)
+        _index_cache[fasta_file] = (file_key, indexed_fasta)
+    return indexed_fasta
+
+
+if __name__ == '__main__':
+    pass
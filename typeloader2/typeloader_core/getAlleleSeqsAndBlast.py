@@ -2,10 +2,13 @@
 
 import re
 import os
-from subprocess import run, PIPE
 from collections import defaultdict
+from xml.sax.saxutils import escape
 from .EMBLfunctions import fasta_generator
 from .xmlfuncs import *
+from .reference_cache import get_sequence_index, get_kmer_index
+from .fasta_index import get_indexed_fasta
+from . import kmer_index, locus_partitions, result_cache, blast_results, jobs, timing, staging, alignment_service
 
 """
 The BLAST db has to be formatted like so:
@@ -36,35 +39,489 @@ def getAlleleSequences(xmlFile, log):
     return alleles, data_dic
 
 
+def get_blast_xml_filename(inputFastaFile):
+    return inputFastaFile.replace(".fasta", ".blast.xml").replace(".fa", ".blast.xml")
+
+
+def get_blast_output_format(settings):
+    """returns the format BLAST output is stored in: 'xml' (BLAST XML) or 'tabular' (see blast_results)
+    """
+    return settings.get("blast_output", "xml")
+
+
+def split_query_header(header):
+    """returns (query ID, query definition) as BLAST reports them for a fasta header (with -parse_deflines)
+    """
+    s = header.split(None, 1)
+    query_def = s[1] if len(s) > 1 else "No definition line"
+    return s[0], query_def
+
+
+@timing.timed
 def blastSequences(inputFastaFile, parsedFasta, settings, log,
-                   blastOutputFormat="5"):  # 5 corresponds to XML BLAST output
+                   blastOutputFormat="5", blast_batch=None):  # 5 corresponds to XML BLAST output
     blast = settings["blast_path"]
     database = parsedFasta
-    blastXmlOutputFile = inputFastaFile.replace(".fasta", ".blast.xml").replace(".fa", ".blast.xml")
+    tabular = get_blast_output_format(settings) == "tabular"
+    if blastOutputFormat == "5" and tabular:  # compact format instead of XML
+        blastOutputFormat = blast_results.OUTFMT_TABULAR
+    blastXmlOutputFile = blast_results.get_output_filename(inputFastaFile, tabular)
+    in_memory = staging.is_staged(inputFastaFile)  # the upload keeps its temp files in memory (see staging.py)
+    cache = None
+    if blastOutputFormat in ["5", blast_results.OUTFMT_TABULAR]:
+        cache = result_cache.get_result_cache(settings)
+    if cache:
+        records = list(fasta_generator(inputFastaFile))
+        cache_key = result_cache.hash_sequences([seq for (_, seq) in records]) + \
+            result_cache.get_database_key(database) + (blastOutputFormat,)
+
+    if blast_batch:
+        blast_output = blast_batch.get_result(inputFastaFile, database)
+        if blast_output:
+            log.debug("Using result of batched BLAST run")
+            with staging.open_for_writing(blastXmlOutputFile, in_memory) as g:
+                g.write(blast_output)
+            if cache:
+                cache.put("blast", cache_key, blast_output, log)
+            return blastXmlOutputFile
+        log.info(f"{os.path.basename(inputFastaFile)} is not part of the batched BLAST run, blasting it separately")
+
+    if cache:
+        blast_output = cache.get("blast", cache_key, log)
+        if blast_output:
+            iterations = list(split_blast_output(blast_output).values())
+            if len(iterations) == len(records):
+                with staging.open_for_writing(blastXmlOutputFile, in_memory) as g:
+                    g.write(join_blast_output(blast_output, iterations, [header for (header, _) in records]))
+                return blastXmlOutputFile
+
     blast_command = [blast,
-                     "-query", inputFastaFile,
+                     "-query", "-" if in_memory else inputFastaFile,
                      "-parse_deflines",
                      "-db", database,
                      "-dust", "no",
                      "-soft_masking", "false",
-                     "-outfmt", blastOutputFormat,
-                     "-out", blastXmlOutputFile]
+                     "-outfmt", blastOutputFormat]
+    if not in_memory:  # else, the query is passed via stdin and the output is read from stdout
+        blast_command += ["-out", blastXmlOutputFile]
     log.debug("Blast command:")
     log.debug(" ".join(blast_command))
 
-    result = run(blast_command, stdout=PIPE, stderr=PIPE, universal_newlines=True)
-    if result.stdout:
+    query = staging.read_text(inputFastaFile) if in_memory else None
+    result = jobs.run_process(blast_command, query)  # killed if the upload is cancelled
+    if result.stdout and not in_memory:
         log.info(result.stdout)
     if result.returncode != 0:
         log.error(result.stderr)
         log.error(f"Blast did not succeed; return code: {result.returncode}")
+    elif in_memory and result.stdout:
+        staging.stage(blastXmlOutputFile, result.stdout)
 
-    if not os.path.isfile(blastXmlOutputFile):
+    if not staging.exists(blastXmlOutputFile):
         log.error("BlastXMLFile not generated!")
         return False
+    if cache and result.returncode == 0:
+        cache.put("blast", cache_key, staging.read_text(blastXmlOutputFile), log)
     return blastXmlOutputFile
 
 
+class BlastBatch:
+    """runs BLAST once for the sequences of many input files (e.g., of a bulk upload),
+    so the BLAST database is only loaded once, and splits the output back per input file;
+    blastSequences uses these results instead of running BLAST again for a file
+    """
+    def __init__(self, settings, log, num_threads=None):
+        self.settings = settings
+        self.log = log
+        self.num_threads = num_threads or min(os.cpu_count() or 1, 8)
+        self.results = {}  # format: {(database, query records): BLAST output of these queries}
+
+    @staticmethod
+    def make_key(database, records):
+        return os.path.abspath(database), tuple(records)
+
+    def get_result(self, input_fasta_file, database):
+        """returns the BLAST output of an input fasta file if it was part of the batch, else None
+        """
+        if not self.results:
+            return None
+        records = list(fasta_generator(input_fasta_file))
+        return self.results.get(self.make_key(database, records))
+
+    def add_files(self, raw_files, use_given_reference=False):
+        """blasts the sequences of all given raw files (fasta or GenDX XML) in one run per reference database;
+        files that cannot be read are skipped here (they fail later during their regular upload),
+        as are files whose sequences are all identical to known alleles
+        """
+        if self.settings.get("search_engine", "blast") == "kmer":  # files are not blasted at all
+            return
+        queries = defaultdict(list)  # format: {database: [records of one file, ...]}
+        for raw_file in raw_files:
+            try:
+                records = read_raw_records(raw_file, self.log)
+                targetFamily = get_target_family(records[-1][0], self.settings)
+                (database, _, _) = get_reference_files(targetFamily, self.settings, use_given_reference)
+                (_, header_data) = parse_fasta_header(records[-1][0])
+                database = select_blast_db(records, header_data, database, self.log)
+            except jobs.JobCancelled:
+                raise
+            except Exception as E:
+                self.log.info(f"\tNot batching {raw_file}: {repr(E)}")
+                continue
+            if records and not find_exact_matches(records, database, self.log):  # exact matches need no BLAST
+                queries[database].append(records)
+
+        for (database, record_lists) in queries.items():
+            self.run(database, record_lists)
+
+    def run(self, database, record_lists):
+        """blasts the records of several input files against database in one BLAST run
+        """
+        temp_dir = self.settings["temp_dir"]
+        batch_file = os.path.join(temp_dir, f"blast_batch_{os.getpid()}_{os.path.basename(database)}.fa")
+        tabular = get_blast_output_format(self.settings) == "tabular"
+        output_file = blast_results.get_output_filename(batch_file, tabular)
+        query_names = {}  # format: {batch query ID: original fasta header}
+        with open(batch_file, "w") as g:
+            for (i, records) in enumerate(record_lists):
+                for (j, (header, seq)) in enumerate(records):
+                    query_id = f"batchquery{i}_{j}"
+                    query_names[query_id] = header
+                    g.write(f">{query_id}\n{seq}\n")
+
+        blast_command = [self.settings["blast_path"],
+                         "-query", batch_file,
+                         "-parse_deflines",
+                         "-db", database,
+                         "-dust", "no",
+                         "-soft_masking", "false",
+                         "-num_threads", str(self.num_threads),
+                         "-outfmt", blast_results.OUTFMT_TABULAR if tabular else "5",
+                         "-out", output_file]
+        self.log.info(f"Blasting {len(query_names)} sequences of {len(record_lists)} files in one run...")
+        self.log.debug(" ".join(blast_command))
+        try:
+            result = jobs.run_process(blast_command)
+            if result.returncode != 0 or not os.path.isfile(output_file):
+                self.log.error(result.stderr)
+                self.log.error(f"Batched BLAST did not succeed (return code: {result.returncode}), "
+                               f"blasting files one by one instead")
+                return
+            with open(output_file) as f:
+                blast_output = f.read()
+        finally:
+            for myfile in [batch_file, output_file]:
+                if os.path.isfile(myfile):
+                    os.remove(myfile)
+
+        iterations = split_blast_output(blast_output)
+        for (i, records) in enumerate(record_lists):
+            file_iterations = [iterations[f"batchquery{i}_{j}"] for j in range(len(records))
+                               if f"batchquery{i}_{j}" in iterations]
+            if len(file_iterations) != len(records):
+                self.log.warning(f"Batched BLAST output lacks {len(records) - len(file_iterations)} "
+                                 f"of {len(records)} sequences of file {i + 1}, this file is blasted separately")
+                continue
+            self.results[self.make_key(database, records)] = join_blast_output(blast_output, file_iterations,
+                                                                               [header for (header, _) in records])
+
+
+def split_blast_xml(blast_xml):
+    """splits the XML output of a multi-query BLAST run into its iterations (one per query),
+    returns dict of format {query ID: XML of its <Iteration>}
+    """
+    iterations = {}
+    for match in re.finditer(r"<Iteration>.*?</Iteration>", blast_xml, re.DOTALL):
+        iteration = match.group()
+        query_id = re.search(r"<Iteration_query-ID>(.*?)</Iteration_query-ID>", iteration).group(1)
+        iterations[query_id] = iteration
+    return iterations
+
+
+def split_blast_output(blast_output):
+    """splits the output of a multi-query BLAST run (XML or tabular) into dict {query ID: part of this query}
+    """
+    if blast_output.lstrip().startswith("<"):
+        return split_blast_xml(blast_output)
+    return blast_results.split_tabular(blast_output)
+
+
+def join_blast_output(blast_output, parts, headers):
+    """creates the BLAST output (XML or tabular) for a subset of the queries of a multi-query BLAST run,
+    see join_blast_xml
+    """
+    if blast_output.lstrip().startswith("<"):
+        return join_blast_xml(blast_output, parts, headers)
+    return blast_results.join_tabular(parts, headers)
+
+
+def join_blast_xml(blast_xml, iterations, headers):
+    """creates the BLAST XML output for a subset of the queries of a multi-query BLAST run,
+    as if BLAST had been run for them alone;
+    the query IDs and definitions are reset to those from the original fasta headers
+    """
+    def set_tag(text, tag, value):
+        return re.sub(f"<{tag}>.*?</{tag}>", lambda _: f"<{tag}>{value}</{tag}>", text, count=1, flags=re.DOTALL)
+
+    header_part = blast_xml[:blast_xml.index("<BlastOutput_iterations>")]
+    new_iterations = []
+    for (n, (iteration, header)) in enumerate(zip(iterations, headers)):
+        (query_id, query_def) = [escape(text) for text in split_query_header(header)]
+        iteration = set_tag(iteration, "Iteration_iter-num", n + 1)
+        iteration = set_tag(iteration, "Iteration_query-ID", query_id)
+        iteration = set_tag(iteration, "Iteration_query-def", query_def)
+        new_iterations.append(iteration)
+        if n == 0:
+            header_part = set_tag(header_part, "BlastOutput_query-ID", query_id)
+            header_part = set_tag(header_part, "BlastOutput_query-def", query_def)
+            query_len = re.search(r"<Iteration_query-len>(.*?)</Iteration_query-len>", iteration).group(1)
+            header_part = set_tag(header_part, "BlastOutput_query-len", query_len)
+
+    return header_part + "<BlastOutput_iterations>\n" + "\n".join(new_iterations) + \
+        "\n</BlastOutput_iterations>\n</BlastOutput>\n"
+
+
+BLAST_XML_HEADER = """<?xml version="1.0"?>
+<!DOCTYPE BlastOutput PUBLIC "-//NCBI//NCBI BlastOutput/EN" "http://www.ncbi.nlm.nih.gov/dtd/NCBI_BlastOutput.dtd">
+<BlastOutput>
+  <BlastOutput_program>blastn</BlastOutput_program>
+  <BlastOutput_version>BLASTN {engine}</BlastOutput_version>
+  <BlastOutput_reference>TypeLoader</BlastOutput_reference>
+  <BlastOutput_db>{database}</BlastOutput_db>
+  <BlastOutput_query-ID>{query_id}</BlastOutput_query-ID>
+  <BlastOutput_query-def>{query_def}</BlastOutput_query-def>
+  <BlastOutput_query-len>{query_len}</BlastOutput_query-len>
+  <BlastOutput_param>
+    <Parameters>
+      <Parameters_expect>10</Parameters_expect>
+      <Parameters_sc-match>1</Parameters_sc-match>
+      <Parameters_sc-mismatch>-2</Parameters_sc-mismatch>
+      <Parameters_gap-open>0</Parameters_gap-open>
+      <Parameters_gap-extend>0</Parameters_gap-extend>
+      <Parameters_filter>m;</Parameters_filter>
+    </Parameters>
+  </BlastOutput_param>
+<BlastOutput_iterations>
+"""
+
+BLAST_XML_ITERATION = """<Iteration>
+  <Iteration_iter-num>{iter_num}</Iteration_iter-num>
+  <Iteration_query-ID>{query_id}</Iteration_query-ID>
+  <Iteration_query-def>{query_def}</Iteration_query-def>
+  <Iteration_query-len>{query_len}</Iteration_query-len>
+<Iteration_hits>
+{hits}</Iteration_hits>
+</Iteration>
+"""
+
+BLAST_XML_HIT = """<Hit>
+  <Hit_num>1</Hit_num>
+  <Hit_id>gnl|BL_ORD_ID|0</Hit_id>
+  <Hit_def>{allele_name}</Hit_def>
+  <Hit_accession>0</Hit_accession>
+  <Hit_len>{allele_length}</Hit_len>
+  <Hit_hsps>
+    <Hsp>
+      <Hsp_num>1</Hsp_num>
+      <Hsp_bit-score>{bit_score:.3f}</Hsp_bit-score>
+      <Hsp_score>{score:.0f}</Hsp_score>
+      <Hsp_evalue>0</Hsp_evalue>
+      <Hsp_query-from>{query_from}</Hsp_query-from>
+      <Hsp_query-to>{query_to}</Hsp_query-to>
+      <Hsp_hit-from>{hit_from}</Hsp_hit-from>
+      <Hsp_hit-to>{hit_to}</Hsp_hit-to>
+      <Hsp_query-frame>1</Hsp_query-frame>
+      <Hsp_hit-frame>1</Hsp_hit-frame>
+      <Hsp_identity>{identity}</Hsp_identity>
+      <Hsp_positive>{identity}</Hsp_positive>
+      <Hsp_gaps>{gaps}</Hsp_gaps>
+      <Hsp_align-len>{align_len}</Hsp_align-len>
+      <Hsp_qseq>{qseq}</Hsp_qseq>
+      <Hsp_hseq>{hseq}</Hsp_hseq>
+      <Hsp_midline>{midline}</Hsp_midline>
+    </Hsp>
+  </Hit_hsps>
+</Hit>
+"""
+
+
+def find_exact_matches(records, parsedFasta, log):
+    """looks up the sequences of an input file in the sequence index of the reference of parsedFasta;
+    returns a list of kmer_index.LocalHit, one per record,
+    if every sequence is identical to a known allele (or to a known allele without its UTRs), else None
+    """
+    if not records:
+        return None
+    (ref_dir, target) = get_reference_target(parsedFasta)
+    seq_index = get_sequence_index(target, ref_dir, log)
+    if not seq_index:
+        return None
+    hits = []
+    for (_, seq) in records:
+        match = seq_index.find(seq)
+        if not match:
+            return None
+        hits.append(kmer_index.make_exact_hit(seq, *match))
+    return hits
+
+
+def search_kmer_index(records, parsedFasta, log):
+    """finds the closest known allele of each record via the k-mer index of the reference of parsedFasta
+    (instead of BLAST); returns a list of kmer_index.LocalHit (or None if nothing was found), one per record,
+    or None if the reference has no k-mer index
+    """
+    (ref_dir, target) = get_reference_target(parsedFasta)
+    kmers = get_kmer_index(target, ref_dir, log)
+    if not kmers:
+        return None
+    fasta = get_indexed_fasta(parsedFasta, log)
+    return [kmer_index.find_closest_allele(seq, kmers, fasta, log) for (_, seq) in records]
+
+
+def classify_locus(records, header_data, target, ref_dir, log):
+    """determines the locus of the sequences of an input file
+    from the locus given in their header (DR2S files) and a vote of their best candidates in the k-mer index
+    (candidates sharing at least half as many k-mers with a sequence as its best candidate);
+    returns None if no locus or more than one locus is found
+    """
+    loci = set()
+    header_locus = header_data.get("locus") if header_data else None
+    if header_locus:
+        if target == "hla" and not header_locus.startswith(("HLA-", "MIC")):
+            header_locus = "HLA-" + header_locus
+        loci.add(header_locus)
+
+    kmers = get_kmer_index(target, ref_dir, log)
+    if kmers:
+        for (_, seq) in records:
+            candidates = kmers.candidates(seq.upper())
+            if not candidates:
+                return None
+            best_shared = candidates[0][2]
+            loci.update(locus_partitions.get_locus(allele_name) for (allele_name, _, shared) in candidates
+                        if shared * 2 >= best_shared)
+
+    if len(loci) == 1:
+        return loci.pop()
+    return None
+
+
+def select_blast_db(records, header_data, parsedFasta, log):
+    """returns the BLAST database to search for the sequences of an input file:
+    the partition of their locus (see locus_partitions), if the reference has partitions
+    and the locus can be determined unambiguously, else the full reference database parsedFasta
+    """
+    (ref_dir, target) = get_reference_target(parsedFasta)
+    partitions = locus_partitions.get_partitions(ref_dir, target)
+    if not partitions:
+        return parsedFasta
+    locus = classify_locus(records, header_data, target, ref_dir, log)
+    if locus in partitions:
+        log.debug(f"\tSearching only the {locus} alleles of the reference...")
+        return partitions[locus]
+    log.debug("\tLocus could not be determined unambiguously, searching the full reference...")
+    return parsedFasta
+
+
+def get_reference_target(parsedFasta):
+    """translates the path of a parsed reference fasta into (ref_dir, target),
+    e.g., '/some/path/reference_data/parsedKIR.fa' => ('/some/path/reference_data', 'KIR')
+    """
+    target = os.path.splitext(os.path.basename(parsedFasta))[0].replace("parsed", "", 1)
+    return os.path.dirname(parsedFasta), target
+
+
+def write_blast_xml(records, hits, database, output_file, engine, staged=False):
+    """writes BLAST's XML output (format 5) for hits that were found without running BLAST
+    (one HSP per sequence, None for sequences without a hit),
+    so these sequences can be processed exactly like blasted sequences;
+    if staged, the output is only kept in memory (see staging.py)
+    """
+    with staging.open_for_writing(output_file, staged) as g:
+        for (i, ((header, seq), hit)) in enumerate(zip(records, hits)):
+            (query_id, query_def) = [escape(text) for text in split_query_header(header)]
+            if i == 0:
+                g.write(BLAST_XML_HEADER.format(engine=engine, database=escape(database), query_id=query_id,
+                                                query_def=query_def, query_len=len(seq)))
+            hit_xml = ""
+            if hit:
+                hit_xml = BLAST_XML_HIT.format(allele_name=escape(hit.allele_name), allele_length=hit.allele_length,
+                                               bit_score=kmer_index.bit_score(hit.score), score=hit.score,
+                                               query_from=hit.query_from, query_to=hit.query_to,
+                                               hit_from=hit.hit_from, hit_to=hit.hit_to,
+                                               identity=hit.midline.count("|"),
+                                               gaps=hit.qseq.count("-") + hit.hseq.count("-"),
+                                               align_len=len(hit.midline), qseq=hit.qseq, hseq=hit.hseq,
+                                               midline=hit.midline)
+            g.write(BLAST_XML_ITERATION.format(iter_num=i + 1, query_id=query_id, query_def=query_def,
+                                               query_len=len(seq), hits=hit_xml))
+        g.write("</BlastOutput_iterations>\n</BlastOutput>\n")
+    return output_file
+
+
+def write_blast_tabular(records, hits, database, output_file, staged=False):
+    """writes hits that were found without running BLAST in TypeLoader's tabular BLAST format (see blast_results),
+    like write_blast_xml does in XML format
+    """
+    blast_records = []
+    for ((header, seq), hit) in zip(records, hits):
+        (query_id, query_def) = split_query_header(header)
+        record = blast_results.BlastRecord(query_id, query_def, database, len(seq))
+        if hit:
+            alignment = blast_results.BlastAlignment(hit.allele_name, hit.allele_name, hit.allele_length)
+            alignment.hsps.append(blast_results.BlastHsp(hit.qseq, hit.hseq, hit.query_from, hit.query_to,
+                                                         hit.hit_from, hit.hit_to, round(hit.score),
+                                                         kmer_index.bit_score(hit.score), 0, hit.midline.count("|"),
+                                                         hit.qseq.count("-") + hit.hseq.count("-")))
+            record.alignments.append(alignment)
+        blast_records.append(record)
+    with staging.open_for_writing(output_file, staged) as g:
+        blast_results.write_tabular(blast_records, g)
+    return output_file
+
+
+def read_raw_records(raw_file, log):
+    """returns the (header, sequence) records a raw file (fasta or GenDX XML) will be blasted with
+    """
+    if raw_file.lower().endswith(".xml"):
+        alleles, _ = getAlleleSequences(raw_file, log)
+        return [(alleleName, alleles[alleleName]) for alleleName in alleles]
+    return list(fasta_generator(raw_file))
+
+
+def get_target_family(header, settings):
+    """determines the target family from the (last) fasta header of an input file
+    """
+    kir = settings["gene_kir"]
+    hla = settings["gene_hla"]
+    seq_name, header_data = parse_fasta_header(header)
+    locus = header_data["locus"]
+    if locus:  # if DRS2 fasta file
+        if locus.startswith("KIR"):
+            return kir
+        return hla
+    if re.search(kir, seq_name):
+        return kir
+    return hla
+
+
+def get_reference_files(targetFamily, settings, use_given_reference=False):
+    """returns the paths of (parsed fasta, .dat file, version file) of the reference of a target family
+    """
+    if use_given_reference:
+        reference_path = use_given_reference
+    else:
+        reference_path = os.path.join(settings["dat_path"], settings["general_dir"],
+                                      settings["reference_dir"])
+    if targetFamily == settings["gene_kir"]:
+        return (os.path.join(reference_path, settings["parsed_kir"]),
+                os.path.join(reference_path, settings["kir_dat"]),
+                os.path.join(reference_path, settings["kir_version"]))
+    return (os.path.join(reference_path, settings["parsed_hla"]),
+            os.path.join(reference_path, settings["hla_dat"]),
+            os.path.join(reference_path, settings["hla_version"]))
+
+
 def parse_fasta_header(fasta_header):
     """parses header of a fastq file
     """
@@ -116,29 +573,29 @@ def sanity_check_seq(seq, log):
     return ok, msg
 
 
-def blast_raw_seqs(input_filename, filetype, settings, log, use_given_reference=False):
+def blast_raw_seqs(input_filename, filetype, settings, log, use_given_reference=False, blast_batch=None):
     """parses raw allele file (fasta or XML)
     """
-    if filetype == "XML":
-        log.debug("\tConverting xml to fasta...")
-        alleles, xml_data_dic = getAlleleSequences(input_filename, log)
-        log.debug(f"\t- {len(alleles)} alleles found in XML file")
-        fastaFilename = input_filename.replace(".xml", ".fa")
-        with open(fastaFilename, "w") as fastaFile:
-            for alleleName in list(alleles.keys()):
-                log.debug(alleleName)
-                fastaFile.write(">%s\n" % alleleName)
-                fastaFile.write("%s\n" % alleles[alleleName])
-    else:
-        fastaFilename = input_filename
-        xml_data_dic = {}
-
-    kir = settings["gene_kir"]
-    hla = settings["gene_hla"]
+    jobs.report_stage("parse")
+    with timing.stage("parse", filetype=filetype):
+        if filetype == "XML":
+            log.debug("\tConverting xml to fasta...")
+            alleles, xml_data_dic = getAlleleSequences(input_filename, log)
+            log.debug(f"\t- {len(alleles)} alleles found in XML file")
+            fastaFilename = input_filename.replace(".xml", ".fa")
+            with staging.open_for_writing(fastaFilename, staging.is_staged(input_filename)) as fastaFile:
+                for alleleName in list(alleles.keys()):
+                    log.debug(alleleName)
+                    fastaFile.write(">%s\n" % alleleName)
+                    fastaFile.write("%s\n" % alleles[alleleName])
+        else:
+            fastaFilename = input_filename
+            xml_data_dic = {}
 
-    log.debug("\tReading fasta for sanity check...")
+        log.debug("\tReading fasta for sanity check...")
+        records = list(fasta_generator(fastaFilename))
     header = ""
-    for myfasta in fasta_generator(fastaFilename):
+    for myfasta in records:
         (header, seq) = myfasta
         (ok, msg) = sanity_check_seq(seq, log)
         if not ok:
@@ -146,42 +603,39 @@ def blast_raw_seqs(input_filename, filetype, settings, log, use_given_reference=
 
     log.debug("\tParsing fasta header...")
     seq_name, header_data = parse_fasta_header(header)
-    locus = header_data["locus"]
-    if locus:  # if DRS2 fasta file
-        if locus.startswith("KIR"):
-            targetFamily = kir
-        else:
-            targetFamily = hla
-    else:
-        if re.search(kir, seq_name):
-            targetFamily = kir
-        else:
-            targetFamily = hla
+    targetFamily = get_target_family(header, settings)
+    (parsedFasta, allelesFilename, versionFilename) = get_reference_files(targetFamily, settings,
+                                                                          use_given_reference)
+    if not use_given_reference:
+        alignment_service.warm_up(targetFamily)
 
-    if use_given_reference:
-        reference_path = use_given_reference
-    else:
-        reference_path = os.path.join(settings["dat_path"], settings["general_dir"],
-                                      settings["reference_dir"])
-    parsed_kir = settings["parsed_kir"]
-    parsed_hla = settings["parsed_hla"]
-    hla_dat = settings["hla_dat"]
-    kir_dat = settings["kir_dat"]
-    hla_version = settings["hla_version"]
-    kir_version = settings["kir_version"]
-
-    if targetFamily == kir:
-        parsedFasta = os.path.join(reference_path, parsed_kir)
-        allelesFilename = os.path.join(reference_path, kir_dat)
-        versionFilename = os.path.join(reference_path, kir_version)
-    else:
-        parsedFasta = os.path.join(reference_path, parsed_hla)
-        allelesFilename = os.path.join(reference_path, hla_dat)
-        versionFilename = os.path.join(reference_path, hla_version)
+    jobs.report_stage("BLAST")
+    engine = None
+    hits = find_exact_matches(records, parsedFasta, log)
+    if hits:  # all sequences are identical to known alleles
+        log.info(f"\tSequence identical to known allele {hits[0].allele_name}, skipping BLAST...")
+        engine = "exact-match"
+    elif settings.get("search_engine", "blast") == "kmer":
+        log.debug("\tSearching closest allele via k-mer index...")
+        hits = search_kmer_index(records, parsedFasta, log)
+        if hits is None:
+            log.warning(f"No k-mer index found for {parsedFasta}, using BLAST instead")
+        engine = "kmer-index"
 
-    log.debug("\tBlasting sequence...")
     try:
-        BlastXMLFile = blastSequences(fastaFilename, parsedFasta, settings, log)
+        if hits and get_blast_output_format(settings) == "tabular":
+            BlastXMLFile = write_blast_tabular(records, hits, parsedFasta,
+                                               blast_results.get_output_filename(fastaFilename, tabular=True),
+                                               staged=staging.is_staged(fastaFilename))
+        elif hits:
+            BlastXMLFile = write_blast_xml(records, hits, parsedFasta, get_blast_xml_filename(fastaFilename),
+                                           engine, staged=staging.is_staged(fastaFilename))
+        else:
+            log.debug("\tBlasting sequence...")
+            database = select_blast_db(records, header_data, parsedFasta, log)
+            BlastXMLFile = blastSequences(fastaFilename, database, settings, log, blast_batch=blast_batch)
+    except jobs.JobCancelled:
+        raise
     except Exception as E:
         log.exception(E)
         return False, "Error while trying to BLAST raw sequence", repr(E)
@@ -11,210 +11,657 @@ parser functions for repeat use
 #import modules:
 
 import os, re
-from pickle import dump
+import mmap
+import hashlib
+from pickle import dump, load, loads, Pickler, Unpickler
 import sys
 
+try:
+    from . import locus_partitions
+except ImportError:
+    import locus_partitions
+
 #===========================================================
 #classes:
 
 class Allele:
-    def __init__(self, ID, locus, name, seq, length, UTR5, UTR3, exon_dic, intron_dic, exonpos_dic, intronpos_dic, utrpos_dic, pseudo_exon_dic, exon_num_dic, intron_num_dic, target):
+    """compact representation of a reference allele:
+    only the full sequence and the feature coordinates are stored,
+    the sequences of the single features are derived from the sequence when needed
+    """
+    __slots__ = ("ID", "locus", "name", "seq", "exonpos_dic", "intronpos_dic", "utrpos_dic",
+                 "pseudo_exon_dic", "exon_num_dic", "intron_num_dic", "is_ref")
+
+    def __init__(self, ID, locus, name, seq, exonpos_dic, intronpos_dic, utrpos_dic, pseudo_exon_dic, exon_num_dic, intron_num_dic, target=None):
         self.ID = ID # Accession number or name
         self.locus = locus # gene
         self.name = name # allele name
         self.seq = seq.upper() # full sequence in upper case
-        self.length = len(seq) # length of sequence
-        self.UTR3 = UTR3 # sequence of UTR3
-        self.UTR5 = UTR5 # sequence of UTR5
-        self.exon_dic = exon_dic # dict of format {1:'EXON1_SEQ', 2:'EXON2_SEQ'...}
-        self.intron_dic = intron_dic # dict of format {1:'INTRON1_SEQ', 2:'INTRON2_SEQ'...}
-        self.exonpos_dic = exonpos_dic
-        self.intronpos_dic = intronpos_dic
-        self.utrpos_dic = utrpos_dic
+        self.exonpos_dic = exonpos_dic # dict of format {1: (start, end), ...} (0-based, end exclusive)
+        self.intronpos_dic = intronpos_dic # dict of format {1: (start, end), ...} (0-based, end exclusive)
+        self.utrpos_dic = utrpos_dic # dict of format {"utr5": (start, end), "utr3": (start, end)}
         self.pseudo_exon_dic = pseudo_exon_dic # dict of format {1:'False', 2:'True', ...}
         self.exon_num_dic = exon_num_dic # dict of formart {1: '1', 3: '3/4', ...}
         self.intron_num_dic = intron_num_dic # dict of formart {1: '1', 2: '2', ...}
         self.is_ref = False
-        self.full_seq = False # True if at least some introns are known, otherwise false
-        if len(list(intron_dic.keys())) > 0:
-            self.full_seq = True
-        if name.startswith("HLA"):
-            name = name.split("-")[1]
-#         self.fasta_header = ">%s:%s_%s %s bp" % (target, ID, name, self.length)
-        self.fasta_header = ">%s %s bp" % (name, self.length)
-
-        # calculate CDS:
-        exons = list(exon_dic.keys())
-        exons.sort()
-        self.CDS = ""
-        for exon in exons:
-            self.CDS += exon_dic[exon]
 
     def __repr__(self):
         return self.name
 
+    def __getstate__(self):
+        return {attr: getattr(self, attr) for attr in self.__slots__ if hasattr(self, attr)}
+
+    def __setstate__(self, state):
+        """also accepts the attribute dicts of the old, non-compact Allele objects (from older dump files)
+        """
+        if isinstance(state, tuple):  # default slot state: (None, slot_dict)
+            state = state[1]
+        self.is_ref = False
+        for attr in self.__slots__:
+            if attr in state:
+                setattr(self, attr, state[attr])
+
+    @property
+    def length(self):
+        """length of sequence
+        """
+        return len(self.seq)
+
+    @property
+    def full_seq(self):
+        """True if at least some introns are known, otherwise false
+        """
+        return len(self.intronpos_dic) > 0
+
+    @property
+    def UTR5(self):
+        """sequence of UTR5
+        """
+        if "utr5" in self.utrpos_dic:
+            (start, end) = self.utrpos_dic["utr5"]
+            return self.seq[start:end]
+        return ""
+
+    @property
+    def UTR3(self):
+        """sequence of UTR3
+        """
+        if "utr3" in self.utrpos_dic:
+            (start, end) = self.utrpos_dic["utr3"]
+            return self.seq[start:end]
+        return ""
+
+    @property
+    def exon_dic(self):
+        """dict of format {1:'EXON1_SEQ', 2:'EXON2_SEQ'...}
+        """
+        return {exon: self.seq[start:end] for (exon, (start, end)) in self.exonpos_dic.items()}
+
+    @property
+    def intron_dic(self):
+        """dict of format {1:'INTRON1_SEQ', 2:'INTRON2_SEQ'...}
+        """
+        return {intron: self.seq[start:end] for (intron, (start, end)) in self.intronpos_dic.items()}
+
+    @property
+    def CDS(self):
+        """concatenated sequence of all exons
+        """
+        return "".join(self.seq[start:end] for (_, (start, end)) in sorted(self.exonpos_dic.items()))
+
+    @property
+    def fasta_header(self):
+        name = self.name
+        if name.startswith("HLA"):
+            name = name.split("-")[1]
+        return ">%s %s bp" % (name, self.length)
+
 #===========================================================
 # reading functions:
 
-def read_dat_file(dat_file, target, log, isENA = False, verbose = False):
-    """reads content of a .dat file (EMBL format),
-    returns list of allele objects.
-    The parameter 'target' expects one of the following: "HLA", "Blutgruppen","CCR5", "KIR".
+usable_loci_hla = ["HLA-A*", "HLA-B*", "HLA-C*", "HLA-E*", "HLA-DPB1*", "HLA-DQB1*",
+                   "HLA-DRB", "MICA", "MICB", "HLA-DPA1", "HLA-DQA1",
+                   "HLA-DMA", "HLA-DMB", "HLA-DOA", "HLA-DOB",
+                   "HLA-F", "HLA-G", "HLA-H", "HLA-K", "HLA-J"]
+
+
+def get_release_regex(target):
+    """returns the regex to find the release version in a .dat file of the given target
     """
-    alleles = []
-    version = ""
     if target == "KIR":
         curr_release_pattern1 = "\(rel. (.*?), current release"
-        curr_release_regex1 = re.compile(curr_release_pattern1)
     else:
         curr_release_pattern1 = "CC  .* Release Version (.*)"
-        curr_release_regex1 = re.compile(curr_release_pattern1)
+    return re.compile(curr_release_pattern1)
 
-    if verbose:
-        log.info("Reading {}...".format(dat_file))
-    with open(dat_file, "r") as f:
-        data = f.readlines()
-        for i in range(len(data)):
-            line = data[i]
-            if line.startswith("ID"):
-                s = line.split()
-                allele_ID = s[1].replace(";","")
-                length = s[5]
-                seq = ""
-                UTR3 = ""
-                UTR5 = ""
-                UTR5_start = False
-                UTR5_end = False
-                UTR3_start = False
-                UTR3_end = False
-                exon_dic = {}
-                exonpos_dic = {}
-                intron_dic = {}
-                intronpos_dic = {}
-                utrpos_dic = {}
-                pseudo_exon_dic = {}
-                intron_num_dic = {}
-                exon_num_dic = {}
-
-                if target in ["Blutgruppen","CCR5"]:
-                    allele = allele_ID
-                    if allele.find("*")>0:
-                        locus = allele.split("*")[0]
-                    elif allele.find("_")>0:
-                        locus = allele.split("_")[0]
-                    else:
-                        log.error("!!!Cannot see Locus of Allele %s! Please adjust Input file!" % allele)
-                        log.error(line)
-                        sys.exit()
-
-            elif line.startswith("DT"):
-                line = line.lower()
-                match = curr_release_regex1.search(line)
-                if match:
-                    version = match.groups()[0]
-
-            elif line.startswith("CC"):
-                match = curr_release_regex1.search(line)
-                if match:
-                    version = match.groups()[0]
-
-            elif line.startswith("DE"):
-                s = line.split()
-                allele = s[1][:-1]
-                locus = allele.split("*")[0]
-
-            elif line.startswith("FT"):
-                s = line.split()
-                if s[1] == "UTR":
-                    start = int(s[-1].split(".")[0]) - 1
-                    end = int(s[-1].split(".")[-1])
-
-                    if start == 0:
-                        UTR5_start = start
-                        UTR5_end = end
-                        utrpos_dic["utr5"] = (start, end)
-                    else:
-                        UTR3_start = start
-                        UTR3_end = end
-                        utrpos_dic["utr3"] = (start, end)
-                elif s[1] == "exon":
-                    start = int(s[-1].split(".")[0]) - 1
-                    end = int(s[-1].split(".")[-1])
-                    next_line = data[i+1]
-                    assert next_line.find("number") > 0, "Cannot find exon number in %s:\n '%s'\n '%s'" % (allele, line, next_line)
-                    # doublesplit, because of [/number="3/4"] lines
-                    exon_num = int(next_line.split('"')[-2].split('/')[0])
-                    exonpos_dic[exon_num] = (start, end)
-                    exon_num_dic[exon_num] = next_line.split('"')[-2]
-                    # look at line + 2, to find pseudoexon
-                    next_line = data[i+2]
-                    pseudo_exon_dic[exon_num] = True if next_line.find("pseudo") > 0 else False
-
-                elif s[1] == "intron":
-                    start = int(s[-1].split(".")[0]) - 1
-                    end = int(s[-1].split(".")[-1])
-                    next_line = data[i+1]
-                    assert next_line.find("number") > 0, "Cannot find intron number in %s:\n '%s'\n '%s'" % (allele, line, next_line)
-                    # doublesplit, because of [/number="3/4"] lines
-                    intron_num = int(next_line.split('"')[-2].split('/')[0])
-                    intronpos_dic[intron_num] = (start, end)
-                    intron_num_dic[intron_num] = intron_num = next_line.split('"')[-2]
-
-            elif line.startswith("SQ"):
-                read_on = True
-                j = 0
-                while read_on:
-                    j += 1
-                    s = data[i+j]
-                    if s.startswith("//"):
-                        read_on = False
-                    else:
-                        myseq = "".join(s.split()[:-1]).upper()
-                        seq += myseq
-
-            elif line.startswith("//"):
-                for exon in exonpos_dic:
-                    (start,end) = exonpos_dic[exon]
-                    exon_seq = seq[start:end]
-                    exon_dic[exon] = exon_seq
-
-                for intron in intronpos_dic:
-                    (start,end) = intronpos_dic[intron]
-                    intron_seq = seq[start:end]
-                    intron_dic[intron] = intron_seq
-
-                if UTR5_end:
-                    UTR5 = seq[UTR5_start:UTR5_end].upper()
-                if UTR3_end:
-                    UTR3 = seq[UTR3_start:UTR3_end].upper()
-
-                myAllele = Allele(allele_ID, locus, allele, seq, length, UTR5, UTR3, exon_dic, intron_dic, exonpos_dic, intronpos_dic, utrpos_dic, pseudo_exon_dic, exon_num_dic, intron_num_dic, target)
-                if target == "HLA": # HLA.dat contains other loci, too - MIC, TAP...
-                    usable = False
-                    usable_loci = ["HLA-A*", "HLA-B*", "HLA-C*", "HLA-E*", "HLA-DPB1*", "HLA-DQB1*",
-                                   "HLA-DRB", "MICA", "MICB", "HLA-DPA1", "HLA-DQA1",
-                                   "HLA-DMA", "HLA-DMB", "HLA-DOA", "HLA-DOB",
-                                   "HLA-F", "HLA-G", "HLA-H", "HLA-K", "HLA-J"]
-                    for loc in usable_loci:
-                        if allele.startswith(loc): # HLA.dat contains other loci, too - MIC, TAP...
-                            usable = True
-                    if usable:
-                        alleles.append(myAllele)
+
+def is_usable_allele(allele, target):
+    """checks whether an allele should be used as reference
+    (HLA.dat contains other loci, too - MIC, TAP...)
+    """
+    if target != "HLA":
+        return True
+    for loc in usable_loci_hla:
+        if allele.startswith(loc):
+            return True
+    return False
+
+
+def iter_dat_records(dat_file):
+    """reads a .dat file (EMBL format) record by record,
+    yields (byte offset, byte length, list of lines) for each record from its ID line up to and including its // line
+
+    :param dat_file: path of the .dat file, or an iterable of its lines as bytes (e.g. an open binary stream)
+    """
+    if isinstance(dat_file, (str, bytes, os.PathLike)):
+        with open(dat_file, "rb") as f:
+            yield from iter_dat_records(f)
+        return
+
+    offset = 0
+    record_start = None
+    record = []
+    for line in dat_file:
+        if line.startswith(b"ID"):
+            record_start = offset
+            record = []
+        offset += len(line)
+        if record_start is None:
+            continue
+        record.append(line.decode("latin-1"))
+        if line.startswith(b"//"):
+            yield record_start, offset - record_start, record
+            record_start = None
+
+
+def copy_lines(stream, target_file):
+    """yields the lines of a binary stream while writing them to target_file (an open binary file)
+    """
+    for line in stream:
+        target_file.write(line)
+        yield line
+
+
+def parse_dat_record(data, target, log, release_regex=None):
+    """parses the lines of one .dat record (ID ... //),
+    returns (Allele object, release version found in the record or "")
+    """
+    if not release_regex:
+        release_regex = get_release_regex(target)
+    version = ""
+    allele = None
+    locus = None
+    myAllele = None
+    for i in range(len(data)):
+        line = data[i]
+        if line.startswith("ID"):
+            s = line.split()
+            allele_ID = s[1].replace(";","")
+            seq = ""
+            exonpos_dic = {}
+            intronpos_dic = {}
+            utrpos_dic = {}
+            pseudo_exon_dic = {}
+            intron_num_dic = {}
+            exon_num_dic = {}
+
+            if target in ["Blutgruppen","CCR5"]:
+                allele = allele_ID
+                if allele.find("*")>0:
+                    locus = allele.split("*")[0]
+                elif allele.find("_")>0:
+                    locus = allele.split("_")[0]
+                else:
+                    log.error("!!!Cannot see Locus of Allele %s! Please adjust Input file!" % allele)
+                    log.error(line)
+                    sys.exit()
+
+        elif line.startswith("DT"):
+            line = line.lower()
+            match = release_regex.search(line)
+            if match:
+                version = match.groups()[0]
+
+        elif line.startswith("CC"):
+            match = release_regex.search(line)
+            if match:
+                version = match.groups()[0].strip()
+
+        elif line.startswith("DE"):
+            s = line.split()
+            allele = s[1][:-1]
+            locus = allele.split("*")[0]
+
+        elif line.startswith("FT"):
+            s = line.split()
+            if s[1] == "UTR":
+                start = int(s[-1].split(".")[0]) - 1
+                end = int(s[-1].split(".")[-1])
+
+                if start == 0:
+                    utrpos_dic["utr5"] = (start, end)
                 else:
-                    alleles.append(myAllele)
+                    utrpos_dic["utr3"] = (start, end)
+            elif s[1] == "exon":
+                start = int(s[-1].split(".")[0]) - 1
+                end = int(s[-1].split(".")[-1])
+                next_line = data[i+1]
+                assert next_line.find("number") > 0, "Cannot find exon number in %s:\n '%s'\n '%s'" % (allele, line, next_line)
+                # doublesplit, because of [/number="3/4"] lines
+                exon_num = int(next_line.split('"')[-2].split('/')[0])
+                exonpos_dic[exon_num] = (start, end)
+                exon_num_dic[exon_num] = next_line.split('"')[-2]
+                # look at line + 2, to find pseudoexon
+                next_line = data[i+2]
+                pseudo_exon_dic[exon_num] = True if next_line.find("pseudo") > 0 else False
+
+            elif s[1] == "intron":
+                start = int(s[-1].split(".")[0]) - 1
+                end = int(s[-1].split(".")[-1])
+                next_line = data[i+1]
+                assert next_line.find("number") > 0, "Cannot find intron number in %s:\n '%s'\n '%s'" % (allele, line, next_line)
+                # doublesplit, because of [/number="3/4"] lines
+                intron_num = int(next_line.split('"')[-2].split('/')[0])
+                intronpos_dic[intron_num] = (start, end)
+                intron_num_dic[intron_num] = intron_num = next_line.split('"')[-2]
+
+        elif line.startswith("SQ"):
+            read_on = True
+            j = 0
+            while read_on:
+                j += 1
+                s = data[i+j]
+                if s.startswith("//"):
+                    read_on = False
+                else:
+                    myseq = "".join(s.split()[:-1]).upper()
+                    seq += myseq
+
+        elif line.startswith("//"):
+            myAllele = Allele(allele_ID, locus, allele, seq, exonpos_dic, intronpos_dic, utrpos_dic, pseudo_exon_dic, exon_num_dic, intron_num_dic, target)
+    return myAllele, version
+
+
+def hash_dat_record(data, release_regex):
+    """calculates the content hash of the lines of one .dat record (ID ... //);
+    lines only stating the current release are left out, so a record keeps its hash between releases
+    as long as its content does not change.
+    Returns (hash, release version found in the record or "")
+    """
+    version = ""
+    md5 = hashlib.md5()
+    for line in data:
+        match = None
+        if line.startswith("DT"):
+            match = release_regex.search(line.lower())
+        elif line.startswith("CC"):
+            match = release_regex.search(line)
+        if match:
+            version = match.groups()[0].strip()
+            continue
+        md5.update(line.encode("latin-1"))
+    return md5.hexdigest(), version
+
+
+def parse_dat_file(dat_file, target, log, known_alleles=None):
+    """parses a .dat file (EMBL format) record by record,
+    yields (Allele object, byte offset, byte length, release version, record hash) for each usable allele;
+    the release version is "" as long as it has not been found in the file
+
+    :param dat_file: path of the .dat file, or an iterable of its lines as bytes (e.g. an open binary stream)
+    :param known_alleles: optional dict of format {record hash: Allele} (e.g. from the previous release);
+                          records with a known hash are not parsed again, the known Allele is yielded instead
+    """
+    version = ""
+    release_regex = get_release_regex(target)
+    for (offset, length, data) in iter_dat_records(dat_file):
+        record_hash, record_version = hash_dat_record(data, release_regex)
+        if known_alleles and record_hash in known_alleles:
+            myAllele = known_alleles[record_hash]
+        else:
+            myAllele, record_version = parse_dat_record(data, target, log, release_regex)
+        if record_version:
+            version = record_version
+        if myAllele and is_usable_allele(myAllele.name, target):
+            yield myAllele, offset, length, version, record_hash
+
+
+def read_dat_file(dat_file, target, log, isENA = False, verbose = False):
+    """reads content of a .dat file (EMBL format),
+    returns list of allele objects.
+    The parameter 'target' expects one of the following: "HLA", "Blutgruppen","CCR5", "KIR".
+    """
+    version = ""
     if verbose:
-        log.info("\t=> successfully read {} of {} alleles!" % (len(alleles), target))
+        log.info("Reading {}...".format(dat_file))
 
     alleleHash = {}
-    for allele in alleles:
-        #if not isENA:
-        #    if allele.name.find("DQB1") != -1:
-        #       if ((allele.name != "HLA-DQB1*05:03:01:01") or (allele.name != "HLA-DQB1*06:01:01")): continue
-        alleleHash[allele.name] = allele
+    for (myAllele, _, _, version, _) in parse_dat_file(dat_file, target, log):
+        alleleHash[myAllele.name] = myAllele
+
+    if verbose:
+        log.info("\t=> successfully read %s of %s alleles!" % (len(alleleHash), target))
 
     return alleleHash, version
 
 
+def read_parsed_dump(dump_file):
+    """reads a parsed{target}.dump file written by make_parsed_files,
+    returns dict of format {allele_name: Allele}
+    """
+    alleles = {}
+    with open(dump_file, "rb") as f:
+        unpickler = Unpickler(f)
+        while True:
+            try:
+                item = unpickler.load()
+            except EOFError:
+                break
+            if isinstance(item, dict):  # dump files of older versions contain a single dict
+                alleles.update(item)
+            else:
+                alleles[item.name] = item
+    return alleles
+
+
+def read_dat_index(index_file):
+    """reads the byte-offset index of a .dat file written by make_parsed_files,
+    returns dict of format {"size": size of the indexed .dat file in bytes, "version": version,
+                            "alleles": {allele_name: (offset, length)},
+                            "hashes": {allele_name: record hash},
+                            "dumped": {allele_name: (offset, length) of its pickle in parsed{target}.dump}}
+    ("hashes" and "dumped" are missing in indices written by older versions)
+    """
+    with open(index_file, "rb") as f:
+        return load(f)
+
+
+class KnownAlleles:
+    """read-only, dict-like access to the alleles of the current local reference keyed by their record hash
+    (from {target}_dat_index.dump): only the record hashes are held in memory,
+    an allele is read from parsed{target}.dump (via its offset in the index) when it is requested
+    """
+    def __init__(self, dump_file, index_data):
+        self.dump_file = dump_file
+        dumped = index_data["dumped"]
+        self.index = {record_hash: dumped[allele_name] for (allele_name, record_hash) in index_data["hashes"].items()
+                      if allele_name in dumped}
+        self._file = None
+        self._mm = None
+
+    def __getitem__(self, record_hash):
+        (offset, length) = self.index[record_hash]
+        if self._mm is None:
+            self._file = open(self.dump_file, "rb")
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return loads(self._mm[offset: offset + length])
+
+    def __contains__(self, record_hash):
+        return record_hash in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._file.close()
+            self._mm = None
+            self._file = None
+
+
+def load_known_alleles(ref_dir, target, log):
+    """returns the alleles of the current local reference keyed by their record hash as KnownAlleles,
+    so an incremental update only parses records whose hash changed and reads all others from parsed{target}.dump;
+    returns an empty dict if the files are missing or too old to contain hashes and dump offsets
+    """
+    index_file = os.path.join(ref_dir, f"{target}_dat_index.dump")
+    dump_file = os.path.join(ref_dir, f"parsed{target}.dump")
+    if not (os.path.isfile(index_file) and os.path.isfile(dump_file)):
+        log.debug("\t\tNo previous parsed reference found, parsing all alleles")
+        return {}
+    index_data = read_dat_index(index_file)
+    if not (index_data.get("hashes") and index_data.get("dumped")):
+        log.debug("\t\tPrevious reference has no record hashes, parsing all alleles")
+        return {}
+    return KnownAlleles(dump_file, index_data)
+
+
+def write_change_report(report_file, changes, old_version, new_version):
+    """writes the alleles that were added, changed or removed by a reference update to report_file,
+    one allele per line, tab-separated from its type of change
+    """
+    with open(report_file, "w") as g:
+        g.write(f"# changes from version {old_version} to version {new_version}\n")
+        for change in ["added", "changed", "removed"]:
+            for allele_name in changes[change]:
+                g.write(f"{change}\t{allele_name}\n")
+
+
+def read_change_report(report_file):
+    """reads a change report written by make_parsed_files,
+    returns dict of format {"added": [allele_names], "changed": [allele_names], "removed": [allele_names]}
+    """
+    changes = {"added": [], "changed": [], "removed": []}
+    with open(report_file, "r") as f:
+        for line in f:
+            if line.startswith("#") or not line.strip():
+                continue
+            (change, allele_name) = line.rstrip("\n").split("\t")
+            changes[change].append(allele_name)
+    return changes
+
+
+def read_indexed_allele(dat_file, allele_name, index, target, log):
+    """reads a single allele from a .dat file, using the byte-offset index of this file;
+    only the record of this allele is parsed
+
+    :param dat_file: path to the .dat file
+    :param allele_name: name of the allele to read
+    :param index: dict of format {allele_name: (offset, length)}
+    :param target: designates target database, either 'KIR' or 'HLA'
+    :param log: logger instance
+    :return: Allele object (raises KeyError if allele_name is not in the index)
+    """
+    (offset, length) = index[allele_name]
+    with open(dat_file, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            raw = mm[offset: offset + length]
+    data = raw.decode("latin-1").splitlines(keepends=True)
+    myAllele, _ = parse_dat_record(data, target, log)
+    return myAllele
+
+
+def build_gene_model(allele):
+    """derives the static gene model of a reference allele, as used for annotating new alleles:
+    returns (features, coordinates, extraInformation, cds_offsets) with
+        features = ['utr5', (1, 'e'), (1, 'i'), (2, 'e'), ..., 'utr3']
+        coordinates = [(start, end), ...] (1-based, end inclusive; the end of utr3 is the end of the allele)
+        extraInformation = {"pseudoexon": {...}, "exon_number": {...}, "intron_number": {...}}
+        cds_offsets = [(start, end), ...] (0-based slices of the sequence forming the CDS, without pseudoexons)
+    """
+    features = []
+    coordinates = []
+    exonIds = []
+    cds_offsets = []
+    extraInformation = {"pseudoexon": dict(allele.pseudo_exon_dic),
+                        "exon_number": dict(allele.exon_num_dic),
+                        "intron_number": dict(allele.intron_num_dic)}
+
+    if "utr5" in allele.utrpos_dic:
+        features.append("utr5")
+        coordinates.append((allele.utrpos_dic["utr5"][0] + 1, allele.utrpos_dic["utr5"][1]))
+
+    for exonNumber in allele.exonpos_dic:
+        if extraInformation["pseudoexon"][exonNumber]:
+            exonIds.append((exonNumber, "epseudo"))
+        else:
+            exonIds.append((exonNumber, "e"))
+    intronIds = [(intronNumber, "i") for intronNumber in allele.intronpos_dic]
+
+    cdsIds = sorted(exonIds + intronIds)
+    features.extend(cdsIds)
+    for (number, kind) in cdsIds:
+        if kind == "i":
+            (start, end) = allele.intronpos_dic[number]
+        else:
+            (start, end) = allele.exonpos_dic[number]
+            if kind == "e":
+                cds_offsets.append((start, end))
+        coordinates.append((start + 1, end))
+
+    if "utr3" in allele.utrpos_dic:
+        features.append("utr3")
+        coordinates.append((allele.utrpos_dic["utr3"][0] + 1, allele.utrpos_dic["utr3"][1]))
+
+    return features, coordinates, extraInformation, cds_offsets
+
+
+class GeneModelTable:
+    """columnar table of the gene models (see build_gene_model) of all alleles of a reference,
+    written by make_parsed_files to {target}_gene_models.dump
+    """
+    columns = ["features", "coordinates", "pseudoexon", "exon_number", "intron_number", "cds_offsets"]
+
+    def __init__(self, version=""):
+        self.version = version
+        self.rows = {}  # format: {allele_name: row number}
+        self.data = {column: [] for column in self.columns}
+
+    def add(self, allele):
+        features, coordinates, extraInformation, cds_offsets = build_gene_model(allele)
+        self.rows[allele.name] = len(self.rows)
+        for (column, value) in [("features", features), ("coordinates", coordinates),
+                                ("pseudoexon", extraInformation["pseudoexon"]),
+                                ("exon_number", extraInformation["exon_number"]),
+                                ("intron_number", extraInformation["intron_number"]),
+                                ("cds_offsets", cds_offsets)]:
+            self.data[column].append(value)
+
+    def get(self, allele_name):
+        """returns the gene model of an allele in the format of build_gene_model (as fresh copies,
+        so callers may change them), or None if the allele is not in the table
+        """
+        row = self.rows.get(allele_name)
+        if row is None:
+            return None
+        data = self.data
+        extraInformation = {"pseudoexon": dict(data["pseudoexon"][row]),
+                            "exon_number": dict(data["exon_number"][row]),
+                            "intron_number": dict(data["intron_number"][row])}
+        return (list(data["features"][row]), list(data["coordinates"][row]), extraInformation,
+                data["cds_offsets"][row])
+
+    def __contains__(self, allele_name):
+        return allele_name in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getstate__(self):
+        return {"version": self.version, "rows": self.rows, "data": self.data}
+
+    def __setstate__(self, state):
+        self.version = state["version"]
+        self.rows = state["rows"]
+        self.data = state["data"]
+
+
+def read_gene_models(gene_model_file):
+    """reads a {target}_gene_models.dump written by make_parsed_files, returns a GeneModelTable
+    """
+    with open(gene_model_file, "rb") as f:
+        return load(f)
+
+
+def hash_sequence(seq):
+    """returns the hash of a sequence as used in the SequenceIndex
+    """
+    return hashlib.md5(seq.upper().encode()).hexdigest()
+
+
+class SequenceIndex:
+    """hash index of the sequences in the reference fasta (= BLAST database) of a target,
+    used to recognize uploaded sequences identical to a known allele without running BLAST;
+    written by make_parsed_files to {target}_seq_index.dump
+    """
+    def __init__(self, version=""):
+        self.version = version
+        self.full = {}  # format: {hash of full sequence: (allele_name, allele length)}
+        self.stripped = {}  # format: {hash of sequence without UTRs: (allele_name, allele length, UTR5 length)}
+
+    def add(self, allele):
+        """adds an allele; if several alleles have the same sequence, the first one is kept
+        """
+        self.full.setdefault(hash_sequence(allele.seq), (allele.name, allele.length))
+        if allele.UTR5 or allele.UTR3:
+            start = allele.utrpos_dic["utr5"][1] if "utr5" in allele.utrpos_dic else 0
+            end = allele.utrpos_dic["utr3"][0] if "utr3" in allele.utrpos_dic else allele.length
+            self.stripped.setdefault(hash_sequence(allele.seq[start:end]), (allele.name, allele.length, start))
+
+    def find(self, seq):
+        """returns (allele_name, allele length, 0-based start of seq within the allele) of the reference allele
+        whose sequence or sequence without UTRs is identical to seq, or None if there is none
+        """
+        seq_hash = hash_sequence(seq)
+        if seq_hash in self.full:
+            (allele_name, length) = self.full[seq_hash]
+            return allele_name, length, 0
+        return self.stripped.get(seq_hash)
+
+    def __len__(self):
+        return len(self.full)
+
+    def __getstate__(self):
+        return {"version": self.version, "full": self.full, "stripped": self.stripped}
+
+    def __setstate__(self, state):
+        self.version = state["version"]
+        self.full = state["full"]
+        self.stripped = state["stripped"]
+
+
+def read_sequence_index(seq_index_file):
+    """reads a {target}_seq_index.dump written by make_parsed_files, returns a SequenceIndex
+    """
+    with open(seq_index_file, "rb") as f:
+        return load(f)
+
+
+class IndexedDatFile:
+    """read-only, dict-like access to the alleles of a .dat file via its byte-offset index:
+    each allele record is only parsed when it is requested
+    """
+    def __init__(self, dat_file, index_file, target, log):
+        self.dat_file = dat_file
+        self.target = target
+        self.log = log
+        index_data = read_dat_index(index_file)
+        if index_data["size"] != os.path.getsize(dat_file):
+            raise ValueError(f"{index_file} does not belong to the current version of {dat_file}!")
+        self.version = index_data["version"]
+        self.index = index_data["alleles"]
+        self._parsed = {}
+
+    def __getitem__(self, allele_name):
+        if allele_name not in self._parsed:
+            self._parsed[allele_name] = read_indexed_allele(self.dat_file, allele_name, self.index,
+                                                            self.target, self.log)
+        return self._parsed[allele_name]
+
+    def __contains__(self, allele_name):
+        return allele_name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+
 #===========================================================
 # writing functions:
 
@@ -229,25 +676,86 @@ def write_fasta(alleles, output_fasta, no_UTR = False, verbose = False):
             if no_UTR: # only use sequence without UTR (not always fully known)
                 start_utr3 = len(allele.UTR3) * -1
                 if start_utr3 == 0:
-                    allele.print_seq = allele.seq[len(allele.UTR5):]
+                    print_seq = allele.seq[len(allele.UTR5):]
                 else:
-                    allele.print_seq = allele.seq[len(allele.UTR5): -1 * len(allele.UTR3)]
+                    print_seq = allele.seq[len(allele.UTR5): -1 * len(allele.UTR3)]
             else:
-                allele.print_seq = allele.seq
-            g.write("%s\n%s\n" % (allele.fasta_header, allele.print_seq))
+                print_seq = allele.seq
+            g.write("%s\n%s\n" % (allele.fasta_header, print_seq))
     if verbose:
         print("\tFertig!")
 
 
-def make_parsed_files(target, ref_dir, log, restricted_to=None, target_dir=None):
+def use_in_reference_fasta(allele, target):
+    """checks whether an allele should be part of the (unrestricted) reference fasta / blast database
+    """
+    if target == "hla":
+        if allele.name.startswith("MIC"): # take only full length MIC alleles
+            return len(allele.UTR3) > 0 and len(allele.UTR5) > 0
+        return True
+    elif target == "KIR":
+        # take only full length KIR alleles
+        return len(allele.UTR3) > 0 and len(allele.UTR5) > 0
+    return False
+
+
+def make_restricted_files(target, alleles, restricted_to, target_dir, version, log):
+    """creates the parsed reference files of a restricted reference in target_dir,
+    taking the alleles from an already parsed reference (e.g. an IndexedDatFile), so the .dat file is not read again
+
+    :param target: designates target database, either 'KIR' or 'hla'
+    :param alleles: dict-like object of format {allele_name: Allele} (the complete reference)
+    :param restricted_to: list of allele names the restricted reference should contain
+    :param target_dir: path where to create the reference files
+    :param version: version of the reference the alleles are taken from
+    :param log: logger instance
+    :return: list of the allele names from restricted_to that are not part of the reference
+    """
+    os.makedirs(target_dir, exist_ok=True)
+    fa_file = os.path.join(target_dir, f"parsed{target}.fa")
+    dump_file = os.path.join(target_dir, f"parsed{target}.dump")
+    version_file = os.path.join(target_dir, f"curr_version_{target}.txt")
+
+    missing = []
+    log.debug("\t\tWriting {} and {}...".format(fa_file, dump_file))
+    with open(fa_file, "w") as fasta_file, open(dump_file, "wb") as g:
+        pickler = Pickler(g)
+        for allele_name in restricted_to:
+            if allele_name not in alleles:
+                log.warning(f"\t\t\t{allele_name} is not part of the {target} reference!")
+                missing.append(allele_name)
+                continue
+            log.debug(f"\t\t\tAdding {allele_name} to database...")
+            allele_data = alleles[allele_name]
+            fasta_file.write(">%s\n" % allele_name)
+            fasta_file.write("%s\n" % allele_data.seq)
+            pickler.dump(allele_data)
+            pickler.clear_memo()
+
+    log.debug("\t\tWriting {}...".format(version_file))
+    with open(version_file, "w") as g:
+        g.write(version or "")
+    return missing
+
+
+def make_parsed_files(target, ref_dir, log, restricted_to=None, target_dir=None, dat_stream=None,
+                      previous_dir=None):
     """creates the parsed reference files from IPD's files
 
+    The .dat file is processed in one pass, record by record: the fasta file, dump file and index are written
+    while the file is being read, so memory usage does not depend on the size of the .dat file.
+
     :param target: designates target database, either 'KIR' or 'hla'
     :param ref_dir: path where to create the reference files (if not restricted_to)
     :param log: logger instance
     :param restricted_to: if used, a list of allele names; then the created database will only
                           contain the listed alleles
     :param target_dir: path where to create the databases; only used if restricted_to is not None
+    :param dat_stream: if given, a binary stream (e.g. a download or zip member) providing the content of
+                       the .dat file; it is written to {target}.dat in ref_dir while being parsed
+    :param previous_dir: if given (and not restricted_to), path to the current local reference;
+                         records whose content hash is unchanged since that reference are not parsed again,
+                         and the added, changed and removed alleles are written to {target}_changes.txt
     """
     if restricted_to:
         if not target_dir:
@@ -263,55 +771,117 @@ def make_parsed_files(target, ref_dir, log, restricted_to=None, target_dir=None)
     dump_file = os.path.join(myref_dir, f"parsed{target}.dump")
     version_file = os.path.join(myref_dir, f"curr_version_{target}.txt")
     allelename_file = os.path.join(ref_dir, f"{target}_allelenames.dump")
-
-    log.debug("\t\tReading alleles from {}...".format(ipd_file))
-    alleles, version = read_dat_file(ipd_file, target.upper(), log)
-    log.debug(f"\t\t\t=> found {len(alleles)} alleles")
+    index_file = os.path.join(ref_dir, f"{target}_dat_index.dump")
+    report_file = os.path.join(ref_dir, f"{target}_changes.txt")
+    gene_model_file = os.path.join(ref_dir, f"{target}_gene_models.dump")
+    seq_index_file = os.path.join(ref_dir, f"{target}_seq_index.dump")
+    kmer_index_file = os.path.join(ref_dir, f"{target}_kmer_index.npz")
+
+    if not restricted_to and os.path.isfile(report_file):  # left over from an earlier update
+        os.remove(report_file)
+
+    known_alleles = None
+    previous_index = None
+    if previous_dir and not restricted_to:
+        log.debug("\t\tLoading record hashes of previous reference from {}...".format(previous_dir))
+        known_alleles = load_known_alleles(previous_dir, target, log)
+        if known_alleles:
+            previous_index = read_dat_index(os.path.join(previous_dir, f"{target}_dat_index.dump"))
+
+    dat_copy = None
+    if dat_stream is not None:
+        log.debug("\t\tReading alleles from stream, writing them to {}...".format(ipd_file))
+        dat_copy = open(ipd_file, "wb")
+        source = copy_lines(dat_stream, dat_copy)
+    else:
+        log.debug("\t\tReading alleles from {}...".format(ipd_file))
+        source = ipd_file
 
     allele_names = []
-    log.debug("\t\tWriting {}...".format(fa_file))
-    with open(fa_file, "w") as fasta_file:
-        for allele_name in list(alleles.keys()):
-            allele_data = alleles[allele_name]
-            if allele_data.intron_dic:  # allele is not a CDS-only allele
-                allele_names.append(allele_name)
-
-            if restricted_to:
-                if allele_name in restricted_to:
+    dat_index = {}
+    record_hashes = {}
+    dumped = {}
+    gene_models = GeneModelTable()
+    seq_index = SequenceIndex()
+    partitions = None if restricted_to else locus_partitions.PartitionWriter(ref_dir, target)
+    version = ""
+    log.debug("\t\tWriting {} and {}...".format(fa_file, dump_file))
+    try:
+        with open(fa_file, "w") as fasta_file, open(dump_file, "wb") as g:
+            pickler = Pickler(g)
+            for (allele_data, offset, length, version, record_hash) in parse_dat_file(source, target.upper(), log,
+                                                                                       known_alleles):
+                allele_name = allele_data.name
+                dat_index[allele_name] = (offset, length)
+                record_hashes[allele_name] = record_hash
+                if not restricted_to:
+                    gene_models.add(allele_data)
+                if allele_data.full_seq:  # allele is not a CDS-only allele
+                    allele_names.append(allele_name)
+
+                if restricted_to:
+                    if allele_name not in restricted_to:
+                        continue
                     log.debug(f"\t\t\tAdding {allele_name} to database...")
-                    fasta_file.write(">%s\n" % allele_name)
-                    fasta_file.write("%s\n" % allele_data.seq)
-            else:
-                if target == "hla":
-                    if allele_name.startswith("MIC"): # take only full length MIC alleles
-                        if len(allele_data.UTR3) > 0 and len(allele_data.UTR5) > 0:
-                            fasta_file.write(">%s\n" % allele_name)
-                            fasta_file.write("%s\n" % allele_data.seq)
-                    else:
-                        fasta_file.write(">%s\n" % allele_name)
-                        fasta_file.write("%s\n" % allele_data.seq)
-                elif target == "KIR":
-                    # take only full length KIR alleles
-                    if len(allele_data.UTR3) > 0 and len(allele_data.UTR5) > 0:
-                        fasta_file.write(">%s\n" % allele_name)
-                        fasta_file.write("%s\n" % allele_data.seq)
+                    use_me = True
                 else:
-                    pass
+                    use_me = use_in_reference_fasta(allele_data, target)
 
-    log.debug("\t\tWriting {}...".format(dump_file))
-    if restricted_to:  # limit dump file to chosen alleles
-        alleles2 = {}
-        for allele in alleles:
-            if allele in restricted_to:
-                alleles2[allele] = alleles[allele]
-        alleles = alleles2
-    with open(dump_file, "wb") as g:
-        dump(alleles, g)
+                if use_me:
+                    fasta_file.write(">%s\n" % allele_name)
+                    fasta_file.write("%s\n" % allele_data.seq)
+                    if not restricted_to:
+                        seq_index.add(allele_data)
+                        partitions.add(allele_name, allele_data.seq)
+                dump_offset = g.tell()
+                pickler.dump(allele_data)
+                pickler.clear_memo()
+                dumped[allele_name] = (dump_offset, g.tell() - dump_offset)
+    finally:
+        if dat_copy:
+            dat_copy.close()
+        if isinstance(known_alleles, KnownAlleles):
+            known_alleles.close()
+        if partitions:
+            partitions.close()
+    log.debug(f"\t\t\t=> found {len(dat_index)} alleles")
 
     log.debug("\t\tWriting {}...".format(allelename_file))
     with open(allelename_file, "wb") as g:
         dump(allele_names, g)
 
+    if not restricted_to:
+        log.debug("\t\tWriting {}...".format(index_file))
+        with open(index_file, "wb") as g:
+            dump({"size": os.path.getsize(ipd_file), "version": version, "alleles": dat_index,
+                  "hashes": record_hashes, "dumped": dumped}, g)
+
+    if not restricted_to:
+        log.debug("\t\tWriting {}...".format(gene_model_file))
+        gene_models.version = version
+        with open(gene_model_file, "wb") as g:
+            dump(gene_models, g)
+
+        log.debug("\t\tWriting {}...".format(seq_index_file))
+        seq_index.version = version
+        with open(seq_index_file, "wb") as g:
+            dump(seq_index, g)
+
+        if os.path.isfile(kmer_index_file):  # rebuilt from the new fasta file when needed (see reference_cache)
+            log.debug("\t\tRemoving outdated {}...".format(kmer_index_file))
+            os.remove(kmer_index_file)
+
+    if previous_index:
+        old_hashes = previous_index["hashes"]
+        changes = {"added": [name for name in record_hashes if name not in old_hashes],
+                   "changed": [name for name in record_hashes
+                               if name in old_hashes and old_hashes[name] != record_hashes[name]],
+                   "removed": [name for name in old_hashes if name not in record_hashes]}
+        log.info(f"\t\t=> {len(changes['added'])} alleles added, {len(changes['changed'])} changed, "
+                 f"{len(changes['removed'])} removed since version {previous_index['version']}")
+        log.debug("\t\tWriting {}...".format(report_file))
+        write_change_report(report_file, changes, previous_index["version"], version)
+
     log.debug("\t\tWriting {}...".format(version_file))
     with open(version_file, "w") as g:
         g.write(version)
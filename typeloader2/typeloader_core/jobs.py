@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""
+jobs.py
+
+progress reporting and cancellation of long-running tasks (e.g., uploading a new allele in a worker thread):
+the thread running a task registers a Job (see run_with_job); the core functions report each stage they reach
+via report_stage and run external programs (BLAST) via run_process,
+so a cancelled job stops at its next stage and its running subprocess is killed.
+
+Worker threads of a job (e.g., of a bulk upload) run as its subjobs (see subjob): they are cancelled with it.
+
+Without a registered Job (e.g., in scripts), report_stage does nothing and run_process simply runs the program.
+"""
+import subprocess
+from subprocess import PIPE
+from threading import Lock, local
+
+# ===========================================================
+# parameters:
+
+STAGES = ["copy", "parse", "BLAST", "annotate"]  # stages of uploading a new allele
+
+_local = local()
+
+
+# ===========================================================
+# classes:
+
+class JobCancelled(Exception):
+    """raised in the thread(s) of a job after it was cancelled
+    """
+    def __init__(self, msg="The task was cancelled"):
+        super().__init__(msg)
+        self.msg = msg
+
+
+class Job:
+    """a cancellable task; on_stage (if given) is called with the name of each stage reached;
+    main_thread_runner (if given) is used by run_in_main_thread
+    """
+    def __init__(self, on_stage=None, main_thread_runner=None):
+        self.on_stage = on_stage
+        self.main_thread_runner = main_thread_runner
+        self.cancelled = False
+        self.process = None
+        self.subjobs = []
+        self._lock = Lock()
+
+    def check(self):
+        """raises JobCancelled if the job was cancelled
+        """
+        if self.cancelled:
+            raise JobCancelled()
+
+    def stage(self, name):
+        self.check()
+        if self.on_stage:
+            self.on_stage(name)
+
+    def cancel(self):
+        """marks the job and its subjobs as cancelled and kills their running subprocesses, if any
+        """
+        with self._lock:
+            self.cancelled = True
+            process = self.process
+            subjobs = list(self.subjobs)
+        if process and process.poll() is None:
+            process.kill()
+        for job in subjobs:
+            job.cancel()
+
+    def subjob(self):
+        """returns a Job for a worker thread of this job: it is cancelled along with this job,
+        but does not report its stages (they would mix with those of this job)
+        """
+        job = Job(main_thread_runner=self.main_thread_runner)
+        with self._lock:
+            self.subjobs.append(job)
+            job.cancelled = self.cancelled
+        return job
+
+    def run_process(self, cmd, input=None):
+        with self._lock:
+            self.check()
+            process = subprocess.Popen(cmd, stdin=None if input is None else PIPE, stdout=PIPE, stderr=PIPE,
+                                       universal_newlines=True)
+            self.process = process
+        try:
+            (stdout, stderr) = process.communicate(input)
+        finally:
+            with self._lock:
+                self.process = None
+        self.check()
+        return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+
+
+# ===========================================================
+# functions:
+
+def current_job():
+    """returns the Job the current thread is working on, or None
+    """
+    return getattr(_local, "job", None)
+
+
+def run_with_job(job, func, *args, **kwargs):
+    """runs func(*args, **kwargs) in the current thread as part of job (which may be None)
+    """
+    previous = current_job()
+    _local.job = job
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _local.job = previous
+
+
+def subjob():
+    """returns a subjob of the current job for a worker thread (see Job.subjob), or None if there is no current job
+    """
+    job = current_job()
+    if job:
+        return job.subjob()
+    return None
+
+
+def report_stage(name):
+    """reports that the current job reached a stage; raises JobCancelled if it was cancelled
+    """
+    job = current_job()
+    if job:
+        job.stage(name)
+
+
+def run_in_main_thread(func, *args, **kwargs):
+    """runs func(*args, **kwargs) via the main_thread_runner of the current job, if it has one, else directly;
+    needed for database access, which Qt only allows from the thread that opened the connection
+    """
+    job = current_job()
+    if job and job.main_thread_runner:
+        return job.main_thread_runner(func, *args, **kwargs)
+    return func(*args, **kwargs)
+
+
+def run_process(cmd, input=None):
+    """runs an external program like subprocess.run(cmd, input=input, stdout=PIPE, stderr=PIPE,
+    universal_newlines=True); if the current job is cancelled meanwhile, the program is killed and JobCancelled is raised
+    """
+    job = current_job()
+    if job:
+        return job.run_process(cmd, input)
+    return subprocess.run(cmd, input=input, stdout=PIPE, stderr=PIPE, universal_newlines=True)
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+"""
+kmer_index.py
+
+finds the closest known allele of a sequence without BLAST:
+a k-mer index of the reference fasta (= BLAST database), built on first use (see reference_cache.get_kmer_index),
+shortlists the reference alleles sharing the most k-mers with a query;
+the query is then aligned to these candidates only, and the best local alignment is reported
+like BLAST's best hit (scored like blastn's default megablast: match 1, mismatch -2, gaps 2.5 per base).
+
+To keep the index small, only a fixed fraction of all k-mers is indexed
+(those whose hash is below 2^32 / SAMPLING; the same k-mers are then sampled from every query).
+"""
+import os
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from Bio import Align
+
+# ===========================================================
+# parameters:
+
+K = 15  # k-mer length (2 bits per base, so k-mers fit into uint32)
+SAMPLING = 8  # roughly every SAMPLING-th k-mer is indexed
+TOP_N = 10  # number of candidate alleles aligned per query
+END_SLACK = 50  # additional reference bases considered when aligning the sequence ends
+
+MATCH = 1
+MISMATCH = -2
+GAP = -2.5
+LAMBDA = 1.28  # Karlin-Altschul parameters of this scoring scheme
+LN_K = -0.777
+
+_HASH_FACTOR = np.uint32(0x9E3779B1)
+_HASH_LIMIT = np.uint32((1 << 32) // SAMPLING)
+_BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for (_code, _base) in enumerate("ACGT"):
+    _BASE_CODES[ord(_base)] = _code
+    _BASE_CODES[ord(_base.lower())] = _code
+
+# one local alignment (= one BLAST HSP) of a query against a reference allele;
+# positions are 1-based and inclusive, like in BLAST's output
+LocalHit = namedtuple("LocalHit", """allele_name allele_length score query_from query_to hit_from hit_to
+                                     qseq hseq midline""")
+
+
+# ===========================================================
+# classes:
+
+class KmerIndex:
+    """sampled k-mers of all alleles of a reference fasta, as sorted NumPy arrays:
+    keys (k-mer hashes) and allele_ids (row numbers in names / lengths)
+    """
+    def __init__(self, version=""):
+        self.version = version
+        self.names = []
+        self.lengths = []
+        self._added = []  # arrays of k-mer hashes per allele, until the index is finished
+        self.keys = np.zeros(0, dtype=np.uint32)
+        self.allele_ids = np.zeros(0, dtype=np.int32)
+
+    def add(self, allele_name, seq):
+        self._added.append(sampled_kmers(seq))
+        self.names.append(allele_name)
+        self.lengths.append(len(seq))
+
+    def finish(self):
+        """builds the sorted lookup arrays from all added alleles
+        """
+        if not self._added:
+            return
+        ids = np.repeat(np.arange(len(self._added), dtype=np.int32), [len(kmers) for kmers in self._added])
+        keys = np.concatenate(self._added)
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.allele_ids = ids[order]
+        self._added = []
+
+    def save(self, index_file):
+        self.finish()
+        with open(index_file, "wb") as g:
+            np.savez(g, keys=self.keys, allele_ids=self.allele_ids, names=np.array(self.names, dtype=str),
+                     lengths=np.array(self.lengths, dtype=np.int32), version=np.array(self.version, dtype=str),
+                     params=np.array([K, SAMPLING], dtype=np.int32))
+
+    def __len__(self):
+        return len(self.names)
+
+    def candidates(self, seq, top_n=TOP_N):
+        """returns the (up to) top_n reference alleles sharing the most sampled k-mers with seq,
+        as list of (allele_name, allele length, number of shared k-mers), best first
+        (ties are kept in the order of the reference fasta)
+        """
+        query_kmers = sampled_kmers(seq)
+        starts = np.searchsorted(self.keys, query_kmers, side="left")
+        counts = np.searchsorted(self.keys, query_kmers, side="right") - starts
+        found = counts > 0
+        if not found.any():
+            return []
+        starts = starts[found]
+        counts = counts[found]
+        # positions of all matching entries, i.e. the concatenation of the ranges [start, start + count):
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        shared = np.bincount(self.allele_ids[offsets], minlength=len(self.names))
+        best = np.argsort(-shared, kind="stable")[:top_n]
+        return [(self.names[i], int(self.lengths[i]), int(shared[i])) for i in best if shared[i] > 0]
+
+
+# ===========================================================
+# functions:
+
+def make_kmer_index(fasta_file, index_file, version=""):
+    """builds the KmerIndex of all alleles of a reference fasta (as written by make_parsed_files:
+    one line per header and sequence) and saves it to index_file, returns the KmerIndex
+    """
+    kmer_index = KmerIndex(version)
+    with open(fasta_file) as f:
+        allele_name = None
+        for line in f:
+            line = line.strip()
+            if line.startswith(">"):
+                allele_name = line[1:].split()[0]
+            elif line and allele_name:
+                kmer_index.add(allele_name, line)
+                allele_name = None
+    temp_file = f"{index_file}.{os.getpid()}.tmp"  # other processes may build the same index at the same time
+    kmer_index.save(temp_file)
+    os.replace(temp_file, index_file)
+    return kmer_index
+
+
+def read_kmer_index_version(index_file):
+    """returns the reference version a {target}_kmer_index.npz was built for (without loading the index)
+    """
+    with np.load(index_file) as data:
+        return str(data["version"])
+
+
+def read_kmer_index(index_file):
+    """reads a {target}_kmer_index.npz written by make_kmer_index, returns a KmerIndex
+    """
+    with np.load(index_file) as data:
+        if tuple(data["params"]) != (K, SAMPLING):
+            raise ValueError(f"{index_file} was created with different k-mer parameters")
+        kmer_index = KmerIndex(str(data["version"]))
+        kmer_index.keys = data["keys"]
+        kmer_index.allele_ids = data["allele_ids"]
+        kmer_index.names = data["names"].tolist()
+        kmer_index.lengths = data["lengths"]
+    return kmer_index
+
+
+def kmer_codes(seq, k=K):
+    """returns (2-bit encoded k-mers of seq as uint32 array, start positions of these k-mers);
+    k-mers containing other characters than ACGT are left out
+    """
+    codes = _BASE_CODES[np.frombuffer(seq.encode(), dtype=np.uint8)]
+    if len(codes) < k:
+        return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.int64)
+    windows = sliding_window_view(codes, k)
+    positions = np.nonzero((windows < 4).all(axis=1))[0]
+    kmers = np.zeros(len(windows), dtype=np.uint32)
+    for i in range(k):
+        kmers = (kmers << np.uint32(2)) | (codes[i:len(windows) + i] & 3)
+    return kmers[positions], positions
+
+
+def sampled_kmers(seq):
+    """returns the (unique) hashes of the k-mers of seq that are used in the KmerIndex
+    """
+    (kmers, _) = kmer_codes(seq)
+    hashes = kmers * _HASH_FACTOR
+    return np.unique(hashes[hashes < _HASH_LIMIT])
+
+
+def find_anchors(query, ref, k=K):
+    """finds exact matches between query and ref from k-mers occurring once in each of them;
+    returns list of non-overlapping, co-linear blocks (query_start, ref_start, length) (0-based)
+    """
+    blocks = []
+    (q_kmers, q_pos) = kmer_codes(query, k)
+    (r_kmers, r_pos) = kmer_codes(ref, k)
+    (q_kmers, q_first, q_counts) = np.unique(q_kmers, return_index=True, return_counts=True)
+    (r_kmers, r_first, r_counts) = np.unique(r_kmers, return_index=True, return_counts=True)
+    q_unique = q_counts == 1
+    r_unique = r_counts == 1
+    (_, qi, ri) = np.intersect1d(q_kmers[q_unique], r_kmers[r_unique], assume_unique=True, return_indices=True)
+    q_anchor = q_pos[q_first[q_unique][qi]]
+    r_anchor = r_pos[r_first[r_unique][ri]]
+    order = np.argsort(q_anchor)
+
+    for (q, r) in zip(q_anchor[order].tolist(), r_anchor[order].tolist()):
+        if blocks:
+            (q0, r0, length) = blocks[-1]
+            if q - r == q0 - r0 and q <= q0 + length:  # same diagonal, overlapping: extend block
+                blocks[-1] = (q0, r0, q + k - q0)
+                continue
+            if q < q0 + length or r < r0 + length:  # conflicts with current block
+                continue
+        blocks.append((q, r, k))
+    return blocks
+
+
+def _free_end_gaps(aligner, side):
+    """makes gaps in the query at one end (side = "left" or "right") of the alignment free
+    """
+    if hasattr(aligner, f"open_{side}_deletion_score"):
+        setattr(aligner, f"open_{side}_deletion_score", 0)
+        setattr(aligner, f"extend_{side}_deletion_score", 0)
+    else:  # older Biopython versions only know the old names
+        setattr(aligner, f"query_{side}_open_gap_score", 0)
+        setattr(aligner, f"query_{side}_extend_gap_score", 0)
+
+
+@lru_cache(maxsize=None)
+def get_aligner(query_left_free=False, query_right_free=False):
+    """returns the (shared) aligner of the scoring scheme, created on first use
+    """
+    aligner = Align.PairwiseAligner()
+    aligner.mode = "global"
+    aligner.match_score = MATCH
+    aligner.mismatch_score = MISMATCH
+    aligner.gap_score = GAP
+    if query_left_free:
+        _free_end_gaps(aligner, "left")
+    if query_right_free:
+        _free_end_gaps(aligner, "right")
+    return aligner
+
+
+def align_segment(ref_part, query_part, aligner=None):
+    """returns (aligned ref, aligned query) of two (short) sequence parts, with '-' for gaps
+    (aligned globally by the given aligner, default: get_aligner())
+    """
+    if not ref_part:
+        return "-" * len(query_part), query_part
+    if not query_part:
+        return ref_part, "-" * len(ref_part)
+    if aligner is None:
+        if len(ref_part) == len(query_part):
+            return ref_part, query_part
+        aligner = get_aligner()
+    alignment = aligner.align(ref_part, query_part)[0]
+    return alignment[0], alignment[1]
+
+
+def best_local_segment(aligned_ref, aligned_query):
+    """returns (score, first column, last column + 1) of the best scoring part of an alignment
+    """
+    best = (0, 0, 0)
+    score = 0
+    start = 0
+    for (i, (r, q)) in enumerate(zip(aligned_ref, aligned_query)):
+        if r == "-" or q == "-":
+            score += GAP
+        elif r == q:
+            score += MATCH
+        else:
+            score += MISMATCH
+        if score <= 0:
+            score = 0
+            start = i + 1
+        elif score > best[0]:
+            best = (score, start, i + 1)
+    return best
+
+
+def align_to_candidate(query, ref, allele_name):
+    """aligns query to a candidate reference allele, anchored on exact k-mer matches;
+    returns the best local alignment as LocalHit, or None if they share no anchor
+    """
+    blocks = find_anchors(query, ref)
+    if not blocks:
+        return None
+
+    (q_first, r_first, _) = blocks[0]
+    ref_start = max(0, r_first - q_first - END_SLACK)
+    (aligned_ref, aligned_query) = align_segment(ref[ref_start:r_first], query[:q_first],
+                                                 get_aligner(query_left_free=True))
+    # remove leading reference bases not covered by the query:
+    lead = len(aligned_query) - len(aligned_query.lstrip("-"))
+    ref_pieces = [aligned_ref[lead:]]
+    query_pieces = [aligned_query[lead:]]
+    ref_start += lead - aligned_ref[:lead].count("-")
+
+    for (i, (q, r, length)) in enumerate(blocks):
+        ref_pieces.append(ref[r:r + length])
+        query_pieces.append(query[q:q + length])
+        if i + 1 < len(blocks):
+            (q_next, r_next, _) = blocks[i + 1]
+            (ref_part, query_part) = align_segment(ref[r + length:r_next], query[q + length:q_next])
+        else:
+            query_rest = len(query) - q - length
+            ref_part = ref[r + length:r + length + query_rest + END_SLACK]
+            (ref_part, query_part) = align_segment(ref_part, query[q + length:],
+                                                         get_aligner(query_right_free=True))
+            trail = len(query_part) - len(query_part.rstrip("-"))
+            if trail:
+                (ref_part, query_part) = (ref_part[:-trail], query_part[:-trail])
+        ref_pieces.append(ref_part)
+        query_pieces.append(query_part)
+
+    aligned_ref = "".join(ref_pieces)
+    aligned_query = "".join(query_pieces)
+    (score, start, end) = best_local_segment(aligned_ref, aligned_query)
+    if not score:
+        return None
+
+    hseq = aligned_ref[start:end]
+    qseq = aligned_query[start:end]
+    query_from = len(aligned_query[:start].replace("-", "")) + 1
+    hit_from = ref_start + len(aligned_ref[:start].replace("-", "")) + 1
+    midline = "".join("|" if r == q else " " for (r, q) in zip(hseq, qseq))
+    return LocalHit(allele_name=allele_name, allele_length=len(ref), score=score,
+                    query_from=query_from, query_to=query_from + len(qseq.replace("-", "")) - 1,
+                    hit_from=hit_from, hit_to=hit_from + len(hseq.replace("-", "")) - 1,
+                    qseq=qseq, hseq=hseq, midline=midline)
+
+
+def make_exact_hit(seq, allele_name, allele_length, start):
+    """returns the LocalHit of a sequence identical to (a part of) a reference allele, starting at start (0-based)
+    """
+    seq = seq.upper()
+    return LocalHit(allele_name=allele_name, allele_length=allele_length, score=len(seq),
+                    query_from=1, query_to=len(seq), hit_from=start + 1, hit_to=start + len(seq),
+                    qseq=seq, hseq=seq, midline="|" * len(seq))
+
+
+def bit_score(score):
+    return (LAMBDA * score - LN_K) / np.log(2)
+
+
+def find_closest_allele(seq, kmer_index, fasta, log, top_n=TOP_N):
+    """finds the reference allele best matching seq:
+    shortlists candidates via the kmer_index and aligns seq to each of them
+
+    :param seq: query sequence
+    :param kmer_index: KmerIndex of the reference
+    :param fasta: indexed reference fasta (see fasta_index.get_indexed_fasta)
+    :param log: logger instance
+    :param top_n: number of candidates to align
+    :return: LocalHit of the best alignment, or None if no candidate could be aligned
+    """
+    seq = seq.upper()
+    best = None
+    candidates = kmer_index.candidates(seq, top_n)
+    log.debug(f"\t{len(candidates)} candidate alleles: {', '.join(name for (name, _, _) in candidates)}")
+    for (allele_name, _, _) in candidates:
+        hit = align_to_candidate(seq, fasta.fetch(allele_name).upper(), allele_name)
+        if hit and (best is None or hit.score > best.score):
+            best = hit
+    return best
+
+
+if __name__ == '__main__':
+    pass
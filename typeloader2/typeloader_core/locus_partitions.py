@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+locus_partitions.py
+
+per-locus parts of the parsed reference fasta (= BLAST database) of a target,
+so a query whose locus is known only has to be blasted against the alleles of this locus.
+
+The partitions of a target are kept in reference_data/{target}_loci/parsed{target}_{locus}.fa
+(plus their BLAST database files); loci.txt lists the loci whose BLAST database was created successfully.
+"""
+import os
+import re
+import shutil
+
+# ===========================================================
+# parameters:
+
+PARTITION_LIST = "loci.txt"
+
+
+# ===========================================================
+# classes:
+
+class PartitionWriter:
+    """writes the alleles of a reference fasta into one fasta file per locus
+    """
+    def __init__(self, ref_dir, target):
+        self.partition_dir = get_partition_dir(ref_dir, target)
+        self.target = target
+        if os.path.isdir(self.partition_dir):  # left over from an earlier update
+            shutil.rmtree(self.partition_dir)
+        os.makedirs(self.partition_dir)
+        self.files = {}  # format: {locus: open fasta file}
+
+    def add(self, allele_name, seq):
+        locus = get_locus(allele_name)
+        if locus not in self.files:
+            self.files[locus] = open(get_partition_fasta(os.path.dirname(self.partition_dir), self.target, locus),
+                                     "w")
+        self.files[locus].write(">%s\n%s\n" % (allele_name, seq))
+
+    def close(self):
+        for myfile in self.files.values():
+            myfile.close()
+
+
+# ===========================================================
+# functions:
+
+def get_locus(allele_name):
+    """returns the locus of an allele name, e.g., 'HLA-A*01:01:01:01' => 'HLA-A', 'KIR2DL1*0010101' => 'KIR2DL1'
+    """
+    return allele_name.split("*")[0]
+
+
+def get_partition_dir(ref_dir, target):
+    return os.path.join(ref_dir, f"{target}_loci")
+
+
+def get_partition_fasta(ref_dir, target, locus):
+    """returns the path of the partition fasta of a locus
+    """
+    safe_locus = re.sub(r"[^A-Za-z0-9\-]", "_", locus)
+    return os.path.join(get_partition_dir(ref_dir, target), f"parsed{target}_{safe_locus}.fa")
+
+
+def list_partition_fastas(ref_dir, target):
+    """returns the partition fasta files of a target as dict {locus: path}
+    """
+    partition_dir = get_partition_dir(ref_dir, target)
+    if not os.path.isdir(partition_dir):
+        return {}
+    partitions = {}
+    for myfile in sorted(os.listdir(partition_dir)):
+        if myfile.startswith(f"parsed{target}_") and myfile.endswith(".fa"):
+            with open(os.path.join(partition_dir, myfile)) as f:
+                header = f.readline()
+            if header.startswith(">"):
+                partitions[get_locus(header[1:].split()[0])] = os.path.join(partition_dir, myfile)
+    return partitions
+
+
+def write_partition_list(ref_dir, target, loci):
+    """marks the BLAST databases of these loci as complete
+    """
+    with open(os.path.join(get_partition_dir(ref_dir, target), PARTITION_LIST), "w") as g:
+        g.write("\n".join(sorted(loci)) + "\n")
+
+
+def get_partitions(ref_dir, target):
+    """returns the usable partitions (with complete BLAST database) of a target as dict {locus: fasta path},
+    or {} if the reference has none
+    """
+    list_file = os.path.join(get_partition_dir(ref_dir, target), PARTITION_LIST)
+    if not os.path.isfile(list_file):
+        return {}
+    with open(list_file) as f:
+        loci = [line.strip() for line in f if line.strip()]
+    return {locus: get_partition_fasta(ref_dir, target, locus) for locus in loci}
+
+
+if __name__ == '__main__':
+    pass
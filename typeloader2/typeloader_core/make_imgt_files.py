@@ -207,7 +207,7 @@ def make_imgt_data(project_dir, samples, file_dic, allele_dic, cellEnaIdMap, gen
         newAlleleStub = getNewAlleleNameFromEna(enafile).split(":")[0]
         try:
             annotations = getCoordinates(blastOp, allelesFilename, targetFamily, settings, log, isENA=False,
-                                         incomplete_ok=True)
+                                         incomplete_ok=True, db_version=file_dic[local_name].get("db_version"))
         except KeyError as E:
             log.exception(E)
             with contextlib.suppress(FileNotFoundError):
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""
+reference_cache.py
+
+keeps the parsed reference alleles in memory,
+so the IPD reference has to be loaded only once per TypeLoader process
+instead of once per annotated allele
+"""
+import os
+from threading import Lock
+
+try:
+    from . import hla_embl_parser, kmer_index
+except ImportError:
+    import hla_embl_parser
+    import kmer_index
+
+# ===========================================================
+# parameters:
+
+_cache = {}  # format: {(ref_dir, target): (reference_key, alleles)}
+_gene_model_cache = {}  # format: {(ref_dir, target): (reference_key, GeneModelTable or None)}
+_sequence_index_cache = {}  # format: {(ref_dir, target): (reference_key, SequenceIndex or None)}
+_kmer_index_cache = {}  # format: {(ref_dir, target): (reference_key, KmerIndex or None)}
+_cache_lock = Lock()
+_kmer_build_lock = Lock()
+
+
+# ===========================================================
+# functions:
+
+def _read_first_word(myfile):
+    """returns the first word of a small text file, or None if the file does not exist or is empty
+    """
+    try:
+        with open(myfile, "r") as f:
+            content = f.read().split()
+    except IOError:
+        return None
+    if content:
+        return content[0]
+    return None
+
+
+def get_reference_key(target, ref_dir):
+    """returns the key identifying the current state of a local reference:
+    (version, md5 checksum), read from curr_version_{target}.txt and curr_md5_{target}.txt
+
+    :param target: designates target database, either 'KIR' or 'hla'
+    :param ref_dir: path to the reference files
+    """
+    version = _read_first_word(os.path.join(ref_dir, f"curr_version_{target}.txt"))
+    md5 = _read_first_word(os.path.join(ref_dir, f"curr_md5_{target}.txt"))
+    return version, md5
+
+
+def get_target_from_dat_file(dat_file):
+    """translates the path of an IPD .dat file into (ref_dir, target),
+    e.g., '/some/path/reference_data/KIR.dat' => ('/some/path/reference_data', 'KIR')
+    """
+    ref_dir = os.path.dirname(os.path.abspath(dat_file))
+    target = os.path.splitext(os.path.basename(dat_file))[0]
+    return ref_dir, target
+
+
+def load_reference_alleles(target, ref_dir, log):
+    """reads the reference alleles of a target from disk:
+    uses the byte-offset index {target}_dat_index.dump (written by make_parsed_files) if possible,
+    so single alleles are only parsed when needed;
+    otherwise loads parsed{target}.dump or, as last resort, parses {target}.dat completely
+
+    :return: dict-like object of format {allele_name: hla_embl_parser.Allele}
+    """
+    dat_file = os.path.join(ref_dir, f"{target}.dat")
+    index_file = os.path.join(ref_dir, f"{target}_dat_index.dump")
+    if os.path.isfile(index_file):
+        log.debug(f"\tUsing index {index_file}...")
+        try:
+            return hla_embl_parser.IndexedDatFile(dat_file, index_file, target.upper(), log)
+        except Exception as E:
+            log.warning(f"Could not use {index_file} ({repr(E)}), loading the parsed alleles instead")
+
+    dump_file = os.path.join(ref_dir, f"parsed{target}.dump")
+    if os.path.isfile(dump_file):
+        log.debug(f"\tLoading reference alleles from {dump_file}...")
+        try:
+            alleles = hla_embl_parser.read_parsed_dump(dump_file)
+            log.debug(f"\t\t=> found {len(alleles)} alleles")
+            return alleles
+        except Exception as E:
+            log.warning(f"Could not load {dump_file} ({repr(E)}), reading the .dat file instead")
+
+    log.debug(f"\tReading reference alleles from {dat_file}...")
+    alleles, _ = hla_embl_parser.read_dat_file(dat_file, target.upper(), log)
+    return alleles
+
+
+def get_reference_alleles(target, ref_dir, log):
+    """returns the parsed reference alleles of a target;
+    they are only read from disk if they are not cached yet or if the local reference version or
+    md5 checksum has changed since they were cached
+
+    :param target: designates target database, either 'KIR' or 'hla'
+    :param ref_dir: path to the reference files
+    :param log: logger instance
+    :return: dict-like object of format {allele_name: hla_embl_parser.Allele}
+    """
+    cache_key = (os.path.abspath(ref_dir), target)
+    reference_key = get_reference_key(target, ref_dir)
+    with _cache_lock:
+        cached = _cache.get(cache_key)
+        if cached and cached[0] == reference_key:
+            return cached[1]
+
+        log.debug(f"Loading {target} reference version {reference_key[0]} into memory...")
+        alleles = load_reference_alleles(target, ref_dir, log)
+        _cache[cache_key] = (reference_key, alleles)
+    return alleles
+
+
+def _get_cached_table(cache, target, ref_dir, table_file, reader, log):
+    """returns a precomputed table of a reference (read from table_file in ref_dir by reader),
+    cached like the alleles themselves; returns None if the table does not exist (yet)
+    """
+    cache_key = (os.path.abspath(ref_dir), target)
+    reference_key = get_reference_key(target, ref_dir)
+    with _cache_lock:
+        cached = cache.get(cache_key)
+        if cached and cached[0] == reference_key:
+            return cached[1]
+
+        table = None
+        table_path = os.path.join(ref_dir, table_file)
+        if os.path.isfile(table_path):
+            log.debug(f"Loading {table_path}...")
+            try:
+                table = reader(table_path)
+            except Exception as E:
+                log.warning(f"Could not load {table_path} ({repr(E)}), continuing without it")
+        cache[cache_key] = (reference_key, table)
+    return table
+
+
+def get_gene_models(target, ref_dir, log):
+    """returns the precomputed gene models of the reference alleles of a target
+    (from {target}_gene_models.dump, written by make_parsed_files), cached like the alleles themselves;
+    returns None if the reference has no gene model table (yet)
+
+    :param target: designates target database, either 'KIR' or 'hla'
+    :param ref_dir: path to the reference files
+    :param log: logger instance
+    :return: hla_embl_parser.GeneModelTable or None
+    """
+    return _get_cached_table(_gene_model_cache, target, ref_dir, f"{target}_gene_models.dump",
+                             hla_embl_parser.read_gene_models, log)
+
+
+def get_sequence_index(target, ref_dir, log):
+    """returns the hash index of the reference sequences of a target
+    (from {target}_seq_index.dump, written by make_parsed_files), cached like the alleles themselves;
+    returns None if the reference has no sequence index (yet)
+
+    :param target: designates target database, either 'KIR' or 'hla'
+    :param ref_dir: path to the reference files
+    :param log: logger instance
+    :return: hla_embl_parser.SequenceIndex or None
+    """
+    return _get_cached_table(_sequence_index_cache, target, ref_dir, f"{target}_seq_index.dump",
+                             hla_embl_parser.read_sequence_index, log)
+
+
+def build_kmer_index(target, ref_dir, log):
+    """builds {target}_kmer_index.npz from parsed{target}.fa, unless it exists already for the current version
+    (a reference update does not replace it, so an index of another version is rebuilt);
+    only the k-mer search engine and the locus classification of partitioned references need the k-mer index,
+    so it is built by the first search that uses it instead of with every reference update
+    """
+    index_file = os.path.join(ref_dir, f"{target}_kmer_index.npz")
+    fasta_file = os.path.join(ref_dir, f"parsed{target}.fa")
+    with _kmer_build_lock:
+        if not os.path.isfile(fasta_file):
+            return
+        (version, _) = get_reference_key(target, ref_dir)
+        if os.path.isfile(index_file):
+            try:
+                if kmer_index.read_kmer_index_version(index_file) == (version or ""):
+                    return
+            except Exception as E:
+                log.warning(f"Could not read {index_file} ({repr(E)}), building it again")
+        log.info(f"Building the k-mer index of the {target} reference (once per reference version)...")
+        kmer_index.make_kmer_index(fasta_file, index_file, version or "")
+
+
+def get_kmer_index(target, ref_dir, log):
+    """returns the k-mer index of the reference sequences of a target
+    (from {target}_kmer_index.npz, built on first use by build_kmer_index), cached like the alleles themselves;
+    returns None if the reference has no k-mer index and no parsed fasta to build it from
+
+    :param target: designates target database, either 'KIR' or 'hla'
+    :param ref_dir: path to the reference files
+    :param log: logger instance
+    :return: kmer_index.KmerIndex or None
+    """
+    cached = _kmer_index_cache.get((os.path.abspath(ref_dir), target))
+    if not cached or cached[0] != get_reference_key(target, ref_dir):  # else, the cached index is current
+        build_kmer_index(target, ref_dir, log)
+    return _get_cached_table(_kmer_index_cache, target, ref_dir, f"{target}_kmer_index.npz",
+                             kmer_index.read_kmer_index, log)
+
+
+def clear_reference_cache(target=None):
+    """removes cached reference alleles, gene models, sequence and k-mer indices
+    (of the given target or of all targets) from memory;
+    called whenever the local reference files are replaced
+    """
+    with _cache_lock:
+        for cache in [_cache, _gene_model_cache, _sequence_index_cache, _kmer_index_cache]:
+            for cache_key in list(cache.keys()):
+                if target is None or cache_key[1].lower() == target.lower():
+                    cache.pop(cache_key)
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+"""
+reference_store.py
+
+keeps several IPD releases of a reference side by side (under reference_data/versions/{target}),
+so alleles can be re-annotated with the reference version they were originally uploaded with.
+
+Each allele record is stored only once, addressed by its content hash (see hla_embl_parser.hash_dat_record),
+in a record store shared by all versions of a target. Per version, only a manifest
+(allele name => record hash) is kept; the reference fasta of a version is rebuilt from its manifest
+when it is needed (see get_version_fasta_dir). When old versions are removed, the record store is compacted,
+so it only contains records of the remaining versions.
+"""
+import os
+import shutil
+from pickle import dump, load, dumps, loads, HIGHEST_PROTOCOL
+from threading import Lock
+
+try:
+    from . import hla_embl_parser
+except ImportError:
+    import hla_embl_parser
+
+# ===========================================================
+# parameters:
+
+STORE_DIR = "versions"
+STORED_VERSIONS = 5  # number of reference versions kept per target
+
+_version_cache = {}  # format: {(store_dir, version): VersionAlleles}
+_version_cache_lock = Lock()
+_fasta_lock = Lock()
+
+
+# ===========================================================
+# classes:
+
+class RecordStore:
+    """append-only store of pickled Allele objects of one target, addressed by their record hash
+    """
+    def __init__(self, store_dir):
+        self.data_file = os.path.join(store_dir, "records.dump")
+        self.index_file = os.path.join(store_dir, "records_index.dump")
+        self.index = {}  # format: {record hash: (offset, length, allele_name)}
+        if os.path.isfile(self.index_file):
+            with open(self.index_file, "rb") as f:
+                self.index = load(f)
+
+    def __contains__(self, record_hash):
+        return record_hash in self.index
+
+    def add(self, record_hash, allele):
+        """appends an allele to the store (the index is only written by save())
+        """
+        data = dumps(allele, protocol=HIGHEST_PROTOCOL)
+        with open(self.data_file, "ab") as g:
+            offset = g.tell()
+            g.write(data)
+        self.index[record_hash] = (offset, len(data), allele.name)
+
+    def save(self):
+        with open(self.index_file, "wb") as g:
+            dump(self.index, g)
+
+    def get_name(self, record_hash):
+        return self.index[record_hash][2]
+
+    def get(self, record_hash):
+        (offset, length, _) = self.index[record_hash]
+        with open(self.data_file, "rb") as f:
+            f.seek(offset)
+            return loads(f.read(length))
+
+    def compact(self, keep_hashes):
+        """rewrites the store with only the records in keep_hashes, returns the number of removed records
+        """
+        removed = [record_hash for record_hash in self.index if record_hash not in keep_hashes]
+        if not removed:
+            return 0
+        temp_file = self.data_file + ".tmp"
+        new_index = {}
+        with open(self.data_file, "rb") as f, open(temp_file, "wb") as g:
+            for (record_hash, (offset, length, allele_name)) in self.index.items():
+                if record_hash not in keep_hashes:
+                    continue
+                f.seek(offset)
+                new_index[record_hash] = (g.tell(), length, allele_name)
+                g.write(f.read(length))
+        os.replace(temp_file, self.data_file)
+        self.index = new_index
+        self.save()
+        return len(removed)
+
+
+class VersionAlleles:
+    """read-only, dict-like access to the alleles of one stored reference version;
+    each allele is only loaded from the record store when it is requested
+    """
+    def __init__(self, store_dir, version):
+        self.version = version
+        self.records = RecordStore(store_dir)
+        with open(os.path.join(store_dir, version, "manifest.dump"), "rb") as f:
+            self.manifest = load(f)  # format: {allele_name: record hash}
+        self._loaded = {}
+
+    def __getitem__(self, allele_name):
+        if allele_name not in self._loaded:
+            self._loaded[allele_name] = self.records.get(self.manifest[allele_name])
+        return self._loaded[allele_name]
+
+    def __contains__(self, allele_name):
+        return allele_name in self.manifest
+
+    def __len__(self):
+        return len(self.manifest)
+
+    def __iter__(self):
+        return iter(self.manifest)
+
+    def keys(self):
+        return self.manifest.keys()
+
+
+# ===========================================================
+# functions:
+
+def get_store_dir(ref_dir, target):
+    """returns the directory where the versions of a target are stored
+    """
+    return os.path.join(ref_dir, STORE_DIR, target)
+
+
+def get_version_dir(ref_dir, target, version):
+    """returns the directory of a stored reference version, or None if this version is not stored
+    """
+    if not version:
+        return None
+    version_dir = os.path.join(get_store_dir(ref_dir, target), version)
+    if os.path.isfile(os.path.join(version_dir, "manifest.dump")):
+        return version_dir
+    return None
+
+
+def list_versions(ref_dir, target):
+    """returns the stored versions of a target, least recently stored first
+    """
+    store_dir = get_store_dir(ref_dir, target)
+    if not os.path.isdir(store_dir):
+        return []
+    version_dirs = [os.path.join(store_dir, mydir) for mydir in os.listdir(store_dir)]
+    version_dirs = [mydir for mydir in version_dirs if os.path.isfile(os.path.join(mydir, "manifest.dump"))]
+    version_dirs.sort(key=lambda mydir: os.path.getmtime(os.path.join(mydir, "manifest.dump")))
+    return [os.path.basename(mydir) for mydir in version_dirs]
+
+
+def add_version(target, ref_dir, log, keep=STORED_VERSIONS):
+    """adds the current local reference of a target (in ref_dir) to the store, unless it is already there:
+    the records of {target}.dat which are not stored yet are added to the record store,
+    and the manifest of this version is saved in its own directory.
+    The record hashes are taken from {target}_dat_index.dump if make_parsed_files wrote it for this .dat file
+    (see get_current_index), so only older references are read and hashed record by record.
+
+    :param target: designates target database, either 'KIR' or 'hla'
+    :param ref_dir: path to the reference files
+    :param log: logger instance
+    :param keep: number of versions to keep; older ones are removed
+    :return: the stored version (or None, if the local reference has no version)
+    """
+    version_file = os.path.join(ref_dir, f"curr_version_{target}.txt")
+    dat_file = os.path.join(ref_dir, f"{target}.dat")
+    if not (os.path.isfile(version_file) and os.path.isfile(dat_file)):
+        return None
+    with open(version_file, "r") as f:
+        version = f.read().strip()
+    if not version or get_version_dir(ref_dir, target, version):
+        return version or None
+
+    log.debug(f"\tAdding {target} version {version} to the reference store...")
+    store_dir = get_store_dir(ref_dir, target)
+    version_dir = os.path.join(store_dir, version)
+    os.makedirs(version_dir, exist_ok=True)
+
+    records = RecordStore(store_dir)
+    index_data = get_current_index(target, ref_dir, version)
+    if index_data:
+        (manifest, new_records) = add_records_from_index(records, index_data, ref_dir, target)
+    else:
+        (manifest, new_records) = add_records_from_dat(records, dat_file, target, log)
+    records.save()
+    log.debug(f"\t\t=> {len(manifest)} alleles, {new_records} of them not stored before")
+
+    with open(os.path.join(version_dir, f"curr_version_{target}.txt"), "w") as g:
+        g.write(version)
+    with open(os.path.join(version_dir, "manifest.dump"), "wb") as g:  # written last: marks version as complete
+        dump(manifest, g)
+
+    remove_old_versions(ref_dir, target, keep, log)
+    return version
+
+
+def get_current_index(target, ref_dir, version):
+    """returns the content of {target}_dat_index.dump (see hla_embl_parser.read_dat_index)
+    if make_parsed_files wrote it for the current {target}.dat of this version with record hashes and dump offsets,
+    else None
+    """
+    index_file = os.path.join(ref_dir, f"{target}_dat_index.dump")
+    dump_file = os.path.join(ref_dir, f"parsed{target}.dump")
+    if not (os.path.isfile(index_file) and os.path.isfile(dump_file)):
+        return None
+    index_data = hla_embl_parser.read_dat_index(index_file)
+    if not (index_data.get("hashes") and index_data.get("dumped")) or index_data.get("version") != version \
+            or index_data.get("size") != os.path.getsize(os.path.join(ref_dir, f"{target}.dat")):
+        return None
+    return index_data
+
+
+def add_records_from_index(records, index_data, ref_dir, target):
+    """adds the alleles of the current local reference to the record store via the record hashes
+    make_parsed_files wrote to the dat index; alleles not stored yet are read from parsed{target}.dump,
+    so the .dat file is neither read nor hashed again;
+    returns (manifest of format {allele_name: record hash}, number of added records)
+    """
+    known_alleles = hla_embl_parser.KnownAlleles(os.path.join(ref_dir, f"parsed{target}.dump"), index_data)
+    manifest = {}
+    new_records = 0
+    try:
+        for (allele_name, record_hash) in index_data["hashes"].items():
+            if record_hash not in records:
+                records.add(record_hash, known_alleles[record_hash])
+                new_records += 1
+            manifest[allele_name] = record_hash
+    finally:
+        known_alleles.close()
+    return manifest, new_records
+
+
+def add_records_from_dat(records, dat_file, target, log):
+    """adds the alleles of a .dat file to the record store, hashing it record by record
+    (for references without a current dat index);
+    returns (manifest of format {allele_name: record hash}, number of added records)
+    """
+    release_regex = hla_embl_parser.get_release_regex(target.upper())
+    manifest = {}
+    new_records = 0
+    for (_, _, data) in hla_embl_parser.iter_dat_records(dat_file):
+        (record_hash, _) = hla_embl_parser.hash_dat_record(data, release_regex)
+        if record_hash in records:
+            allele_name = records.get_name(record_hash)
+        else:
+            (allele, _) = hla_embl_parser.parse_dat_record(data, target.upper(), log, release_regex)
+            if not allele or not hla_embl_parser.is_usable_allele(allele.name, target.upper()):
+                continue
+            records.add(record_hash, allele)
+            allele_name = allele.name
+            new_records += 1
+        manifest[allele_name] = record_hash
+    return manifest, new_records
+
+
+def remove_old_versions(ref_dir, target, keep, log):
+    """removes the oldest stored versions of a target, so at most keep versions remain,
+    and removes the records no remaining version refers to from the record store
+    """
+    versions = list_versions(ref_dir, target)
+    store_dir = get_store_dir(ref_dir, target)
+    removed_versions = versions[:max(len(versions) - keep, 0)]
+    if not removed_versions:
+        return
+    for version in removed_versions:
+        log.debug(f"\tRemoving {target} version {version} from the reference store...")
+        shutil.rmtree(os.path.join(store_dir, version), ignore_errors=True)
+
+    keep_hashes = set()
+    for version in versions[len(removed_versions):]:
+        with open(os.path.join(store_dir, version, "manifest.dump"), "rb") as f:
+            keep_hashes.update(load(f).values())
+    with _version_cache_lock:  # cached versions know the old record offsets
+        for key in [key for key in _version_cache if key[0] == store_dir]:
+            _version_cache.pop(key)
+        removed_records = RecordStore(store_dir).compact(keep_hashes)
+    log.debug(f"\t\t=> removed {removed_records} records no longer used by any stored version")
+
+
+def get_version_alleles(target, ref_dir, version, log):
+    """returns the alleles of a stored reference version (cached per process),
+    or None if this version is not stored
+
+    :return: dict-like object of format {allele_name: hla_embl_parser.Allele}
+    """
+    if not get_version_dir(ref_dir, target, version):
+        return None
+    store_dir = get_store_dir(ref_dir, target)
+    with _version_cache_lock:
+        alleles = _version_cache.get((store_dir, version))
+        if alleles is None:
+            log.debug(f"Loading stored {target} reference version {version}...")
+            alleles = VersionAlleles(store_dir, version)
+            _version_cache[(store_dir, version)] = alleles
+    return alleles
+
+
+def get_version_fasta_dir(target, ref_dir, version, log):
+    """returns the directory of a stored reference version containing its reference fasta (parsed{target}.fa),
+    which is written from the manifest of this version on first use; or None if this version is not stored
+    """
+    version_dir = get_version_dir(ref_dir, target, version)
+    if not version_dir:
+        return None
+    fasta_file = os.path.join(version_dir, f"parsed{target}.fa")
+    with _fasta_lock:
+        if not os.path.isfile(fasta_file):
+            log.debug(f"Writing reference fasta of stored {target} version {version}...")
+            alleles = get_version_alleles(target, ref_dir, version, log)
+            temp_file = fasta_file + ".tmp"
+            with open(temp_file, "w") as g:
+                for allele_name in alleles:
+                    allele = alleles[allele_name]
+                    if hla_embl_parser.use_in_reference_fasta(allele, target):
+                        g.write(f">{allele_name}\n{allele.seq}\n")
+            os.replace(temp_file, fasta_file)
+    return version_dir
+
+
+if __name__ == '__main__':
+    pass
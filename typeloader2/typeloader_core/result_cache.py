@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+"""
+result_cache.py
+
+persistent on-disk cache of the results of processing query sequences
+(BLAST output, closest known alleles and annotations),
+so a sequence that is processed again (e.g., when an allele is started over
+or its IPD files are created) does not have to be blasted and annotated again.
+
+Each entry is keyed by the SHA-256 hashes of the query sequences plus everything else its result depends on
+(target family, BLAST database incl. restricted reference, reference version).
+Entries are stored as one pickle file each in {temp_dir}/result_cache;
+if the cache grows beyond MAX_CACHE_SIZE, the least recently used entries are removed
+until it is no larger than EVICT_TO of MAX_CACHE_SIZE. The size of the cache is tracked in memory,
+so the cache directory is only scanned once per process and whenever the limit is exceeded.
+"""
+import os
+import re
+import hashlib
+from pickle import dump, load
+from threading import Lock
+
+try:
+    from .reference_cache import get_reference_key
+    from .blast_results import read_database
+    from . import staging
+except ImportError:
+    from reference_cache import get_reference_key
+    from blast_results import read_database
+    import staging
+
+# ===========================================================
+# parameters:
+
+CACHE_DIRNAME = "result_cache"
+CACHE_VERSION = 1  # increase if the format of cached results changes
+MAX_CACHE_SIZE = 500 * 1024 * 1024  # bytes
+EVICT_TO = 0.9  # fraction of MAX_CACHE_SIZE the cache is reduced to when it grew too large
+
+stats = {"hits": 0, "misses": 0}
+_stats_lock = Lock()
+_cache_sizes = {}  # format: {cache_dir: size of all entries in bytes, as far as known to this process}
+_cache_sizes_lock = Lock()
+
+
+# ===========================================================
+# classes:
+
+class ResultCache:
+    """stores picklable results under keys (= tuples of strings, numbers, booleans or None) in cache_dir
+    """
+    def __init__(self, cache_dir, max_size=MAX_CACHE_SIZE):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_path(self, kind, key):
+        key_hash = hashlib.sha256(repr((CACHE_VERSION, kind) + tuple(key)).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{kind}_{key_hash}.dump")
+
+    def get(self, kind, key, log):
+        """returns the cached result of this kind and key, or None if there is none
+        """
+        path = self.get_path(kind, key)
+        try:
+            with open(path, "rb") as f:
+                result = load(f)
+            os.utime(path)  # mark as recently used
+        except Exception:  # missing, or damaged by an interrupted write
+            result = None
+        count_lookup(kind, result is not None, log)
+        return result
+
+    def put(self, kind, key, result, log):
+        """stores a result; problems writing the cache are logged, but never raised
+        """
+        path = self.get_path(kind, key)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, "wb") as g:
+                dump(result, g)
+                size = g.tell()
+            os.replace(temp_path, path)  # atomic, so concurrent readers never see half-written entries
+            if self.add_size(size) > self.max_size:
+                self.evict(log)
+        except Exception as E:
+            log.warning(f"Could not write result cache entry {path}: {repr(E)}")
+            if os.path.isfile(temp_path):
+                os.remove(temp_path)
+
+    def add_size(self, size):
+        """adds the size of a new entry to the tracked size of the cache (scanned on first use), returns the sum
+        """
+        with _cache_sizes_lock:
+            if self.cache_dir not in _cache_sizes:
+                _cache_sizes[self.cache_dir] = sum(size for (_, size, _) in self.list_entries())
+            else:
+                _cache_sizes[self.cache_dir] += size
+            return _cache_sizes[self.cache_dir]
+
+    def list_entries(self):
+        """returns (last use, size, path) of all entries
+        """
+        entries = []
+        for myfile in os.listdir(self.cache_dir):
+            if myfile.endswith(".dump"):
+                path = os.path.join(self.cache_dir, myfile)
+                try:
+                    stat = os.stat(path)
+                except OSError:  # removed by another process in the meantime
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self, log):
+        """if the cache is larger than max_size, removes the least recently used entries
+        until it is no larger than EVICT_TO of max_size
+        """
+        entries = self.list_entries()
+        total_size = sum(size for (_, size, _) in entries)
+        removed = 0
+        if total_size > self.max_size:
+            entries.sort()
+            for (_, size, path) in entries:
+                if total_size <= self.max_size * EVICT_TO:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total_size -= size
+                removed += 1
+            log.debug(f"Removed {removed} least recently used entries from the result cache")
+        with _cache_sizes_lock:
+            _cache_sizes[self.cache_dir] = total_size
+
+
+# ===========================================================
+# functions:
+
+def get_result_cache(settings):
+    """returns the ResultCache of a user, or None if settings have no temp_dir (e.g., in scripts)
+    """
+    if not settings or not settings.get("temp_dir"):
+        return None
+    return ResultCache(os.path.join(settings["temp_dir"], CACHE_DIRNAME))
+
+
+def count_lookup(kind, hit, log):
+    with _stats_lock:
+        stats["hits" if hit else "misses"] += 1
+        msg = f"Result cache {'hit' if hit else 'miss'} for {kind} (hits: {stats['hits']}, misses: {stats['misses']})"
+    if hit:
+        log.info(msg)
+    else:
+        log.debug(msg)
+
+
+def hash_sequences(seqs):
+    """returns the SHA-256 hashes of the (upper-cased) sequences as tuple
+    """
+    return tuple(hashlib.sha256(str(seq).upper().encode("utf-8")).hexdigest() for seq in seqs)
+
+
+def get_database_key(database):
+    """returns the part of a cache key identifying a BLAST database (full reference, locus partition
+    or restricted reference): its absolute path and the state (version, md5) of the reference it belongs to
+    """
+    database = os.path.abspath(database)
+    db_match = re.search(r"parsed(KIR|hla)(_[^/\\]+)?\.fa$", database)
+    if not db_match:
+        return database, None, None
+    ref_dir = os.path.dirname(database)
+    if db_match.group(2):  # locus partition in {ref_dir}/{target}_loci
+        ref_dir = os.path.dirname(ref_dir)
+    return (database,) + get_reference_key(db_match.group(1), ref_dir)
+
+
+def read_queries(fasta_file):
+    """returns (IDs (= first word of the header), sequences) of the records of a fasta file
+    """
+    (query_ids, seqs) = ([], [])
+    with staging.open_text(fasta_file) as f:  # may be an in-memory temp file
+        for line in f:
+            line = line.strip()
+            if line.startswith(">"):
+                query_ids.append(line[1:].split()[0] if line[1:].strip() else "")
+                seqs.append([])
+            elif line and seqs:
+                seqs[-1].append(line)
+    return query_ids, ["".join(seq) for seq in seqs]
+
+
+def get_query_key(blast_file, query_fasta_file):
+    """returns (query IDs, cache key part) for the results of a BLAST output file and its query fasta file:
+    the key part consists of the hashes of the query sequences and the key of the BLAST database
+    """
+    (query_ids, seqs) = read_queries(query_fasta_file)
+    return query_ids, hash_sequences(seqs) + get_database_key(read_database(blast_file) or "")
+
+
+def to_positions(results, query_ids):
+    """translates a result dict {query ID: result} into {position of the query in its fasta file: result},
+    so it can be reused for the same sequences under other names; returns None if query IDs are not unique
+    """
+    if len(set(query_ids)) != len(query_ids) or not set(results).issubset(query_ids):
+        return None
+    positions = {query_id: i for (i, query_id) in enumerate(query_ids)}
+    return {positions[query_id]: result for (query_id, result) in results.items()}
+
+
+def from_positions(results, query_ids):
+    """reverses to_positions
+    """
+    return {query_ids[i]: result for (i, result) in results.items()}
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+staging.py
+
+in-memory temp files of the allele upload (setting temp_files = memory):
+instead of copying a raw file to the temp dir and writing its fasta file and BLAST output there,
+the upload keeps these files in memory under their temp paths ("staged files").
+The core functions read files via open_text / read_text and write them via open_for_writing,
+so staged and real files are handled alike; files derived from a staged file are staged as well.
+Staged files are only written to disk once, when the allele is saved to its sample directory
+(see save, used by general.move_rename_file).
+
+This saves several writes, renames and re-reads per allele, which are slow if root_path is on a network share.
+Staged files belong to the process: worker processes hand theirs over via pop_dir / stage_all.
+"""
+import io
+import os
+import shutil
+from contextlib import contextmanager
+from threading import Lock
+
+# ===========================================================
+# parameters:
+
+_files = {}  # format: {absolute path: text}
+_lock = Lock()
+
+
+# ===========================================================
+# functions:
+
+def is_enabled(settings):
+    """returns True if the temp files of uploads should be kept in memory
+    """
+    return settings.get("temp_files", "disk") == "memory"
+
+
+def _key(path):
+    return os.path.abspath(path)
+
+
+def stage(path, text):
+    """keeps text in memory as the content of path (instead of writing it to disk)
+    """
+    with _lock:
+        _files[_key(path)] = text
+
+
+def is_staged(path):
+    return _key(path) in _files
+
+
+def unstage(path):
+    """drops a staged file, returns its text (or None if it was not staged)
+    """
+    with _lock:
+        return _files.pop(_key(path), None)
+
+
+def exists(path):
+    return is_staged(path) or os.path.isfile(path)
+
+
+def read_text(path):
+    """returns the content of a staged or real file
+    """
+    with open_text(path) as f:
+        return f.read()
+
+
+def open_text(path):
+    """opens a staged or real file for reading (in text mode with universal newlines, like open(path))
+    """
+    text = _files.get(_key(path))
+    if text is None:
+        return open(path)
+    return io.StringIO(text, newline=None)
+
+
+@contextmanager
+def open_for_writing(path, staged):
+    """opens path for writing (like open(path, "w")); if staged, the written text is only kept in memory
+    """
+    if not staged:
+        with open(path, "w") as g:
+            yield g
+        return
+    g = io.StringIO()
+    yield g
+    stage(path, g.getvalue())
+
+
+def rewrite(path, text):
+    """replaces the content of a staged or real file
+    """
+    with open_for_writing(path, is_staged(path)) as g:
+        g.write(text)
+
+
+def replace(src, dst):
+    """replaces dst by src (both staged or both real files)
+    """
+    if is_staged(src):
+        stage(dst, unstage(src))
+    else:
+        os.remove(dst)
+        shutil.move(src, dst)
+
+
+def save(path, target_path):
+    """writes a staged file to target_path and drops it from memory
+    """
+    text = unstage(path)
+    with open(target_path, "w", newline="") as g:
+        g.write(text)
+
+
+def pop_dir(mydir):
+    """drops all staged files directly within mydir, returns them as {path: text}
+    """
+    mydir = _key(mydir)
+    with _lock:
+        paths = [path for path in _files if os.path.dirname(path) == mydir]
+        return {path: _files.pop(path) for path in paths}
+
+
+def stage_all(files):
+    """stages files returned by pop_dir (e.g., in another process)
+    """
+    with _lock:
+        _files.update(files)
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""
+timing.py
+
+optional timing of the stages of the allele pipeline (upload, parsing, BLAST, annotation, saving):
+once enabled (see enable), each stage timed via stage() or @timed appends one JSON line
+{"time", "stage", "seconds", "pid", "thread", ...} to the timing file, which lies next to the user's log file.
+Stages may be nested (e.g., getCoordinates runs within make_ENA_file).
+
+Records can additionally be collected in memory (see collect), e.g. for the summary of a bulk upload.
+Worker processes write to the same timing file; their collected records are passed back via add_records.
+
+While disabled (default), stage() returns a shared no-op context manager and @timed functions
+only check one flag, so the instrumentation costs next to nothing.
+"""
+import os
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock, current_thread
+
+# ===========================================================
+# parameters:
+
+_timing_file = None  # set by enable
+_collectors = []  # lists records are collected in (see collect)
+_lock = Lock()
+
+
+# ===========================================================
+# classes:
+
+class _NoTimer:
+    """returned by stage() while timing is disabled
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_no_timer = _NoTimer()
+
+
+class _Timer:
+    def __init__(self, name, info):
+        self.name = name
+        self.info = info
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.start, **self.info)
+        return False
+
+
+# ===========================================================
+# functions:
+
+def enable(timing_file):
+    """starts timing the pipeline stages, appending the results to timing_file (JSON lines)
+    """
+    global _timing_file
+    _timing_file = timing_file
+
+
+def disable():
+    global _timing_file
+    _timing_file = None
+
+
+def is_enabled():
+    return _timing_file is not None
+
+
+def get_timing_file():
+    return _timing_file
+
+
+def get_timing_filename(logfile):
+    """returns the name of the timing file belonging to a log file
+    """
+    return os.path.splitext(logfile)[0] + "_timings.jsonl"
+
+
+def stage(name, **info):
+    """context manager timing the code within as stage name; info is added to the record
+    """
+    if _timing_file is None:
+        return _no_timer
+    return _Timer(name, info)
+
+
+def timed(func):
+    """decorator timing each call of func as a stage named like func
+    """
+    name = func.__name__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if _timing_file is None:
+            return func(*args, **kwargs)
+        with _Timer(name, {}):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def record(name, seconds, **info):
+    """writes a timing record to the timing file and adds it to all active collectors
+    """
+    timing_file = _timing_file
+    if timing_file is None:
+        return
+    myrecord = {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "stage": name, "seconds": round(seconds, 6),
+                "pid": os.getpid(), "thread": current_thread().name}
+    myrecord.update(info)
+    line = json.dumps(myrecord, default=str) + "\n"
+    with _lock:
+        try:
+            with open(timing_file, "a") as g:  # opened per record, so processes can write to the same file
+                g.write(line)
+        except OSError:  # timing must never break the pipeline
+            pass
+        for collector in _collectors:
+            collector.append(myrecord)
+
+
+def add_records(records):
+    """adds records collected elsewhere (e.g., in a worker process) to all active collectors
+    """
+    with _lock:
+        for collector in _collectors:
+            collector.extend(records)
+
+
+@contextmanager
+def collect():
+    """collects all records of this process (all threads) made within, yields the list of records
+    """
+    records = []
+    with _lock:
+        _collectors.append(records)
+    try:
+        yield records
+    finally:
+        with _lock:
+            _collectors.remove(records)
+
+
+def summarize(records):
+    """returns a table of the number of calls, total, mean and maximum duration of each stage
+    (in the order the stages first finished)
+    """
+    durations = defaultdict(list)
+    for myrecord in records:
+        durations[myrecord["stage"]].append(myrecord["seconds"])
+    if not durations:
+        return ""
+    width = max(len("Stage"), max(len(name) for name in durations))
+    lines = [f"{'Stage':<{width}}  {'Calls':>5}  {'Total s':>8}  {'Mean s':>7}  {'Max s':>7}"]
+    for (name, seconds) in durations.items():
+        lines.append(f"{name:<{width}}  {len(seconds):>5}  {sum(seconds):>8.2f}  "
+                     f"{sum(seconds) / len(seconds):>7.2f}  {max(seconds):>7.2f}")
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    pass
@@ -6,6 +6,7 @@ update_referce.py
 handles updating of the reference data for TypeLoader
 """
 import os
+import io
 import zipfile
 from pathlib import Path
 import datetime
@@ -17,9 +18,9 @@ from typing import Tuple
 import logging
 
 if __name__ == "__main__":
-    import hla_embl_parser
+    import hla_embl_parser, reference_cache, fasta_index, reference_store, locus_partitions
 else:
-    from . import hla_embl_parser
+    from . import hla_embl_parser, reference_cache, fasta_index, reference_store, locus_partitions
 
 remote_db_path = {
     "hla_path": "https://github.com/DKMS-LSL/IMGTHLA2/raw/Latest/hla.dat.zip",
@@ -40,9 +41,35 @@ COUNTRY_URL = "https://raw.githubusercontent.com/DKMS-LSL/typeloader_reference_p
 COUNTRY_FILE = "collection_country_options.csv"
 
 
-def read_remote_file(myurl, proxy, timeout, log, return_binary=False, to_file=None):
-    """reads a remote file from a given URL, either using the given proxy or not if none is given,
-    returns the data as string
+CHUNK_SIZE = 1024 * 1024  # bytes read at once while streaming reference files
+RESTRICTED_DB_CACHE_SIZE = 20  # number of restricted reference databases kept on disk
+
+
+class HashingReader(io.RawIOBase):
+    """wraps a binary stream (e.g. a download) and calculates the MD5 checksum of everything read from it,
+    so the checksum is available as soon as the stream was read once
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.md5 = hashlib.md5()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.stream.read(len(buffer))
+        n = len(data)
+        buffer[:n] = data
+        self.md5.update(data)
+        return n
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+
+def open_remote_file(myurl, proxy, timeout, log):
+    """opens a remote file from a given URL, either using the given proxy or not if none is given,
+    returns the response (a binary stream)
     """
     if proxy:
         log.debug("Using proxy...")
@@ -52,7 +79,25 @@ def read_remote_file(myurl, proxy, timeout, log, return_binary=False, to_file=No
         log.debug("Not using proxy...")
         opener = urllib.request.build_opener()
 
-    with opener.open(myurl, timeout=timeout) as request:
+    return opener.open(myurl, timeout=timeout)
+
+
+def download_file(myurl, proxy, timeout, log, to_file):
+    """downloads a remote file in chunks to to_file, calculating its MD5 checksum on the fly;
+    returns the MD5 checksum
+    """
+    with open_remote_file(myurl, proxy, timeout, log) as request:
+        stream = HashingReader(request)
+        with open(to_file, 'wb') as g:
+            shutil.copyfileobj(stream, g, CHUNK_SIZE)
+    return stream.hexdigest()
+
+
+def read_remote_file(myurl, proxy, timeout, log, return_binary=False, to_file=None):
+    """reads a remote file from a given URL, either using the given proxy or not if none is given,
+    returns the data as string
+    """
+    with open_remote_file(myurl, proxy, timeout, log) as request:
         if return_binary:
             if to_file:
                 with open(to_file, 'wb') as g:
@@ -130,20 +175,28 @@ def get_local_md5checksum(local_reference_file, log):
     """
     log.debug("\tGetting checksum of local file {}...".format(local_reference_file))
 
-    md5 = hashlib.md5(open(local_reference_file, "rb").read()).hexdigest()
+    md5 = hashlib.md5()
+    with open(local_reference_file, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            md5.update(chunk)
+    md5 = md5.hexdigest()
     log.debug("\t=> {}".format(md5))
     return md5
 
 
 def make_blast_db(target, ref_dir, blast_path, log):
-    """calls blast to create the local blast database for TypeLoader;
+    """calls blast to create the local blast database for TypeLoader (and its per-locus partitions, if any)
+    and creates the fasta index (.fai) of the parsed reference next to it;
     returns success (=BOOL), msg (=String if error; None if not)
     """
     log.debug("\tCreating local blast database...")
     makeblastdb = os.path.join(blast_path, "makeblastdb")
-    cmd_list = [makeblastdb, "-dbtype", "nucl", "-in", "{}".format(os.path.join(ref_dir, "parsed{}.fa".format(target)))]
+    fa_file = os.path.join(ref_dir, "parsed{}.fa".format(target))
+    cmd_list = [makeblastdb, "-dbtype", "nucl", "-in", "{}".format(fa_file)]
     try:
         subprocess.run(cmd_list, check=True, shell=False)
+        fasta_index.make_fasta_index(fa_file, log)
+        make_partition_dbs(target, ref_dir, blast_path, log)
         return True, None
 
     except Exception as E:
@@ -155,8 +208,26 @@ def make_blast_db(target, ref_dir, blast_path, log):
         return False, msg
 
 
+def make_partition_dbs(target, ref_dir, blast_path, log):
+    """creates the blast databases of the per-locus partitions of a reference (see locus_partitions);
+    as the full database is used whenever they are missing, failures are only logged
+    """
+    partitions = locus_partitions.list_partition_fastas(ref_dir, target)
+    if not partitions:
+        return
+    log.debug(f"\tCreating blast databases for {len(partitions)} loci...")
+    makeblastdb = os.path.join(blast_path, "makeblastdb")
+    try:
+        for fa_file in partitions.values():
+            subprocess.run([makeblastdb, "-dbtype", "nucl", "-in", fa_file], check=True, shell=False,
+                           stdout=subprocess.DEVNULL)
+        locus_partitions.write_partition_list(ref_dir, target, partitions.keys())
+    except Exception as E:
+        log.warning(f"Could not create the per-locus blast databases, using the full database only: {repr(E)}")
+
+
 def move_files(ref_path_temp, ref_path, target, log):
-    """moves all files from ref_path_temp to ref_path, replacing existing files
+    """moves all files from ref_path_temp to ref_path, replacing existing files and directories
     """
     log.debug("\tReplacing old files with new files...")
     for myfile in os.listdir(ref_path_temp):
@@ -164,7 +235,9 @@ def move_files(ref_path_temp, ref_path, target, log):
             src_path = os.path.join(ref_path_temp, myfile)
             target_path = os.path.join(ref_path, myfile)
             log.debug("\t\t- {}".format(myfile))
-            if os.path.exists(target_path):
+            if os.path.isdir(target_path):
+                shutil.rmtree(target_path)
+            elif os.path.exists(target_path):
                 os.remove(target_path)
             shutil.move(src_path, target_path)
 
@@ -204,8 +277,22 @@ def check_database(db_name, reference_local_path, proxy, log, skip_if_updated_to
     return True, msg
 
 
-def update_database(db_name, reference_local_path, blast_path, proxy, log, version=None):
-    """updates a reference database
+def get_dat_file_from_zip(zf, use_dbname):
+    """returns the name of the .dat file within an opened zip file of IPD
+    """
+    names = zf.namelist()
+    dat_name = f"{use_dbname}.dat"
+    if dat_name in names:
+        return dat_name
+    for name in names:
+        if name.endswith(".dat"):
+            return name
+    raise ValueError(f"Could not find {dat_name} in the downloaded zip file!")
+
+
+def update_database(db_name, reference_local_path, blast_path, proxy, log, version=None, incremental=True):
+    """updates a reference database;
+    if incremental, only alleles whose records changed since the current local reference are parsed again
     """
     log.info("Retrieving new database version for {}...".format(db_name))
     if db_name == "kir":
@@ -215,7 +302,7 @@ def update_database(db_name, reference_local_path, blast_path, proxy, log, versi
         use_dbname = db_name
         is_zipped = True
 
-    ref_path_temp = os.path.join(reference_local_path, "temp")
+    ref_path_temp = os.path.join(reference_local_path, f"temp_{use_dbname}")  # own dir, so HLA & KIR can run at once
     os.makedirs(ref_path_temp, exist_ok=True)
 
     if version:
@@ -224,21 +311,32 @@ def update_database(db_name, reference_local_path, blast_path, proxy, log, versi
         remote_db_file = remote_db_path["%s_path" % db_name]
     log.debug(f"\tdownloading new file from {remote_db_file}...")
     local_db_file = os.path.join(ref_path_temp, "%s.dat" % use_dbname)
+    previous_dir = reference_local_path if incremental else None
 
+    # the .dat file is parsed while it is read from the download (or zip member),
+    # so it is never held in memory completely:
     try:
         if is_zipped:
             local_db_file_zipped = local_db_file + ".zip"
-            read_remote_file(remote_db_file, proxy, 60, log, return_binary=True, to_file=local_db_file_zipped)
-            local_md5 = get_local_md5checksum(local_db_file_zipped, log)
+            local_md5 = download_file(remote_db_file, proxy, 60, log, to_file=local_db_file_zipped)
+            log.debug("\t => successfully downloaded new {} file".format(db_name))
+            log.debug("\tCreating parsed files...")
             with zipfile.ZipFile(local_db_file_zipped) as zf:
-                zf.extractall(ref_path_temp)
+                member = get_dat_file_from_zip(zf, use_dbname)
+                with zf.open(member) as dat_stream:
+                    version = hla_embl_parser.make_parsed_files(use_dbname, ref_path_temp, log,
+                                                                dat_stream=dat_stream,
+                                                                previous_dir=previous_dir)
         else:
-            db_response = read_remote_file(remote_db_file, proxy, 60, log, return_binary=True)
-            with open(local_db_file, "wb") as db_local:
-                db_local.write(db_response)
-            local_md5 = get_local_md5checksum(local_db_file, log)
+            with open_remote_file(remote_db_file, proxy, 60, log) as db_response:
+                stream = HashingReader(db_response)
+                log.debug("\tCreating parsed files while downloading...")
+                version = hla_embl_parser.make_parsed_files(use_dbname, ref_path_temp, log,
+                                                            dat_stream=io.BufferedReader(stream, CHUNK_SIZE),
+                                                            previous_dir=previous_dir)
+                local_md5 = stream.hexdigest()
+            log.debug("\t => successfully downloaded new {} file".format(db_name))
 
-        log.debug("\t => successfully downloaded new {} file".format(db_name))
         log.debug(f"\t => MD5 of downloaded file: {local_md5}")
     except urllib.error.HTTPError:
         msg = f"Sorry, could not find file {remote_db_file}!\n\n" \
@@ -248,9 +346,6 @@ def update_database(db_name, reference_local_path, blast_path, proxy, log, versi
         msg = "Reference file took too long to download. :-( Maybe the connection is slow or you need a proxy?"
         return False, msg
 
-    log.debug("\tCreating parsed files...")
-    version = hla_embl_parser.make_parsed_files(use_dbname, ref_path_temp, log)
-
     success, msg = make_blast_db(use_dbname, ref_path_temp, blast_path, log)
 
     if success:
@@ -260,7 +355,15 @@ def update_database(db_name, reference_local_path, blast_path, proxy, log, versi
             g.write(f"{local_md5} {datetime.datetime.now().strftime('%d.%m.%y')}")
 
         update_msg = f"Updated the reference data for {db_name.upper()} to version {version}."
+        store_reference_version(use_dbname, reference_local_path, log)  # keep the previous version available
+        report_file = os.path.join(ref_path_temp, f"{use_dbname}_changes.txt")
+        if os.path.isfile(report_file):
+            changes = hla_embl_parser.read_change_report(report_file)
+            update_msg += f"\n({len(changes['added'])} alleles added, {len(changes['changed'])} changed, "
+            update_msg += f"{len(changes['removed'])} removed; see {use_dbname}_changes.txt)"
         move_files(ref_path_temp, reference_local_path, db_name, log)
+        reference_cache.clear_reference_cache(use_dbname)
+        store_reference_version(use_dbname, reference_local_path, log)  # uses the record hashes of the new dat index
     else:
         log.error(msg)
         update_msg = f"Tried to update the reference data for {db_name.upper()} to version {version}, "
@@ -270,8 +373,19 @@ def update_database(db_name, reference_local_path, blast_path, proxy, log, versi
     return success, update_msg
 
 
+def store_reference_version(use_dbname, reference_local_path, log):
+    """adds the current local reference version to the multi-version reference store;
+    failing to do so does not affect the reference itself, so errors are only logged
+    """
+    try:
+        reference_store.add_version(use_dbname, reference_local_path, log)
+    except Exception as E:
+        log.exception(f"Could not add the current {use_dbname} reference to the reference store: {repr(E)}")
+
+
 def make_restricted_db(db_name, ref_path, restricted_to, target_dir, blast_path, log):
-    """creates a limited version of the given database, restricted to the given alleles
+    """creates a limited version of the given database, restricted to the given alleles;
+    the alleles are taken from the indexed local reference, so only their records are parsed
     """
     log.info(f"Create local reference version of {db_name} restricted to {', '.join(restricted_to)}...")
     if db_name == "kir":
@@ -282,9 +396,13 @@ def make_restricted_db(db_name, ref_path, restricted_to, target_dir, blast_path,
     os.makedirs(target_dir, exist_ok=True)
 
     log.debug("\tCreating parsed files...")
-    hla_embl_parser.make_parsed_files(use_dbname, ref_path, log,
-                                      restricted_to=restricted_to,
-                                      target_dir=target_dir)
+    alleles = reference_cache.get_reference_alleles(use_dbname, ref_path, log)
+    (version, _) = reference_cache.get_reference_key(use_dbname, ref_path)
+    missing = hla_embl_parser.make_restricted_files(use_dbname, alleles, restricted_to, target_dir, version, log)
+    if len(missing) == len(restricted_to):
+        msg = f"None of the chosen alleles ({', '.join(restricted_to)}) is part of the {db_name} reference!"
+        log.error(msg)
+        return False, msg
 
     success, msg = make_blast_db(use_dbname, target_dir, blast_path, log)
 
@@ -295,6 +413,66 @@ def make_restricted_db(db_name, ref_path, restricted_to, target_dir, blast_path,
     return success, msg
 
 
+def get_restricted_db_key(use_dbname, ref_path, restricted_to):
+    """returns the key under which a restricted database is cached:
+    a hash of the sorted allele names and the version and MD5 checksum of the reference they are taken from
+    """
+    (version, md5) = reference_cache.get_reference_key(use_dbname, ref_path)
+    key = "\n".join([use_dbname, str(version), str(md5)] + sorted(set(restricted_to)))
+    return hashlib.md5(key.encode("utf-8")).hexdigest()
+
+
+def evict_restricted_dbs(cache_dir, max_cached, log, keep=None):
+    """removes the least recently used restricted databases from cache_dir,
+    so at most max_cached of them are kept
+    """
+    db_dirs = [os.path.join(cache_dir, mydir) for mydir in os.listdir(cache_dir)
+               if not mydir.startswith(".")]
+    db_dirs = [mydir for mydir in db_dirs if os.path.isdir(mydir) and mydir != keep]
+    db_dirs.sort(key=os.path.getmtime, reverse=True)
+    for mydir in db_dirs[max(max_cached - 1, 0):]:
+        log.debug(f"\tRemoving least recently used restricted database {mydir}...")
+        shutil.rmtree(mydir, ignore_errors=True)
+
+
+def get_restricted_db(db_name, ref_path, restricted_to, cache_dir, blast_path, log,
+                      max_cached=RESTRICTED_DB_CACHE_SIZE):
+    """returns a restricted database of the given alleles from cache_dir;
+    it is only created if no database for the same alleles and reference version exists there yet.
+    The least recently used databases are removed, so at most max_cached are kept.
+
+    :return: success (bool), path of the restricted database (or error message, if not successful)
+    """
+    if db_name == "kir":
+        use_dbname = "KIR"  # biological databases and consistency in naming are arch enemies
+    else:
+        use_dbname = db_name
+
+    os.makedirs(cache_dir, exist_ok=True)
+    db_key = get_restricted_db_key(use_dbname, ref_path, restricted_to)
+    db_dir = os.path.join(cache_dir, f"{use_dbname}_{db_key}")
+
+    if os.path.isdir(db_dir):
+        log.info(f"Reusing restricted reference of {db_name} for {', '.join(restricted_to)} from {db_dir}")
+        os.utime(db_dir)  # mark as recently used
+        return True, db_dir
+
+    temp_dir = os.path.join(cache_dir, f".{use_dbname}_{db_key}_{os.getpid()}")
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    success, msg = make_restricted_db(db_name, ref_path, restricted_to, temp_dir, blast_path, log)
+    if not success:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        return False, msg
+
+    try:
+        os.rename(temp_dir, db_dir)
+    except OSError:  # created by someone else in the meantime
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    evict_restricted_dbs(cache_dir, max_cached, log, keep=db_dir)
+    return True, db_dir
+
+
 def update_country_data(target_dir: str, proxy: str, log: logging.Logger) -> Tuple[bool, str | None]:
     """Get current list of possible countries from GitHub and store them locally.
 
@@ -3,6 +3,7 @@
 import xmltodict
 from sys import argv
 from .errors import FileFormatError, UnknownXMLFormatError
+from . import staging
 
 
 def change_utf_decl(xmlFileName):
@@ -11,13 +12,8 @@ def change_utf_decl(xmlFileName):
     lookFor = "utf-16"
     changeTo = "utf-8"
 
-    xmlHandle = open(xmlFileName)
-    xmlText = xmlHandle.read()
-    xmlHandle.close()
-
-    xmlHandle = open(xmlFileName, "w")
-    xmlHandle.write(xmlText.replace(lookFor, changeTo))
-    xmlHandle.close()
+    xmlText = staging.read_text(xmlFileName)  # may be an in-memory temp file
+    staging.rewrite(xmlFileName, xmlText.replace(lookFor, changeTo))
 
     return
 
@@ -25,9 +21,7 @@ def change_utf_decl(xmlFileName):
 def parseXML(xmlFileName):
     change_utf_decl(xmlFileName)  # utf-16 to utf-8 change
 
-    xmlHandle = open(xmlFileName)
-    xmlText = xmlHandle.read()
-    xmlHandle.close()
+    xmlText = staging.read_text(xmlFileName)
 
     return xmltodict.parse(xmlText)
 
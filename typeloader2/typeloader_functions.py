@@ -17,19 +17,28 @@ import re
 from pathlib import Path
 import string, random, time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from Bio import SeqIO
-from PyQt5.QtSql import QSqlQuery
+from configparser import ConfigParser
+import platform
 
 from typing import List, Optional, Tuple, Dict
 
 from typeloader2.typeloader_core import (EMBLfunctions as EF, coordinates as COO, backend_make_ena as BME,
                                          backend_enaformat as BE, getAlleleSeqsAndBlast as GASB,
-                                         closestallele as CA, errors, update_reference)
-from typeloader2 import general, db_internal, db_external
+                                         closestallele as CA, errors, update_reference,
+                                         blast_results, alignment_service, jobs,
+                                         timing, staging)
+from typeloader2 import general, db_internal
 
 # ===========================================================
 # parameters:
 
+base_config_file = "config_base.ini"
+user_config_file = "config.ini"
+
+__version__ = general.read_package_variable("__version__")
+
 flatfile_dic = {"function_hla": "antigen presenting molecule",
                 "function_kir": "killer-immunoglobulin receptor",
                 "productname_hla_i": "MHC class I antigen",
@@ -52,6 +61,8 @@ MISSING_SPATIOTEMPORAL_OPTIONS = [  # source: https://www.insdc.org/submitting-s
 
 DATE_PATTERN = "^\d{4}(-\d{2})?(-\d{2})?$"
 
+LOCAL_NAME_PLACEHOLDER = "{local_name}"  # local name in ENA texts generated before the allele number is known
+
 
 # ===========================================================
 # classes:
@@ -74,6 +85,7 @@ class Allele:
         self.newAlleleName = newAlleleName
         self.partner_allele = partner_allele
         self.closest_allele_name = closest_allele_name
+        self.closest_allele_candidates = []  # format: [(allele name, number of differences, error or None)]
         self.null_allele = False
         self.parent = None
         self.warnings = []
@@ -97,9 +109,9 @@ class Allele:
         query = f"""select local_name, allele_nr, gene from alleles 
                 where sample_id_int = '{self.sample_id_int}'
                 order by gene, allele_nr"""
-        success, data = db_internal.execute_query(query, 3, self.log,
-                                                  "retrieving number of alleles for this sample from the database",
-                                                  err_type="Database Error", parent=self.parent)
+        success, data = jobs.run_in_main_thread(db_internal.execute_query, query, 3, self.log,
+                                                "retrieving number of alleles for this sample from the database",
+                                                err_type="Database Error", parent=self.parent)
         if success:
             if data:
                 allele_nrs = [nr for [_, nr, _] in data]
@@ -166,6 +178,39 @@ def perform_reference_update(db_name: str, reference_local_path: str, blast_path
     return success, err, update_msg
 
 
+def perform_reference_updates(db_names: List[str], reference_local_path: str, blast_path: str, proxy: str | None,
+                              log, concurrent: bool = True) -> Dict[str, Tuple[bool, str | None, str]]:
+    """updates several reference databases;
+    if concurrent, each database is downloaded, parsed and turned into a BLAST database in its own thread
+    (in its own temp dir), so HLA and KIR are processed at the same time
+
+    :param db_names: list of references to update (can contain "HLA", "KIR" or both)
+    :param reference_local_path: path to 'reference_data' dir
+    :param blast_path: path to BLASTN
+    :param log: logger instance
+    :param concurrent: if True and more than one database is given, update them in parallel
+    :return: dict {db_name: (success (bool), error_type (str or None), message (str))}, in the order of db_names
+    """
+    if not concurrent or len(db_names) < 2:
+        return {db_name: perform_reference_update(db_name, reference_local_path, blast_path, proxy, log)
+                for db_name in db_names}
+
+    log.info(f"Updating {' and '.join(db_names)} concurrently...")
+    results = {}
+    with ThreadPoolExecutor(max_workers=len(db_names), thread_name_prefix="ReferenceUpdate") as executor:
+        futures = {db_name: executor.submit(perform_reference_update, db_name, reference_local_path, blast_path,
+                                            proxy, log)
+                   for db_name in db_names}
+        for db_name, future in futures.items():
+            try:
+                results[db_name] = future.result()
+            except Exception as E:
+                log.exception(f"Reference update of {db_name} failed!")
+                msg = f"Could not update the reference database(s). Please try again!\n\nError: {repr(E)}"
+                results[db_name] = (False, "Reference update failed", msg)
+    return results
+
+
 def update_curr_versions(settings: dict, log) -> None:
     """gets the current version of the reference databases
     """
@@ -186,6 +231,109 @@ def update_curr_versions(settings: dict, log) -> None:
     settings["db_versions"] = db_versions
 
 
+def get_basic_cf(log=None):
+    """extracts data from base_config.ini
+    """
+    if log:
+        log.info("Loading base config from {}...".format(os.path.abspath(base_config_file)))
+    cf = ConfigParser()
+    cf.read(base_config_file)
+    return cf
+
+
+def get_raw_settings(user, log, cf=None):
+    """reads settings from user's config_file
+    """
+    if not cf:
+        cf = get_basic_cf(log)
+    myos = platform.system()
+    if user == "staging":
+        if myos == "Windows":
+            root_path = cf.get("Paths", "staging_path_windows")
+            ini_file = "config_win.ini"
+        else:
+            root_path = cf.get("Paths", "staging_path_linux")
+            ini_file = "config_linux.ini"
+    else:
+        root_path = cf.get("Paths", "root_path")
+        ini_file = user_config_file
+    user_cf_file = os.path.join(root_path, user, ini_file)
+    cf.read(user_cf_file)
+    return cf, user_cf_file, myos
+
+
+def get_settings(user, log, cf=None):
+    """translates user's read config file into settings_dic 
+    """
+    log.info("Loading user settings...")
+    cf, user_cf_file, myos = get_raw_settings(user, log, cf)
+    log.debug(f"User settings file: {user_cf_file}")
+
+    if not os.path.isfile(user_cf_file):
+        log.error("\tUser settings file {} not found!".format(user_cf_file))
+        return None
+
+    settings_dic = {"user_cf": user_cf_file,  # user's config file
+                    "os": myos  # current operating system
+                    }
+    for section in cf.sections():
+        for (key, value) in cf.items(section):
+            settings_dic[key] = value.strip()
+    if settings_dic["modus"] in ["testing", "debugging"]:
+        settings_dic["embl_submission"] = settings_dic["embl_submission_test"]
+    for key in ["ipd_shortname", "cell_line_token"]:  # if these were not set during install
+        if not key in settings_dic:
+            settings_dic[key] = ""
+        elif settings_dic[key] == "a short acronym of your company; use only letters or hyphens!":
+            settings_dic[key] = ""
+    settings_dic["TL_version"] = __version__
+    settings_dic["running_modus"] = "normal"
+
+    if "timeout_ena" not in settings_dic:
+        settings_dic["timeout_ena"] = "300"
+        cf.set("Pref", "timeout_ena", "300")
+        with open(user_cf_file, "w") as g:
+            cf.write(g)
+
+    if "search_engine" not in settings_dic:
+        settings_dic["search_engine"] = "blast"
+        cf.set("Pref", "search_engine", "blast")
+        with open(user_cf_file, "w") as g:
+            cf.write(g)
+
+    if "blast_output" not in settings_dic:
+        settings_dic["blast_output"] = "xml"
+        cf.set("Pref", "blast_output", "xml")
+        with open(user_cf_file, "w") as g:
+            cf.write(g)
+
+    if "closest_allele_candidates" not in settings_dic:
+        settings_dic["closest_allele_candidates"] = "3"
+        cf.set("Pref", "closest_allele_candidates", "3")
+        with open(user_cf_file, "w") as g:
+            cf.write(g)
+
+    if "stage_timing" not in settings_dic:
+        settings_dic["stage_timing"] = "no"
+        cf.set("Pref", "stage_timing", "no")
+        with open(user_cf_file, "w") as g:
+            cf.write(g)
+
+    if "temp_files" not in settings_dic:
+        settings_dic["temp_files"] = "disk"
+        cf.set("Pref", "temp_files", "disk")
+        with open(user_cf_file, "w") as g:
+            cf.write(g)
+
+    settings_dic["reference_local_path"] = os.path.join(settings_dic["root_path"],
+                                                        settings_dic["general_dir"],
+                                                        settings_dic["reference_dir"])
+    update_curr_versions(settings_dic, log)
+
+    log.info("\t=>Success")
+    return settings_dic
+
+
 def create_project_name(user: str, gene: str, pool: str, settings: dict, log) -> Tuple[bool, str | None, str]:
     """Create a project name.
 
@@ -225,13 +373,10 @@ def add_project_to_db(project_name: str, user: str, gene: str, pool: str, title:
     '{title}', '{description}', '{accession_ID}', '{submission_ID}');
     """
 
-    q = QSqlQuery()
-    q.exec_(query)
-
-    lasterr = q.lastError()
-    if lasterr.isValid():
-        log.error(lasterr.text())
-        if lasterr.text().startswith("UNIQUE constraint failed:"):
+    success, msg = db_internal.execute_query(query, 0, log, "adding the new project to the database")
+    if not success:
+        log.error(msg)
+        if "UNIQUE constraint failed:" in msg:
             return False, "Such a project exists already!"
 
     log.debug(f"=> Added new project {project_name} to database successfully")
@@ -340,6 +485,33 @@ def create_project(project_name: str, title: str, description: str, gene: str, p
     return True, None, accession_ID, project_dir, project_filename
 
 
+def check_project_open(project_name, log, parent=None):
+    """checks whether the current project is open or closed;
+    returns True if open, False if closed
+    """
+    if not project_name:  # if no project given, treat as "Open"
+        return True
+    log.info(f"Checking status of project {project_name}...")
+    query = f"select project_status from projects where project_name = '{project_name}'"
+    success, data = db_internal.execute_query(query, 1, log,
+                                              f"retrieving project status of project {project_name} from database",
+                                              parent=parent)
+    if success and data:
+        project_open = True
+        status = data[0][0]
+        if status.lower() == "closed":
+            project_open = False
+        log.info(f"\t=> project status: {status}")
+    else:
+        if success and not data:
+            log.warning(f"\t=> Project {project_name} was not found!")
+        else:
+            log.warning(data)
+        project_open = True  # when in doubt, err on the side of giving access to the project
+
+    return project_open
+
+
 def toggle_project_status(proj_name: str, curr_status: str, log, values=["Open", "Closed"],
                           texts=["Close Project", "Reopen Project"], parent=None) -> Tuple[bool, str, int]:
     """toggles the status of a given project between 'Open' and 'Closed';
@@ -362,8 +534,12 @@ def toggle_project_status(proj_name: str, curr_status: str, log, values=["Open",
         return success, curr_status, 0
 
 
-def upload_parse_sequence_file(raw_path: str, settings: dict, log, use_given_reference: str | bool = False):
-    """uploads file from raw_path to temp_dir and parses it
+def upload_parse_sequence_file(raw_path: str, settings: dict, log, use_given_reference: str | bool = False,
+                               blast_batch: GASB.BlastBatch | None = None, temp_dir: str | None = None):
+    """uploads file from raw_path to temp_dir (default: the user's temp_dir) and parses it;
+    if a blast_batch is given which already contains this file's sequences, its BLAST results are used;
+    with the setting temp_files = memory, the uploaded file and all files derived from it
+    are only kept in memory until the allele is saved (see staging.py)
     """
     log.debug("Uploading file {} to temp location...".format(raw_path))
     extension = os.path.splitext(raw_path)[1].lower()
@@ -382,13 +558,20 @@ def upload_parse_sequence_file(raw_path: str, settings: dict, log, use_given_ref
                 "Input-file should be .xml or .fasta file. Please use a supported file extension!")
 
     # save uploaded file to temp dir:
+    jobs.report_stage("copy")
     try:
-        temp_raw_file = os.path.join(settings["temp_dir"], os.path.basename(raw_path).replace(" ", "_"))
+        temp_raw_file = os.path.join(temp_dir or settings["temp_dir"], os.path.basename(raw_path).replace(" ", "_"))
         if filetype == "FASTA":
             if extension != ".fa":
                 temp_raw_file = os.path.splitext(temp_raw_file)[0] + ".fa"
         log.info("Saving file to {}".format(temp_raw_file))
-        shutil.copyfile(raw_path, temp_raw_file)
+        with timing.stage("copy", file=os.path.basename(raw_path)):
+            if staging.is_enabled(settings):
+                staging.pop_dir(os.path.dirname(temp_raw_file))  # drop leftovers of previous uploads
+                with open(raw_path, newline="") as f:
+                    staging.stage(temp_raw_file, f.read())
+            else:
+                shutil.copyfile(raw_path, temp_raw_file)
         log.info("\t=> Done!")
     except Exception as E:
         log.exception(E)
@@ -397,8 +580,8 @@ def upload_parse_sequence_file(raw_path: str, settings: dict, log, use_given_ref
 
     # read file:
     try:
-        results = GASB.blast_raw_seqs(temp_raw_file, filetype, settings, log,
-                                      use_given_reference=use_given_reference)
+        results = alignment_service.run_job(GASB.blast_raw_seqs, temp_raw_file, filetype, settings, log,
+                                            use_given_reference=use_given_reference, blast_batch=blast_batch)
     except ValueError as E:
         msg = E.args[0]
         if msg.startswith("Fasta"):
@@ -458,12 +641,13 @@ def reformat_header_data(header_data: dict, sample_id_ext: str | None, log):
 
 def remove_other_allele(blast_xml_file: str, fasta_file: str, other_allele_name: str, log, replace: bool = True):
     """removes the non-chosen allele from an XML input file and the generated fasta file
-    so it will not later create difficulties (#115)
+    (and from the BLAST output, XML or tabular) so it will not later create difficulties (#115);
+    in-memory temp files (see staging.py) are cleaned in memory
     """
     log.info("Removing non-chosen partner allele from blast_xml file and generated fasta file...")
     log.debug("\tCleaning fasta file...")
     temp = fasta_file + "1"
-    with open(fasta_file, "rU") as f, open(temp, "w") as g:
+    with staging.open_text(fasta_file) as f, staging.open_for_writing(temp, staging.is_staged(fasta_file)) as g:
         records = list(SeqIO.parse(f, "fasta"))
         if len(records) == 1:  # only one allele present
             log.debug("\t\t=> only one allele found, no cleaning necessary.")
@@ -475,12 +659,20 @@ def remove_other_allele(blast_xml_file: str, fasta_file: str, other_allele_name:
                     log.error(f'Error while writing sequence {record.id} to {temp}')
 
     if replace:
-        os.remove(fasta_file)
-        shutil.move(temp, fasta_file)
+        staging.replace(temp, fasta_file)
 
-    log.debug("\tCleaning XML file...")
     temp = blast_xml_file + "1"
-    with open(blast_xml_file, "r") as f, open(temp, "w") as g:
+    if blast_results.is_tabular(blast_xml_file):
+        log.debug("\tCleaning BLAST output...")
+        blast_results.remove_queries(blast_xml_file, other_allele_name, temp)
+        if replace:
+            staging.replace(temp, blast_xml_file)
+        log.debug("\t=> Done!")
+        return
+
+    log.debug("\tCleaning XML file...")
+    with staging.open_text(blast_xml_file) as f, \
+            staging.open_for_writing(temp, staging.is_staged(blast_xml_file)) as g:
         header = True
         for line in f:
             if line == "<Iteration>\n":
@@ -500,8 +692,7 @@ def remove_other_allele(blast_xml_file: str, fasta_file: str, other_allele_name:
         g.write(text)  # write footer
 
     if replace:
-        os.remove(blast_xml_file)
-        shutil.move(temp, blast_xml_file)
+        staging.replace(temp, blast_xml_file)
     log.debug("\t=> Done!")
 
 
@@ -515,10 +706,22 @@ def _create_overhang_warning(closest_allele_name: str, overhang_length: int) ->
     return msg
 
 
+def get_closest_allele_candidates(annotation: dict) -> List[Tuple[str, Optional[int], Optional[str]]]:
+    """returns the ranked closest allele candidates of an annotation (see COO.annotateCandidates)
+    as [(allele name, number of differences, error)]; only candidates without error can be chosen
+    """
+    return [(candidate["name"], candidate["differences"],
+             None if candidate["annotation"] else candidate["error"] or "could not be annotated")
+            for candidate in annotation.get("closestAlleleCandidates") or []]
+
+
 def process_sequence_file(project: str, filetype: str, blastXmlFile: str, targetFamily: str, fasta_filename: str,
                           allelesFilename: str, header_data: dict, settings: dict, log, incomplete_ok=False,
-                          startover=False):
+                          startover=False, closest_allele: str | None = None):
+    """closest_allele: for fasta files, annotate against this closest allele candidate instead of the best one
+    """
     log.debug("Processing sequence file...")
+    jobs.report_stage("annotate")
     if startover:
         allele_nr = startover["allele_nr"]
         local_name = startover["local_name"]
@@ -586,7 +789,7 @@ def process_sequence_file(project: str, filetype: str, blastXmlFile: str, target
         else:  # Fasta-File:
             try:
                 annotations = COO.getCoordinates(blastXmlFile, allelesFilename, targetFamily, settings, log,
-                                                 incomplete_ok=incomplete_ok)
+                                                 incomplete_ok=incomplete_ok, closest_allele=closest_allele)
             except errors.IncompleteSequenceWarning as E:
                 return False, "Incomplete sequence", E.msg
             except errors.MissingUTRError as E:
@@ -682,6 +885,7 @@ def process_sequence_file(project: str, filetype: str, blastXmlFile: str, target
                                   header_data["sample_id_int"],
                                   settings, log, newAlleleName, closest_allele_name=closestAlleleName, existing_values=existing_values)
                 myallele.null_allele = null_allele
+                myallele.closest_allele_candidates = get_closest_allele_candidates(annotations[alleleName])
                 if warning:
                     myallele.warnings.append(warning)
                 myalleles = [myallele]
@@ -703,19 +907,25 @@ def process_sequence_file(project: str, filetype: str, blastXmlFile: str, target
         return False, "Error while processing the sequence file", repr(E)
 
 
-def make_ENA_file(blastXmlFile: str, targetFamily: str, allele: Allele, settings: dict, log, incomplete_ok=False):
-    """creates ENA file for allele chosen from XML file
+@timing.timed
+def make_ENA_file(blastXmlFile: str, targetFamily: str, allele: Allele, settings: dict, log, incomplete_ok=False,
+                  closest_allele: str | None = None):
+    """creates ENA file for allele chosen from XML file;
+    closest_allele: annotate against this closest allele candidate instead of the best one
     """
     log.debug("Creating ENA text...")
+    jobs.report_stage("annotate")
     allelesFilename = os.path.join(settings["dat_path"],
                                    settings["general_dir"],
                                    settings["reference_dir"],
                                    settings["hla_dat"])
     annotations = COO.getCoordinates(blastXmlFile, allelesFilename, targetFamily, settings, log, isENA=True,
-                                     incomplete_ok=incomplete_ok)
+                                     incomplete_ok=incomplete_ok, closest_allele=closest_allele)
     posHash, sequences = EF.get_coordinates_from_annotation(annotations)
 
     alleleName = allele.gendx_result
+    allele.closest_allele_name = annotations[alleleName]["closestAllele"]
+    allele.closest_allele_candidates = get_closest_allele_candidates(annotations[alleleName])
     currentPosHash = posHash[alleleName]
     sequence = sequences[alleleName]
     enaPosHash = BME.transform(currentPosHash)
@@ -784,6 +994,7 @@ def move_files_to_sample_dir(project: str, sample_name: str, local_name: str, fi
     return sample_dir, raw_file, fasta_filename, blastXmlFile
 
 
+@timing.timed
 def save_new_allele(project: str, sample_name: str, local_name: str, ENA_text: str,
                     filetype: str, temp_raw_file: str, blastXmlFile: str, fasta_filename: str,
                     restricted_db_path: str | bool,
@@ -822,16 +1033,17 @@ def save_new_allele(project: str, sample_name: str, local_name: str, ENA_text: s
         if not os.path.exists(target_dir):
             os.makedirs(target_dir)
 
-        for (dirpath, subdirs, files) in os.walk(os.path.join(settings["temp_dir"],
-                                                              "restricted_db")):
-            for f in files:
-                myfile = os.path.join(dirpath, f)
-                shutil.move(myfile, os.path.join(target_dir, f))
+        # copy, so the cached restricted database can be reused for further alleles:
+        for f in os.listdir(restricted_db_path):
+            myfile = os.path.join(restricted_db_path, f)
+            if os.path.isfile(myfile):
+                shutil.copy(myfile, os.path.join(target_dir, f))
 
     files = [raw_file, fasta_filename, blastXmlFile, ena_path]
     return (True, None, None, files)
 
 
+@timing.timed
 def save_new_allele_to_db(allele: str, project: str,
                           filetype: str, raw_file: str, fasta_filename: str, blastXmlFile: str,
                           header_data: dict, targetFamily: str,
@@ -1076,13 +1288,14 @@ def parse_bulk_csv(csv_file: str, settings: dict, log):
 
 
 def handle_new_allele_parsing(project_name: str, sample_id_int: str, sample_id_ext: str, raw_path: str, customer: str,
-                              settings: dict, log, use_restricted_db=False):
+                              settings: dict, log, use_restricted_db=False, blast_batch=None, temp_dir=None):
     """handles step one of the uploading of one new allele to TL;
-    called by NewAlleleForm and upload_new_allele_complete()
+    called by NewAlleleForm and prepare_new_allele()
     """
     log.info("Uploading {} to project {}...".format(sample_id_int, project_name))
     results = upload_parse_sequence_file(raw_path, settings, log,
-                                         use_given_reference=use_restricted_db)
+                                         use_given_reference=use_restricted_db, blast_batch=blast_batch,
+                                         temp_dir=temp_dir)
     if not results[0]:  # something went wrong
         return False, "{}: {}".format(results[1], results[2])
     log.debug("\t=> success")
@@ -1102,15 +1315,19 @@ def handle_new_allele_parsing(project_name: str, sample_id_int: str, sample_id_e
     return True, results
 
 
-def upload_new_allele_complete(project_name: str, sample_id_int: str, sample_id_ext: str, raw_path: str, customer: str,
-                               provenance: str, sample_date: str,
-                               settings: dict, mydb, log, incomplete_ok=False, use_restricted_db=False,
-                               startover=False):
-    """adds one new target sequence to TypeLoader
+def prepare_new_allele(project_name: str, sample_id_int: str, sample_id_ext: str, raw_path: str, customer: str,
+                       provenance: str, sample_date: str, settings: dict, log, incomplete_ok=False,
+                       use_restricted_db=False, blast_batch=None, temp_dir=None, defer_local_name=False):
+    """first stage of adding one new target sequence to TypeLoader:
+    uploads, blasts and annotates the sequence and generates its ENA text;
+    if defer_local_name, the database is not used (so this can run in a worker process)
+    and the ENA text contains LOCAL_NAME_PLACEHOLDER instead of the local name
+
+    :return: (True, prepared allele for store_new_allele) or (False, error message)
     """
     success, results = handle_new_allele_parsing(project_name, sample_id_int, sample_id_ext,
                                                  raw_path, customer, settings, log,
-                                                 use_restricted_db)
+                                                 use_restricted_db, blast_batch=blast_batch, temp_dir=temp_dir)
     if not success:
         log.warning("Could not upload target file")
         log.warning(results)
@@ -1132,9 +1349,11 @@ def upload_new_allele_complete(project_name: str, sample_id_int: str, sample_id_
             header_data[key] = new_val
 
     # process sequence file:
+    existing_values = {"allele_nr": None, "local_name": LOCAL_NAME_PLACEHOLDER} if defer_local_name else False
     results = process_sequence_file(project_name, filetype, blastXmlFile,
                                     targetFamily, fasta_filename, allelesFilename,
-                                    header_data, settings, log, incomplete_ok=incomplete_ok)
+                                    header_data, settings, log, incomplete_ok=incomplete_ok,
+                                    startover=existing_values)
     if not results[0]:  # something went wrong
         return False, "{}: {}".format(results[1], results[2])
     log.debug("\t=> success")
@@ -1142,11 +1361,24 @@ def upload_new_allele_complete(project_name: str, sample_id_int: str, sample_id_
     (_, myalleles, ENA_text) = results
     myallele = myalleles[0]
     myallele.sample_id_int = sample_id_int
+    return True, (myallele, ENA_text, header_data, filetype, sample_name, targetFamily,
+                  temp_raw_file, blastXmlFile, fasta_filename)
+
+
+def store_new_allele(project_name: str, prepared: tuple, settings: dict, mydb, log, startover=False):
+    """second stage of adding one new target sequence to TypeLoader (see prepare_new_allele):
+    assigns the local name, saves the allele's files and adds it to the database
+
+    :return: (True, local name) or (False, error message)
+    """
+    (myallele, ENA_text, header_data, filetype, sample_name, targetFamily,
+     temp_raw_file, blastXmlFile, fasta_filename) = prepared
     myallele.make_local_name()
     if startover:
         if myallele.gene != startover["gene"]:
             return False, f"This used to be a {startover['gene']} allele! " \
                           f"It can only be restarted with another {startover['gene']} allele."
+    ENA_text = ENA_text.replace(f'/cell_line="{LOCAL_NAME_PLACEHOLDER}"', f'/cell_line="{myallele.local_name}"')
 
     # save allele files:
     results = save_new_allele(project_name, sample_name, myallele.local_name, ENA_text,
@@ -1159,12 +1391,12 @@ def upload_new_allele_complete(project_name: str, sample_id_int: str, sample_id_
 
     [raw_file, fasta_filename, blastXmlFile, ena_path] = files
     # save to db & emit signals:
-    (success, err_type, msg) = save_new_allele_to_db(myallele, project_name,
-                                                     filetype, raw_file,
-                                                     fasta_filename, blastXmlFile,
-                                                     header_data, targetFamily,
-                                                     ena_path, None, settings, mydb, log,
-                                                     startover)
+    (success, err_type, msg) = jobs.run_in_main_thread(save_new_allele_to_db, myallele, project_name,
+                                                       filetype, raw_file,
+                                                       fasta_filename, blastXmlFile,
+                                                       header_data, targetFamily,
+                                                       ena_path, None, settings, mydb, log,
+                                                       startover)
     if success:
         log.debug("Allele uploaded successfully")
         return True, myallele.local_name
@@ -1172,28 +1404,134 @@ def upload_new_allele_complete(project_name: str, sample_id_int: str, sample_id_
         return False, "{}: {}".format(err_type, msg)
 
 
-def bulk_upload_new_alleles(csv_file: str, project: str, settings: dict, mydb, log):
+def upload_new_allele_complete(project_name: str, sample_id_int: str, sample_id_ext: str, raw_path: str, customer: str,
+                               provenance: str, sample_date: str,
+                               settings: dict, mydb, log, incomplete_ok=False, use_restricted_db=False,
+                               startover=False, blast_batch=None):
+    """adds one new target sequence to TypeLoader
+    """
+    success, results = prepare_new_allele(project_name, sample_id_int, sample_id_ext, raw_path, customer,
+                                          provenance, sample_date, settings, log, incomplete_ok=incomplete_ok,
+                                          use_restricted_db=use_restricted_db, blast_batch=blast_batch)
+    if not success:
+        return False, results
+    return store_new_allele(project_name, results, settings, mydb, log, startover=startover)
+
+
+def prepare_bulk_allele(allele: list, project: str, temp_dir: str, settings: dict, log, blast_batch=None):
+    """prepares one allele of a bulk upload in a worker thread (see prepare_new_allele);
+    each allele gets its own temp_dir, so files of the same name cannot collide
+    """
+    [nr, sample_id_int, sample_id_ext, raw_path, customer, incomplete_ok, provenance, sample_date] = allele
+    log.info("Preparing #{}: {}...".format(nr, sample_id_int))
+    os.makedirs(temp_dir, exist_ok=True)
+    with alignment_service.run_directly():  # the workers' alignments run in parallel, not queued in the service
+        return prepare_new_allele(project, sample_id_int, sample_id_ext, raw_path, customer, provenance, sample_date,
+                                  settings, log, incomplete_ok=incomplete_ok, blast_batch=blast_batch,
+                                  temp_dir=temp_dir, defer_local_name=True)
+
+
+def upload_bulk_alleles(alleles: list, project: str, settings: dict, mydb, log, blast_batch=None,
+                        concurrent: bool = True, max_workers: int | None = None):
+    """uploads the alleles of a bulk upload, yields (nr, success, local name or error message) in the order of alleles;
+    if concurrent, the alleles are prepared (uploaded, blasted, annotated, ENA text generated) in a thread pool
+    (the heavy lifting is done by BLAST subprocesses, and threads share the logger and the cached references),
+    while this thread stores them one after the other (in the order of alleles, so project_nr stays deterministic);
+    if the current job is cancelled, alleles not stored yet are skipped, the BLAST runs of the workers are killed
+    and jobs.JobCancelled is raised
+    """
+    if not concurrent or len(alleles) < 2:
+        for (i, allele) in enumerate(alleles):
+            jobs.report_stage(f"allele {i + 1} of {len(alleles)}")
+            [nr, sample_id_int, sample_id_ext, raw_path, customer, incomplete_ok, provenance, sample_date] = allele
+            log.info("Uploading #{}: {}...".format(nr, sample_id_int))
+            success, msg = upload_new_allele_complete(project, sample_id_int, sample_id_ext, raw_path, customer,
+                                                      provenance, sample_date,
+                                                      settings, mydb, log, incomplete_ok=incomplete_ok,
+                                                      blast_batch=blast_batch)
+            yield nr, success, msg
+        return
+
+    log.info(f"Preparing {len(alleles)} alleles in parallel...")
+    temp_dirs = [os.path.join(settings["temp_dir"], f"bulk_{i}") for i in range(len(alleles))]
+    executor = ThreadPoolExecutor(max_workers=max_workers or min(os.cpu_count() or 1, 8),
+                                 thread_name_prefix="BulkUpload")
+    worker_jobs = [jobs.subjob() for _ in alleles]  # cancelled with the current job
+    try:
+        futures = [executor.submit(jobs.run_with_job, worker_job, prepare_bulk_allele,
+                                   allele, project, temp_dir, settings, log, blast_batch)
+                   for (allele, temp_dir, worker_job) in zip(alleles, temp_dirs, worker_jobs)]
+        for (i, (allele, temp_dir, future)) in enumerate(zip(alleles, temp_dirs, futures)):
+            nr = allele[0]
+            jobs.report_stage(f"allele {i + 1} of {len(alleles)}")
+            try:
+                success, results = future.result()
+            except jobs.JobCancelled:
+                raise
+            except Exception as E:
+                log.exception(f"Preparing #{nr} failed!")
+                success, results = False, f"Error while processing the sequence file: {repr(E)}"
+            if success:
+                log.info("Saving #{}: {}...".format(nr, allele[1]))
+                success, results = store_new_allele(project, results, settings, mydb, log)
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            staging.pop_dir(temp_dir)
+            yield nr, success, results
+    finally:  # on cancellation or errors, don't prepare the remaining alleles and kill the running BLASTs
+        for worker_job in worker_jobs:
+            if worker_job:
+                worker_job.cancel()
+        executor.shutdown(wait=True, cancel_futures=True)
+        for temp_dir in temp_dirs:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            staging.pop_dir(temp_dir)
+
+
+def bulk_upload_new_alleles(csv_file: str, project: str, settings: dict, mydb, log, batch_blast: bool = True,
+                            concurrent: bool = True):
     """performs bulk uploading, parsing and saving of new target alleles
-    specified in a .csv file
+    specified in a .csv file;
+    if batch_blast, the sequences of all alleles are blasted in one BLAST run per reference beforehand;
+    if concurrent, the alleles are processed in parallel and saved in the order of the .csv file;
+    if the current job (see jobs.py) is cancelled, the alleles not saved yet are skipped;
+    if the pipeline stages are timed (see timing.py), the report ends with a summary of their durations
     """
     log.info("Starting bulk upload from file {}...".format(csv_file))
+    start_time = time.time()
     alleles, error_dic, num_rows = parse_bulk_csv(csv_file, settings, log)
     successful = []
     alleles_uploaded = []
-    for allele in alleles:
-        [nr, sample_id_int, sample_id_ext, raw_path, customer, incomplete_ok, provenance, sample_date] = allele
-        log.info("Uploading #{}: {}...".format(nr, sample_id_int))
-        success, msg = upload_new_allele_complete(project, sample_id_int, sample_id_ext, raw_path, customer, provenance,
-                                                  sample_date,
-                                                  settings, mydb, log, incomplete_ok=incomplete_ok)
-        if success:
-            local_name = msg
-            successful.append("  - #{}: {}".format(nr, local_name))
-            alleles_uploaded.append(local_name)
-        else:
-            if msg.startswith("Incomplete sequence"):
-                msg = msg.replace("\n", " ").split("!")[0] + "!"
-            error_dic[nr].append(msg)
+    cancelled = False
+
+    with timing.collect() as timing_records:
+        try:
+            blast_batch = None
+            if batch_blast and len(alleles) > 1:
+                blast_batch = GASB.BlastBatch(settings, log)
+                try:
+                    jobs.report_stage("BLAST")
+                    with timing.stage("batch BLAST", files=len(alleles)):
+                        blast_batch.add_files([allele[3] for allele in alleles])
+                except jobs.JobCancelled:
+                    raise
+                except Exception as E:
+                    log.exception(f"Batched BLAST failed, blasting files one by one instead: {repr(E)}")
+                    blast_batch = None
+                log.info(f"\tBatched BLAST of {len(alleles)} files took {time.time() - start_time:.1f} s")
+
+            for (nr, success, msg) in upload_bulk_alleles(alleles, project, settings, mydb, log,
+                                                          blast_batch=blast_batch, concurrent=concurrent):
+                if success:
+                    local_name = msg
+                    successful.append("  - #{}: {}".format(nr, local_name))
+                    alleles_uploaded.append(local_name)
+                else:
+                    if msg.startswith("Incomplete sequence"):
+                        msg = msg.replace("\n", " ").split("!")[0] + "!"
+                    error_dic[nr].append(msg)
+        except jobs.JobCancelled:
+            log.info("Bulk upload cancelled by the user")
+            cancelled = True
 
     # format report:
     report = ""
@@ -1215,6 +1553,13 @@ def bulk_upload_new_alleles(csv_file: str, project: str, settings: dict, mydb, l
     else:
         errors = "\nNo problems encountered."
     report += errors
+    if cancelled:
+        errors_found = True
+        report += "\n\nThe bulk upload was cancelled: the remaining alleles were NOT added."
+    if timing_records:
+        report += "\n\nDuration of the upload stages:\n" + timing.summarize(timing_records)
+        report += f"\n(see {timing.get_timing_file()})"
+    log.info(f"Bulk upload of {num_rows} alleles took {time.time() - start_time:.1f} s")
 
     return report, errors_found, alleles_uploaded
 
@@ -1558,6 +1903,76 @@ def submit_alleles_to_ENA(project_name: str, ENA_ID: str, samples: List[List[str
     return success, file_dic, ena_results, problem_samples, err_type, msg
 
 
+def save_IPD_submission_to_db(project: str, subm_id: str, samples: List[Tuple[str, str, str]], IPD_file: str,
+                              cell_lines: Dict[str, str], customer_dic: Dict[str, str], imgt_files: Dict[str, str],
+                              ENA_id_map: Dict[str, str], ENA_timestamp: str, settings: dict, mydb, log,
+                              parent=None) -> Tuple[bool, List[Tuple[str, str]]]:
+    """copies the IPD files of a submission to their sample folders and saves the submission to the database
+
+    :param project: name of the project the alleles belong to
+    :param subm_id: ID of the IPD submission
+    :param samples: list of submitted alleles, format: [(sample_id_int, local_name, IPD_nr)]
+    :param IPD_file: the zipped IPD file (the IPD files of the alleles lie next to it)
+    :param cell_lines: IPD submission nr of each allele, format: {local_name: IPD_submission_nr}
+    :param customer_dic: customer of each sample, format: {sample_id_int: customer}
+    :param imgt_files: IPD file of each allele, format: {IPD_submission_nr: filename}
+    :param ENA_id_map: ENA accession of each allele, format: {local_name: ENA_accession_nr}
+    :param ENA_timestamp: date the ENA accessions were retrieved
+    :param settings: the user's settings_dic
+    :param mydb: database connection
+    :param log: logger instance
+    :param parent: parent widget of database error popups (if any)
+    :return:
+            - success (bool): whether the database was updated
+            - problems: list of (title, msg) of problems with the sample folders that did not prevent saving
+    """
+    problems = []
+    update_queries = []
+    for (sample, local_name, _) in samples:
+        # update allele_status for individual alleles:
+        IPD_submission_nr = cell_lines[local_name]
+        update_queries.append(f"""update alleles set allele_status = 'IPD submitted',
+            ENA_accession_nr = '{ENA_id_map[local_name]}', ENA_acception_date = '{ENA_timestamp}',
+            IPD_SUBMISSION_ID = '{subm_id}', IPD_SUBMISSION_NR = '{IPD_submission_nr}'
+            where local_name = '{local_name}'""")
+
+        # update files table:
+        subm_file = imgt_files[IPD_submission_nr]
+        update_queries.append(f"update files set IPD_submission_file = '{subm_file}' where local_name = '{local_name}'")
+
+        # update samples table with customer:
+        update_queries.append(f"update samples set customer = '{customer_dic[sample]}' where sample_id_int = '{sample}'")
+
+        # copy file to sample folder:
+        src_path = os.path.join(os.path.dirname(IPD_file), subm_file)
+        dest_dir = os.path.join(settings["projects_dir"], project, sample)
+        if not os.path.isdir(dest_dir):
+            log.warning("Sample folder {} does not exist! Creating...".format(dest_dir))
+            problems.append(("Sample path unknown", f"Sample directory '{dest_dir}' does not exist (but it should)!\n"
+                                                    "I'm creating it, but please notify your admin!"))
+            os.makedirs(dest_dir)
+        dest_path = os.path.join(dest_dir, subm_file)
+        log.debug("Copying IPD file to {}...".format(dest_path))
+        try:
+            shutil.copy(src_path, dest_path)
+        except Exception as E:
+            log.warning("Could not copy file {} to {}".format(subm_file, dest_dir))
+            log.exception(E)
+            problems.append(("File copy error", f"Could not copy file '{os.path.basename(subm_file)}' "
+                                                f"to its sample-folder '{dest_dir}'!"))
+
+    # update IPD_submissions table:
+    today = time.strftime("%Y-%m-%d")
+    update_queries.append(f"""insert into IPD_submissions
+        (SUBMISSION_ID, NR_ALLELES, TIMESTAMP_SENT, SUCCESS) values
+        ('{subm_id}', {len(cell_lines)}, '{today}', 'yes')""")
+
+    success = db_internal.execute_transaction(update_queries, mydb, log,
+                                              "trying to save this submission to the database",
+                                              "Database error", parent)
+    return success, problems
+
+
 def upload_allele_with_restricted_db(project_name: str, sample_id_int: str, sample_id_ext: str, raw_path: str,
                                      customer: str, provenance: str, sample_date: str, reference_alleles,
                                      settings: dict, mydb, log):
@@ -1578,10 +1993,10 @@ def upload_allele_with_restricted_db(project_name: str, sample_id_int: str, samp
     from typeloader_core import update_reference
     ref_path_orig = os.path.join(settings["root_path"], settings["general_dir"],
                                  settings["reference_dir"])
-    target_dir = os.path.join(settings["temp_dir"], "restricted_db")
-    success, restricted_db = update_reference.make_restricted_db("restricted", ref_path_orig,
-                                                                 reference_alleles, target_dir,
-                                                                 settings["blast_path"], log)
+    cache_dir = os.path.join(settings["temp_dir"], "restricted_db")
+    success, restricted_db = update_reference.get_restricted_db("restricted", ref_path_orig,
+                                                                reference_alleles, cache_dir,
+                                                                settings["blast_path"], log)
     if not success:
         msg = "Creating restricted database did not work! Aborting..."
         log.error(msg)
@@ -1969,6 +2384,7 @@ def update_spatiotemporal_data(samples: List[str], is_local_user: bool, mydb, lo
     print("is_local_user", is_local_user)
     if is_local_user:
         log.info(f"Updating provenance and collection_date from external database for {len(samples)} samples...")
+        from typeloader2 import db_external  # needs cx_Oracle, which only local users have
         new_spatiotemporal_dic = db_external.get_countries_and_dates_from_oracle_db(samples, log)
 
         missing, already_defined, update_queries, result_dic = integrate_spatiotemporal_data(new_spatiotemporal_dic,